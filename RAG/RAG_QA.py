@@ -19,14 +19,14 @@ class StreamHandler(BaseCallbackHandler):
         print(token, end="", flush=True)
         
 class LLM_CHAT:
-    def __init__(self):
+    def __init__(self, embeddings=None):
         # Kiểm tra và điều chỉnh đường dẫn DB_ALL:
         # Trong cấu trúc thư mục của bạn, DB_ALL nằm ở thư mục gốc (ngang hàng với RAG)
         # Hoặc nằm trong RAG (RAG/DB_ALL)
         # Dựa trên cấu trúc thư mục, đường dẫn này là chính xác nếu bạn đang dùng DB_ALL ở thư mục gốc
-        self.embed_model = LangchainEmbedding(
-            HuggingFaceEmbeddings(model_name="bkai-foundation-models/vietnamese-bi-encoder",model_kwargs={'device': 'cuda' if torch.cuda.is_available() else 'cpu'})
-        )
+        # embeddings: cho phép server dùng chung model bi-encoder đã nạp (cache câu trả lời)
+        self.hf_embeddings = embeddings or HuggingFaceEmbeddings(model_name="bkai-foundation-models/vietnamese-bi-encoder",model_kwargs={'device': 'cuda' if torch.cuda.is_available() else 'cpu'})
+        self.embed_model = LangchainEmbedding(self.hf_embeddings)
         db_path = os.environ.get("DB_ALL_PATH", "./DB_ALL")
         self.chroma_client = chromadb.PersistentClient(path=db_path)
         self.chroma_collection = self.chroma_client.get_or_create_collection("KienThucYKhoa")
@@ -41,6 +41,8 @@ class LLM_CHAT:
         self.llm =  ChatOpenAI(
             api_key="any-string", 
             base_url="http://127.0.0.1:8080",
+            # llama.cpp server giữ KV của system prompt chung giữa các request
+            extra_body={"cache_prompt": True},
             # streaming=True,        #nếu streaming bật thì gỡ 2 dòng này
             # callbacks=[StreamHandler()],# streaming
             )
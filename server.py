@@ -3,6 +3,8 @@ from fastapi import FastAPI, Request, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from typing import List, Optional
@@ -14,6 +16,20 @@ import datetime
 import uuid
 import subprocess
 import sys
+import time
+import threading
+import collections
+import concurrent.futures
+import pickle
+import sqlite3
+import base64
+import functools
+import hashlib
+import random
+import gzip
+import shutil
+import atexit
+import re
 
 try:
     from llama_cpp import Llama
@@ -22,15 +38,23 @@ except Exception:
     Llama = None
     Llava15ChatHandler = None
 
+try:
+    from llama_cpp.llama_speculative import LlamaDraftModel
+except Exception:
+    LlamaDraftModel = object
+
 try:
     from PIL import Image
-    import base64
     from io import BytesIO
 except ImportError:
     Image = None
-    base64 = None
     BytesIO = None
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     from gtts import gTTS
 except ImportError:
@@ -46,7 +70,14 @@ try:
 except ImportError:
     AudioSegment = None
 
-import requests
+import anyio
+import httpx
+try:
+    import h2  # noqa: F401 - lets httpx negotiate HTTP/2 with the GPU tunnel
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 try:
     import jwt
 except Exception:
@@ -62,6 +93,11 @@ try:
 except ImportError:
     docx = None
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Import audio utilities
 try:
     from audio_utils import AudioChunker, ParallelSpeechRecognizer, TextChunker
@@ -81,89 +117,710 @@ VLM_MODEL_RELATIVE_PATH = os.path.join("models", "llava-v1.5-7b-Q6_K.gguf")
 VLM_MODEL_PATH = os.path.abspath(VLM_MODEL_RELATIVE_PATH)
 VLM_CLIP_MODEL_RELATIVE_PATH = os.path.join("models", "llava-v1.5-7b-mmproj-model-f16.gguf")
 VLM_CLIP_MODEL_PATH = os.path.abspath(VLM_CLIP_MODEL_RELATIVE_PATH)
+TEXT_MODEL_N_CTX = int(os.environ.get("TEXT_MODEL_N_CTX", "2048"))
 
 LLAMA_SERVER_URL = os.environ.get("LLAMA_SERVER_URL", "http://127.0.0.1:8080")
 JWT_SECRET = os.environ.get("JWT_SECRET", "dev-secret")
 JWT_ALG = os.environ.get("JWT_ALG", "HS256")
 
+# Fixed prompts shared by every user; their KV state is pinned per model tier.
+MEDICAL_SYSTEM_PROMPT = """Bạn là Trợ lý Y tế AI. Nhiệm vụ của bạn là cung cấp thông tin y tế hữu ích, chính xác và an toàn bằng Tiếng Việt.
+Lưu ý: Luôn khuyến cáo người dùng đi khám bác sĩ nếu có dấu hiệu nghiêm trọng. Không đưa ra chẩn đoán khẳng định thay thế bác sĩ."""
+FRIEND_SYSTEM_PROMPT = (
+    "Bạn là một người bạn thân, nói chuyện đời thường bằng tiếng Việt.\n"
+    "Cách nói tự nhiên, gần gũi, có thể hài hước nhẹ, dùng từ ngữ bình dân.\n\n"
+    "Nguyên tắc:\n"
+    "- Ưu tiên lắng nghe và đồng cảm trước.\n"
+    "- Không giảng đạo lý, không nói như sách vở.\n"
+    "- Không khuyên dạy ngay, trừ khi người dùng hỏi rõ.\n"
+    "- Phản hồi giống người thật đang trò chuyện, không phải trợ lý máy móc.\n"
+    "- Có thể hỏi lại 1 câu ngắn để hiểu thêm cảm xúc người nói.\n\n"
+    "Tránh:\n"
+    "- Nói quá dài.\n"
+    "- Dùng từ ngữ học thuật.\n"
+    "- Kết luận thay người dùng.\n"
+)
+LOOKUP_SAFETY_DISCLAIMER = (
+    "Thông tin chỉ mang tính tham khảo, không thay thế tư vấn bác sĩ. "
+    "Luôn cân nhắc cơ địa, bệnh nền, tương tác thuốc và chống chỉ định. "
+    "Khuyến khích người dùng hỏi ý kiến chuyên gia y tế cho quyết định điều trị."
+)
+LOOKUP_FORMAT_GUIDE = (
+    "\n\nĐỊNH DẠNG TRẢ LỜI:\n"
+    "📋 Thông tin chính:\n- Định nghĩa/Mô tả\n- Nguyên nhân chính\n- Triệu chứng thường gặp\n"
+    "\n🔍 Chi tiết:\n- Cách chẩn đoán\n- Phương pháp điều trị\n- Biến chứng có thể xảy ra\n"
+    "\n⚠️ Lưu ý quan trọng:\n- Khi nào cần đến bác sĩ\n- Dấu hiệu cảnh báo\n"
+)
+LOOKUP_SYSTEM_PROMPT = "Bạn là cơ sở dữ liệu y khoa an toàn và chính xác. " + LOOKUP_SAFETY_DISCLAIMER + LOOKUP_FORMAT_GUIDE
+LOOKUP_CLASSIFY_PROMPT = "Chỉ trả lời một từ: 'thuốc' hoặc 'bệnh' hoặc 'triệu chứng' hoặc 'không liên quan'. Truy vấn: "
+TITLE_SYSTEM_PROMPT = "Tạo tiêu đề ngắn gọn (≤6 từ) bằng tiếng Việt, mô tả chủ đề cuộc trò chuyện."
+SUMMARY_SYSTEM_PROMPT = (
+    "Tóm tắt ngắn gọn đoạn hội thoại bằng tiếng Việt để làm ngữ cảnh cho các lượt sau. "
+    "Giữ lại triệu chứng, thuốc, bệnh nền, thông tin cá nhân và các câu hỏi còn dang dở. "
+    "Không thêm lời khuyên mới."
+)
+SUMMARY_CONTEXT_PREFIX = "Tóm tắt các lượt trò chuyện trước: "
+
 if os.name == "nt":
     try:
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     except Exception:
         pass
 
+def _registry_servers() -> List[dict]:
+    return _RUNTIME_CONFIG.snapshot().servers
+
 def _get_proxy_base():
-    try:
-        p_mode = os.path.join(os.path.dirname(__file__), "medical-consultation-app", "data", "runtime-mode.json")
-        if os.path.exists(p_mode):
-            with open(p_mode, "r", encoding="utf-8") as f:
-                mode = json.load(f)
-            if str(mode.get("target")) == "gpu" and mode.get("gpu_url"):
-                return str(mode.get("gpu_url"))
-    except Exception:
-        pass
+    mode = _RUNTIME_CONFIG.snapshot().mode
+    if mode and str(mode.get("target")) == "gpu" and mode.get("gpu_url"):
+        return str(mode.get("gpu_url"))
     env = os.environ.get("LLAMA_SERVER_URL", "").strip()
     if env:
         return env
     try:
-        p = os.path.join(os.path.dirname(__file__), "medical-consultation-app", "data", "server-registry.json")
-        if os.path.exists(p):
-            with open(p, "r", encoding="utf-8") as f:
-                reg = json.load(f)
-            servers = reg.get("servers", [])
-            active = [s for s in servers if s.get("status") == "active"]
-            cand = sorted(active or servers, key=lambda s: s.get("updated_at", ""), reverse=True)
-            if cand:
-                return cand[0].get("url", LLAMA_SERVER_URL)
+        servers = _registry_servers()
+        active = [s for s in servers if s.get("status") == "active"]
+        cand = sorted(active or servers, key=lambda s: s.get("updated_at", ""), reverse=True)
+        if cand:
+            return cand[0].get("url", LLAMA_SERVER_URL)
     except Exception:
         pass
     default_gpu = os.environ.get("DEFAULT_GPU_URL", "https://miyoko-trichomonadal-reconditely.ngrok-free.dev")
     return default_gpu or LLAMA_SERVER_URL
 
-_LB_INDEX = 0
 def _choose_gpu_url(round_robin: bool = False) -> str:
     if not round_robin:
         return _get_proxy_base()
     try:
-        p = os.path.join(os.path.dirname(__file__), "medical-consultation-app", "data", "server-registry.json")
-        urls = []
-        if os.path.exists(p):
-            with open(p, "r", encoding="utf-8") as f:
-                reg = json.load(f)
-            servers = reg.get("servers", [])
-            active = [s for s in servers if s.get("status") == "active" and s.get("url")]
-            candidates = active or [s for s in servers if s.get("url")]
-            urls = [str(s.get("url")) for s in candidates]
-        if not urls:
-            return _get_proxy_base()
-        global _LB_INDEX
-        _LB_INDEX = (_LB_INDEX + 1) % len(urls)
-        return urls[_LB_INDEX]
+        return _GPU_BALANCER.pick(_gpu_candidates())
     except Exception:
         return _get_proxy_base()
 
 def _current_target():
+    mode = _RUNTIME_CONFIG.snapshot().mode
+    if mode is not None:
+        return "gpu" if str(mode.get("target", "cpu")).lower() == "gpu" else "cpu"
+    return "gpu"
+
+GPU_HTTP_CONNECT_TIMEOUT = float(os.environ.get("GPU_HTTP_CONNECT_TIMEOUT", "5"))
+GPU_HTTP_MAX_CONNECTIONS = int(os.environ.get("GPU_HTTP_MAX_CONNECTIONS", "64"))
+GPU_HTTP_MAX_KEEPALIVE = int(os.environ.get("GPU_HTTP_MAX_KEEPALIVE", "32"))
+GPU_HTTP_MAX_PER_HOST = int(os.environ.get("GPU_HTTP_MAX_PER_HOST", "16"))
+
+_HTTP_CLIENT = None
+_HTTP_CLIENT_LOOP = None
+_HTTP_HOST_SLOTS = {}
+_HTTP_STATS = {"requests": 0, "streams": 0, "errors": 0, "slot_waits": 0, "in_flight": {}}
+
+def _http_client() -> "httpx.AsyncClient":
+    # One keep-alive pool shared by every proxy path; rebuilt only if the event
+    # loop changed (e.g. TestClient without lifespan) since connections are loop-bound.
+    global _HTTP_CLIENT, _HTTP_CLIENT_LOOP, _HTTP_HOST_SLOTS
+    loop = asyncio.get_running_loop()
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed or _HTTP_CLIENT_LOOP is not loop:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            http2=_HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=GPU_HTTP_MAX_CONNECTIONS, max_keepalive_connections=GPU_HTTP_MAX_KEEPALIVE, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(60.0, connect=GPU_HTTP_CONNECT_TIMEOUT),
+        )
+        _HTTP_CLIENT_LOOP = loop
+        _HTTP_HOST_SLOTS = {}
+    return _HTTP_CLIENT
+
+async def _close_http_client():
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        try:
+            await _HTTP_CLIENT.aclose()
+        except Exception:
+            pass
+        _HTTP_CLIENT = None
+
+class _SlotReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, inner, release):
+        self.inner = inner
+        self.release = release
+
+    async def __aiter__(self):
+        async for chunk in self.inner:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.inner.aclose()
+        finally:
+            self.release()
+
+async def _http_send(method: str, url: str, timeout: float = 60.0, stream: bool = False, **kwargs) -> "httpx.Response":
+    client = _http_client()
+    host = httpx.URL(url).host
+    slot = _HTTP_HOST_SLOTS.get(host)
+    if slot is None:
+        slot = _HTTP_HOST_SLOTS[host] = asyncio.Semaphore(GPU_HTTP_MAX_PER_HOST)
+    if slot.locked():
+        _HTTP_STATS["slot_waits"] += 1
+    await slot.acquire()
+    in_flight = _HTTP_STATS["in_flight"]
+    in_flight[host] = in_flight.get(host, 0) + 1
+    released = False
+    def _release():
+        nonlocal released
+        if not released:
+            released = True
+            in_flight[host] = max(0, in_flight.get(host, 1) - 1)
+            slot.release()
+    _HTTP_STATS["streams" if stream else "requests"] += 1
     try:
-        pdir = _front_data_dir()
-        mode_path = os.path.join(pdir, "runtime-mode.json")
-        if os.path.exists(mode_path):
-            with open(mode_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            t = str(data.get("target", "cpu")).lower()
-            return "gpu" if t == "gpu" else "cpu"
+        request = client.build_request(method, url, timeout=httpx.Timeout(timeout, connect=GPU_HTTP_CONNECT_TIMEOUT), **kwargs)
+        resp = await client.send(request, stream=stream)
+    except BaseException:
+        _HTTP_STATS["errors"] += 1
+        _release()
+        raise
+    if not stream:
+        _release()
+        return resp
+    resp.stream = _SlotReleasingStream(resp.stream, _release)
+    return resp
+
+async def _http_close(resp):
+    # Shielded so a client disconnect cannot cancel the close and leak the connection.
+    with anyio.CancelScope(shield=True):
+        await resp.aclose()
+
+@asynccontextmanager
+async def _http_stream(method: str, url: str, timeout: float = 60.0, **kwargs):
+    resp = await _http_send(method, url, timeout=timeout, stream=True, **kwargs)
+    try:
+        yield resp
+    finally:
+        await _http_close(resp)
+
+def _http_pool_stats() -> dict:
+    pools = {}
+    try:
+        for conn in _HTTP_CLIENT._transport._pool.connections:
+            origin = str(getattr(conn, "_origin", "") or "unknown")
+            p = pools.setdefault(origin, {"connections": 0, "idle": 0, "http2": 0})
+            p["connections"] += 1
+            if conn.is_idle():
+                p["idle"] += 1
+            if "HTTP/2" in conn.info():
+                p["http2"] += 1
     except Exception:
         pass
-    return "gpu"
+    return {
+        "http2_enabled": _HTTP2_AVAILABLE,
+        "max_connections": GPU_HTTP_MAX_CONNECTIONS,
+        "max_keepalive": GPU_HTTP_MAX_KEEPALIVE,
+        "max_per_host": GPU_HTTP_MAX_PER_HOST,
+        "connect_timeout_s": GPU_HTTP_CONNECT_TIMEOUT,
+        "requests": _HTTP_STATS["requests"],
+        "streams": _HTTP_STATS["streams"],
+        "errors": _HTTP_STATS["errors"],
+        "slot_waits": _HTTP_STATS["slot_waits"],
+        "in_flight": dict(_HTTP_STATS["in_flight"]),
+        "pools": pools,
+    }
+
+GPU_REQUEST_DEADLINE_S = float(os.environ.get("GPU_REQUEST_DEADLINE_S", "45"))
+GPU_HEDGE = os.environ.get("GPU_HEDGE", "1").strip().lower() not in ("0", "false", "off")
+GPU_HEDGE_DELAY_S = float(os.environ.get("GPU_HEDGE_DELAY_S", "3"))
+GPU_HEDGE_MIN_DELAY_S = float(os.environ.get("GPU_HEDGE_MIN_DELAY_S", "0.25"))
+GPU_MIN_ROUND_TRIP_S = float(os.environ.get("GPU_MIN_ROUND_TRIP_S", "1"))
+
+_GPU_LATENCY = {}
+_PROXY_STATS = {"calls": 0, "ok": 0, "fallbacks": 0, "hedged": 0, "hedge_wins": 0, "budget_skips": 0, "breaker_skips": 0, "cancelled": 0}
+
+def _latency_quantile(key, q: float, default: float) -> float:
+    # Falls back to `default` until the backend has a handful of samples.
+    samples = _GPU_LATENCY.get(key)
+    if not samples or len(samples) < 5:
+        return default
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _gpu_candidates() -> List[str]:
+    urls = [_get_proxy_base()]
+    for srv in _registry_servers():
+        url = str(srv.get("url") or "")
+        if url and srv.get("status") == "active" and url.rstrip("/") not in [u.rstrip("/") for u in urls]:
+            urls.append(url)
+    return urls
+
+GPU_LB_EWMA_ALPHA = float(os.environ.get("GPU_LB_EWMA_ALPHA", "0.3"))
+
+class _GpuBalancer:
+    # Power-of-two-choices over a per-backend cost: EWMA latency scaled by the
+    # requests we have outstanding there plus the queue the backend itself reports.
+    def __init__(self):
+        self.ewma = {}
+        self.picks = {}
+
+    def observe(self, url: str, seconds: float):
+        key = url.rstrip("/")
+        prev = self.ewma.get(key)
+        self.ewma[key] = seconds if prev is None else prev + GPU_LB_EWMA_ALPHA * (seconds - prev)
+
+    def _queue(self, key: str) -> float:
+        metrics = (_BACKEND_STATUS.get(key) or {}).get("metrics") or {}
+        for field in ("queue_depth", "queue", "pending", "waiting"):
+            if isinstance(metrics.get(field), (int, float)):
+                return float(metrics[field])
+        # The stock GPU server only reports utilisation; treat a saturated GPU as one queued request.
+        util = metrics.get("gpu_utilization")
+        return float(util) / 100.0 if isinstance(util, (int, float)) else 0.0
+
+    def cost(self, url: str) -> float:
+        key = url.rstrip("/")
+        known = [v for v in self.ewma.values() if v is not None]
+        latency = self.ewma.get(key)
+        if latency is None:
+            # Unmeasured backends look as fast as the best one so they get sampled.
+            latency = min(known) if known else 1.0
+        in_flight = _HTTP_STATS["in_flight"].get(httpx.URL(key).host, 0)
+        cost = latency * (1.0 + in_flight + self._queue(key))
+        if (_BACKEND_STATUS.get(key) or {}).get("healthy") is False:
+            cost *= 100.0
+        return cost
+
+    def rank(self, urls: List[str]) -> List[str]:
+        if len(urls) < 2:
+            return list(urls)
+        a, b = random.sample(urls, 2)
+        first = a if self.cost(a) <= self.cost(b) else b
+        rest = sorted((u for u in urls if u != first), key=self.cost)
+        key = first.rstrip("/")
+        self.picks[key] = self.picks.get(key, 0) + 1
+        return [first] + rest
+
+    def pick(self, urls: List[str]) -> str:
+        # Same breaker contract as _proxy_call: rank the available backends and
+        # take the half-open trial slot (or move open -> half_open) via allow().
+        usable = [u for u in urls if _breaker(u).available()]
+        for u in self.rank(usable):
+            if _breaker(u).allow():
+                return u
+        return self.rank(urls)[0]
+
+    def stats(self) -> dict:
+        keys = sorted(set(self.ewma) | set(self.picks))
+        return {k: {"ewma_s": round(self.ewma[k], 3) if k in self.ewma else None, "picks": self.picks.get(k, 0), "cost": round(self.cost(k), 3)} for k in keys}
+
+_GPU_BALANCER = _GpuBalancer()
+
+@asynccontextmanager
+async def _balanced_call(base: str):
+    # Feeds the time to first response into the balancer and the breaker.
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        _breaker(base).failure(str(e) or e.__class__.__name__)
+        raise
+    _GPU_BALANCER.observe(base, time.perf_counter() - started)
+    _breaker(base).success()
+
+GPU_BREAKER_FAILURES = int(os.environ.get("GPU_BREAKER_FAILURES", "3"))
+GPU_BREAKER_COOLDOWN_S = float(os.environ.get("GPU_BREAKER_COOLDOWN_S", "30"))
+GPU_PROBE_INTERVAL_S = float(os.environ.get("GPU_PROBE_INTERVAL_S", "15"))
+
+class _CircuitBreaker:
+    # closed -> open after N consecutive failures; open -> half_open once the
+    # cooldown passes (or a probe succeeds); half_open lets one trial call through.
+    def __init__(self, url: str):
+        self.url = url
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_at = 0.0
+        self.last_error = None
+        self.transitions = 0
+
+    def _move(self, state: str, reason: str):
+        if state == self.state:
+            return
+        prev, self.state = self.state, state
+        self.transitions += 1
+        if state == "open":
+            self.opened_at = time.time()
+        _append_runtime_event({"type": "gpu_breaker", "url": self.url, "from": prev, "to": state, "reason": reason, "failures": self.failures, "ts": datetime.datetime.utcnow().isoformat()})
+
+    def available(self) -> bool:
+        # Side-effect free: could a call be sent now? Used to pick candidates;
+        # the half-open trial slot is only taken by allow() at launch time.
+        now = time.time()
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return now - self.opened_at >= GPU_BREAKER_COOLDOWN_S
+        return now - self.trial_at >= GPU_BREAKER_COOLDOWN_S
+
+    def allow(self) -> bool:
+        now = time.time()
+        if self.state == "open" and now - self.opened_at >= GPU_BREAKER_COOLDOWN_S:
+            self._move("half_open", "cooldown elapsed")
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and now - self.trial_at >= GPU_BREAKER_COOLDOWN_S:
+            self.trial_at = now
+            return True
+        return False
+
+    def success(self, reason: str = "request ok"):
+        self.failures = 0
+        self.last_error = None
+        self._move("closed", reason)
+
+    def failure(self, error: str):
+        self.failures += 1
+        self.last_error = error
+        if self.state == "half_open" or self.failures >= GPU_BREAKER_FAILURES:
+            self._move("open", error)
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "opened_at": self.opened_at or None, "last_error": self.last_error, "transitions": self.transitions}
+
+_BREAKERS = {}
+_BACKEND_STATUS = {}
+_PROBER = {"task": None}
+
+def _breaker(url: str) -> _CircuitBreaker:
+    key = url.rstrip("/")
+    b = _BREAKERS.get(key)
+    if b is None:
+        b = _BREAKERS[key] = _CircuitBreaker(key)
+    return b
+
+def _registry_urls() -> List[str]:
+    return [str(s.get("url")) for s in _registry_servers() if s.get("url")]
+
+async def _probe_backend(url: str):
+    base = url.rstrip("/")
+    headers = {"ngrok-skip-browser-warning": "true"}
+    started = time.perf_counter()
+    status = {"checked_at": datetime.datetime.utcnow().isoformat(), "healthy": False}
+    try:
+        r = await _http_send("GET", f"{base}/health", headers=headers, timeout=5)
+        status["latency_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        status["healthy"] = r.is_success
+        if not r.is_success:
+            status["error"] = f"/health answered {r.status_code}"
+        else:
+            try:
+                gm = await _http_send("GET", f"{base}/gpu/metrics", headers=headers, timeout=5)
+                if gm.is_success:
+                    status["metrics"] = gm.json()
+            except Exception:
+                pass
+    except Exception as e:
+        status["error"] = str(e) or e.__class__.__name__
+    _BACKEND_STATUS[base] = status
+    breaker = _breaker(base)
+    if status["healthy"]:
+        if breaker.state == "open":
+            breaker._move("half_open", "probe ok")
+            breaker.trial_at = 0.0
+    else:
+        breaker.failure("probe: " + status.get("error", "unhealthy"))
+
+async def _probe_backends():
+    while True:
+        try:
+            if _current_target() == "gpu":
+                urls = []
+                for u in [_get_proxy_base()] + _registry_urls():
+                    if u.rstrip("/") not in urls:
+                        urls.append(u.rstrip("/"))
+                await asyncio.gather(*[_probe_backend(u) for u in urls], return_exceptions=True)
+        except Exception:
+            pass
+        await asyncio.sleep(GPU_PROBE_INTERVAL_S)
+
+class _ProxyBudgetExceeded(Exception):
+    pass
+
+async def _proxy_attempt(base: str, attempts, headers: dict, deadline: float, stream: bool):
+    # Walks the endpoint variants on one backend, never past the shared deadline.
+    loop = asyncio.get_running_loop()
+    key = (base.rstrip("/"), stream)
+    status = None
+    for path, body in attempts:
+        remaining = deadline - loop.time()
+        if remaining < _latency_quantile(key, 0.5, GPU_MIN_ROUND_TRIP_S):
+            _PROXY_STATS["budget_skips"] += 1
+            raise _ProxyBudgetExceeded(f"{remaining:.1f}s left, not enough for {base}")
+        started = loop.time()
+        try:
+            resp = await _http_send("POST", f"{base.rstrip('/')}{path}", timeout=remaining, stream=stream, headers=headers, content=json.dumps(body))
+        except Exception as e:
+            _breaker(base).failure(str(e) or e.__class__.__name__)
+            raise
+        if resp.is_success:
+            _GPU_LATENCY.setdefault(key, collections.deque(maxlen=64)).append(loop.time() - started)
+            _GPU_BALANCER.observe(base, loop.time() - started)
+            _breaker(base).success()
+            return base, resp
+        status = resp.status_code
+        if stream:
+            await _http_close(resp)
+    _breaker(base).failure(f"HTTP {status}")
+    raise RuntimeError(f"GPU backend {base} answered {status}")
+
+def _discard_proxy_loser(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    _spawn_background(_http_close(task.result()[1]))
+
+async def _proxy_call(attempts, headers: dict, stream: bool = False, deadline_s: Optional[float] = None):
+    """POST to the GPU registry within one deadline; returns (base, response) or None.
+
+    `attempts` is a list of (path, body) tried in order on a backend. If the first
+    backend has not answered after its p95 latency, the same call is hedged to the
+    next registry server and whichever succeeds first wins; the others are cancelled.
+    None means the caller should fall through to the CPU tier.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (deadline_s or GPU_REQUEST_DEADLINE_S)
+    bases = _GPU_BALANCER.rank([b for b in _gpu_candidates() if _breaker(b).available()])
+    if not GPU_HEDGE:
+        bases = bases[:1]
+    if not bases:
+        # Every backend's circuit is open: go straight to the CPU tier.
+        _PROXY_STATS["calls"] += 1
+        _PROXY_STATS["fallbacks"] += 1
+        _PROXY_STATS["breaker_skips"] += 1
+        return None
+    hedge_delay = max(GPU_HEDGE_MIN_DELAY_S, _latency_quantile((bases[0].rstrip("/"), stream), 0.95, GPU_HEDGE_DELAY_S))
+    _PROXY_STATS["calls"] += 1
+    pending = set()
+    winner = None
+    launched = 0
+    considered = 0
+    wait_timed_out = False
+    errors = []
+    try:
+        while winner is None:
+            if considered < len(bases) and (considered == 0 or not pending or wait_timed_out):
+                base = bases[considered]
+                considered += 1
+                if not _breaker(base).allow():
+                    # Lost the half-open trial slot to a concurrent request.
+                    continue
+                pending.add(asyncio.ensure_future(_proxy_attempt(base, attempts, headers, deadline, stream)))
+                if launched:
+                    _PROXY_STATS["hedged"] += 1
+                launched += 1
+            if not pending:
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                errors.append("deadline")
+                break
+            timeout = min(remaining, hedge_delay) if considered < len(bases) else remaining
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            wait_timed_out = not done
+            for t in done:
+                if t.exception() is not None:
+                    errors.append(str(t.exception()))
+                elif winner is None:
+                    winner = t.result()
+                else:
+                    _discard_proxy_loser(t)
+    finally:
+        for t in pending:
+            t.cancel()
+            t.add_done_callback(_discard_proxy_loser)
+        _PROXY_STATS["cancelled"] += len(pending)
+    if winner is None:
+        _PROXY_STATS["fallbacks"] += 1
+        _append_runtime_event({"type": "gpu_proxy_fallback", "backends": launched, "errors": errors[-3:], "ts": datetime.datetime.utcnow().isoformat()})
+        return None
+    _PROXY_STATS["ok"] += 1
+    if winner[0] != bases[0]:
+        _PROXY_STATS["hedge_wins"] += 1
+    return winner
+
+def _proxy_stats() -> dict:
+    backends = {}
+    for (base, stream), samples in list(_GPU_LATENCY.items()):
+        p50 = _latency_quantile((base, stream), 0.5, None)
+        p95 = _latency_quantile((base, stream), 0.95, None)
+        backends.setdefault(base, {})["stream" if stream else "json"] = {
+            "samples": len(samples),
+            "p50_s": round(p50, 3) if p50 is not None else None,
+            "p95_s": round(p95, 3) if p95 is not None else None,
+        }
+    return {"deadline_s": GPU_REQUEST_DEADLINE_S, "hedge": GPU_HEDGE, **_PROXY_STATS, "backends": backends, "balancer": _GPU_BALANCER.stats()}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup logic
     await _setup_event_loop_handler()
+    _http_client()
     await load_model()
+    if GPU_PROBE_INTERVAL_S > 0:
+        _PROBER["task"] = asyncio.create_task(_probe_backends())
+    config_watch = asyncio.create_task(_RUNTIME_CONFIG.watch())
     yield
+    config_watch.cancel()
+    if _PROBER["task"] is not None:
+        _PROBER["task"].cancel()
+        _PROBER["task"] = None
+    await _close_http_client()
+    await asyncio.to_thread(_EVENTS.flush)
+
+ADMISSION_PATHS = ("/v1/chat/completions", "/v1/friend-chat/completions", "/v1/vision-chat", "/v1/document-chat")
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "16"))
+ADMISSION_USER_TOKENS_PER_MIN = float(os.environ.get("ADMISSION_USER_TOKENS_PER_MIN", "8000"))
+ADMISSION_USER_BURST = float(os.environ.get("ADMISSION_USER_BURST", "4096"))
+ADMISSION_IMAGE_TOKENS = int(os.environ.get("ADMISSION_IMAGE_TOKENS", "576"))
+
+def _estimate_tokens(text: str) -> int:
+    # Vietnamese runs ~3 chars/token on the Llama tokenizers; close enough for admission.
+    return len(text or "") // 3 + 1
+
+def _request_cost(path: str, body: dict) -> int:
+    max_tokens = body.get("max_tokens")
+    cost = int(max_tokens) if isinstance(max_tokens, (int, float)) and max_tokens > 0 else 512
+    if path == "/v1/vision-chat":
+        return cost + _estimate_tokens(body.get("text", "")) + ADMISSION_IMAGE_TOKENS
+    if path == "/v1/document-chat":
+        # Base64 inflates by 4/3; extracted text is usually a fraction of the file.
+        return cost + _estimate_tokens(body.get("text", "")) + len(body.get("doc_base64") or "") // 8
+    for m in body.get("messages") or []:
+        if isinstance(m, dict):
+            cost += _estimate_tokens(str(m.get("content", "")))
+    for field in ("prompt", "question", "message", "system"):
+        if isinstance(body.get(field), str):
+            cost += _estimate_tokens(body[field])
+    return cost
+
+class _TokenBucket:
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float) -> float:
+        # Returns 0 when admitted, else the seconds until `cost` would fit.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+_ADMISSION = {"middleware": None}
+
+class _AdmissionMiddleware:
+    """Fast 429s for generation endpoints instead of queueing until timeout.
+
+    Each request is priced at estimated prompt tokens + max_tokens and charged to a
+    per-user token bucket; a global cap bounds how many run at once. The slot is
+    held until the response body (including a stream) has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.buckets = collections.OrderedDict()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_busy = 0
+        self.avg_s = 5.0
+        _ADMISSION["middleware"] = self
+
+    def _user(self, scope) -> str:
+        # Only an authenticated identity picks the bucket; a body user_id is
+        # caller-controlled and could be rotated to dodge the limit.
+        user = get_current_user(Request(scope))
+        if user and user != "anonymous":
+            return user
+        client = scope.get("client")
+        return "ip:" + (client[0] if client else "unknown")
+
+    def _bucket(self, user: str) -> _TokenBucket:
+        b = self.buckets.get(user)
+        if b is None:
+            b = self.buckets[user] = _TokenBucket(ADMISSION_USER_BURST, ADMISSION_USER_TOKENS_PER_MIN / 60.0)
+            while len(self.buckets) > 10000:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(user)
+        return b
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST" or scope.get("path") not in ADMISSION_PATHS:
+            await self.app(scope, receive, send)
+            return
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        raw = b"".join(chunks)
+        try:
+            body = json.loads(raw or b"{}")
+            if not isinstance(body, dict):
+                body = {}
+        except Exception:
+            body = {}
+        user = self._user(scope)
+        cost = _request_cost(scope["path"], body)
+        if self.in_flight >= ADMISSION_MAX_CONCURRENT:
+            self.rejected_busy += 1
+            await self._reject(scope, receive, send, max(1, int(round(self.avg_s))), "Máy chủ đang quá tải, vui lòng thử lại sau.")
+            return
+        wait = self._bucket(user).take(cost)
+        if wait > 0:
+            self.rejected_rate += 1
+            await self._reject(scope, receive, send, max(1, int(wait + 0.999)), "Bạn đang gửi quá nhiều yêu cầu, vui lòng thử lại sau.")
+            return
+        replayed = False
+        async def _receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": raw, "more_body": False}
+            return await receive()
+        self.in_flight += 1
+        self.admitted += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, _receive, send)
+        finally:
+            self.in_flight -= 1
+            self.avg_s += 0.2 * ((time.perf_counter() - started) - self.avg_s)
+
+    async def _reject(self, scope, receive, send, retry_after: int, detail: str):
+        _append_runtime_event({"type": "admission_rejected", "path": scope.get("path"), "retry_after": retry_after, "ts": datetime.datetime.utcnow().isoformat()})
+        response = JSONResponse(status_code=429, content={"detail": detail}, headers={"Retry-After": str(retry_after)})
+        await response(scope, receive, send)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": ADMISSION_MAX_CONCURRENT,
+            "user_tokens_per_min": ADMISSION_USER_TOKENS_PER_MIN,
+            "user_burst": ADMISSION_USER_BURST,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected_rate": self.rejected_rate,
+            "rejected_busy": self.rejected_busy,
+            "tracked_users": len(self.buckets),
+        }
 
 app = FastAPI(title="Local LLaMA Chat API", version="1.0.0", lifespan=lifespan)
 
+# Registered before CORS so 429s still carry CORS headers and Retry-After is readable.
+app.add_middleware(_AdmissionMiddleware)
+
 # CORS for Next.js dev
 app.add_middleware(
     CORSMiddleware,
@@ -209,6 +866,8 @@ class ChatRequest(BaseModel):
     question: Optional[str] = None
     message: Optional[str] = None
     system: Optional[str] = None
+    stream: Optional[bool] = False
+    deterministic: Optional[bool] = False
 
 class ChatChoice(BaseModel):
     index: int
@@ -268,6 +927,7 @@ class HealthLookupResponse(BaseModel):
     conversation_id: Optional[str] = None
     mode: Optional[str] = None
     redirect_url: Optional[str] = None
+    cached: Optional[bool] = None
 
 class LoginRequest(BaseModel):
     username: str
@@ -297,8 +957,6 @@ llm_pro: Optional[Llama] = None
 llm_flash: Optional[Llama] = None
 vlm_llm: Optional[Llama] = None
 rag_chat = None
-MOCK_CHAT_DB = {}
-MOCK_SOCIAL_DB = {}
 DATA_DIR = os.path.abspath(os.path.join(os.getcwd(), "data"))
 USER_FILE = os.path.join(DATA_DIR, "user.json")
 
@@ -324,91 +982,550 @@ def _save_user(data: dict):
     with open(USER_FILE, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False)
 
-def _ensure_user(user_id: str):
-    if user_id not in MOCK_CHAT_DB:
-        MOCK_CHAT_DB[user_id] = {"conversations": {}}
+CHAT_DB_PATH = os.environ.get("CHAT_DB_PATH", "").strip() or os.path.join(DATA_DIR, "conversations.sqlite3")
+CHAT_DB_BATCH_MAX = int(os.environ.get("CHAT_DB_BATCH_MAX", "64"))
+# Hot conversation histories kept in process; idle or over-budget ones are
+# dropped (SQLite already holds them) and re-read on next use.
+CHAT_MEMORY_BUDGET_MB = float(os.environ.get("CHAT_MEMORY_BUDGET_MB", "64"))
+CHAT_MEMORY_IDLE_S = float(os.environ.get("CHAT_MEMORY_IDLE_S", "1800"))
+
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    pk INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    meta TEXT NOT NULL DEFAULT '{}',
+    start_time TEXT NOT NULL,
+    last_active TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (kind, user_id, id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_pk INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    extra TEXT,
+    PRIMARY KEY (conversation_pk, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conversation_tombstones (
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (kind, user_id, id)
+);
+CREATE TABLE IF NOT EXISTS store_clock (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO store_clock (id, version) VALUES (0, 0);
+"""
+# Created after the migration below so databases from before `version` existed upgrade in place.
+_STORE_INDEXES = """
+CREATE INDEX IF NOT EXISTS conversations_by_activity ON conversations (kind, user_id, last_active);
+CREATE INDEX IF NOT EXISTS conversations_by_version ON conversations (kind, user_id, version);
+CREATE INDEX IF NOT EXISTS tombstones_by_version ON conversation_tombstones (kind, user_id, version);
+"""
+
+def _ts_ms(value) -> int:
+    # Message timestamps are stored as integer epoch milliseconds (UTC); rows
+    # written before that hold naive-UTC ISO strings.
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value or "")
+    if text.isdigit():
+        return int(text)
+    try:
+        dt = datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except Exception:
+        return int(time.time() * 1000)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return int((dt - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+def _ms_iso(ms: int) -> str:
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ms)).isoformat()
+
+class _Message:
+    """Compact stored message; roles are interned so a page shares one string per role."""
+    __slots__ = ("seq", "role", "content", "ts", "extra")
+
+    FIELDS = ("seq", "role", "content", "timestamp", "ts")
+
+    def __init__(self, seq: int, role: str, content: str, ts, extra: Optional[str]):
+        self.seq = seq
+        self.role = sys.intern(role)
+        self.content = content
+        self.ts = _ts_ms(ts)
+        self.extra = extra
+
+    def size(self) -> int:
+        return 120 + sys.getsizeof(self.content) + (len(self.extra) if self.extra else 0)
+
+    def as_dict(self, fields: Optional[tuple] = None) -> dict:
+        if fields is None:
+            m = {"role": self.role, "content": self.content, "timestamp": _ms_iso(self.ts)}
+            if self.extra:
+                m.update(json.loads(self.extra))
+            return m
+        m = {}
+        for f in fields:
+            if f == "timestamp":
+                m[f] = _ms_iso(self.ts)
+            else:
+                m[f] = getattr(self, f)
+        return m
+
+class _ConversationMemory:
+    """LRU of full message histories, bounded by approximate bytes and idle time.
+
+    Entries are keyed by (kind, user_id, id) and validated against the row's
+    (pk, last seq): messages are append-only, so a matching pair means the
+    cached list is exactly what SQLite holds, even if another process wrote."""
+
+    def __init__(self, budget_bytes: int, idle_s: float):
+        self.budget = budget_bytes
+        self.idle_s = idle_s
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {"budget": 0, "idle": 0, "stale": 0}
+
+    def get(self, key: tuple, pk: int, last_seq: int) -> Optional[List[_Message]]:
+        with self.lock:
+            e = self.entries.get(key)
+            if e is not None and (e["pk"], e["last_seq"]) == (pk, last_seq):
+                e["used"] = time.monotonic()
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(e["messages"])
+            if e is not None:
+                self._drop(key, "stale")
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, pk: int, last_seq: int, messages: List[_Message]):
+        if self.budget <= 0:
+            return
+        with self.lock:
+            self._drop(key, None)
+            size = sum(m.size() for m in messages)
+            self.entries[key] = {"pk": pk, "last_seq": last_seq, "messages": list(messages), "bytes": size, "used": time.monotonic()}
+            self.bytes += size
+            self._evict()
+
+    def extend(self, key: tuple, pk: int, first_seq: int, messages: List[_Message]):
+        # Write-through after a committed append; only when the cached copy was current.
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                return
+            if (e["pk"], e["last_seq"]) != (pk, first_seq - 1):
+                self._drop(key, "stale")
+                return
+            size = sum(m.size() for m in messages)
+            e["messages"].extend(messages)
+            e["last_seq"] = messages[-1].seq if messages else e["last_seq"]
+            e["bytes"] += size
+            e["used"] = time.monotonic()
+            self.entries.move_to_end(key)
+            self.bytes += size
+            self._evict()
+
+    def discard(self, key: tuple):
+        with self.lock:
+            self._drop(key, None)
+
+    def _drop(self, key: tuple, reason: Optional[str]):
+        e = self.entries.pop(key, None)
+        if e is not None:
+            self.bytes -= e["bytes"]
+            if reason:
+                self.evictions[reason] += 1
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.idle_s
+        while self.entries:
+            key, e = next(iter(self.entries.items()))
+            if e["used"] < cutoff:
+                self._drop(key, "idle")
+            elif self.bytes > self.budget:
+                self._drop(key, "budget")
+            else:
+                break
+
+    def sweep(self):
+        with self.lock:
+            self._evict()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "budget_bytes": self.budget,
+                "idle_s": self.idle_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": dict(self.evictions),
+            }
+
+class _ConversationStore:
+    """Chat and social conversations in SQLite (WAL), shared by every worker process.
+
+    Reads run on the caller's thread over a per-thread connection. Writes are queued
+    to one writer thread that commits whatever has accumulated in a single
+    transaction, so the event loop never waits on fsync. Reads first wait for this
+    process's queued writes, which keeps read-your-writes semantics.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.init_lock = threading.Lock()
+        self.ready = False
+        self.submitted = 0
+        self.applied = 0
+        # Latest submitted job per (kind, user_id, id) and per (kind, user_id), so a
+        # read only waits for writes to the conversation or listing it looks at.
+        self.pending = {}
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+        self.memory = _ConversationMemory(int(CHAT_MEMORY_BUDGET_MB * 1024 * 1024), CHAT_MEMORY_IDLE_S)
+
+    def _connect(self) -> "sqlite3.Connection":
+        # isolation_level=None: the writer issues BEGIN/COMMIT itself. SQL strings are
+        # constants so sqlite3's statement cache keeps them prepared.
+        conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    def _init(self):
+        if self.ready:
+            return
+        with self.init_lock:
+            if self.ready:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = self._connect()
+            conn.executescript(_STORE_SCHEMA)
+            if "version" not in [r[1] for r in conn.execute("PRAGMA table_info(conversations)")]:
+                conn.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.executescript(_STORE_INDEXES)
+            conn.close()
+            threading.Thread(target=self._writer, name="conversation-store", daemon=True).start()
+            self.ready = True
+
+    def _db(self) -> "sqlite3.Connection":
+        self._init()
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    def _submit(self, fn, *args) -> concurrent.futures.Future:
+        self._init()
+        fut = concurrent.futures.Future()
+        with self.cond:
+            self.submitted += 1
+            # Every op takes (kind, user_id, conversation_id, ...).
+            self.pending[args[:3]] = self.pending[args[:2]] = self.submitted
+            self.jobs.append((self.submitted, fn, args, fut))
+            self.cond.notify_all()
+        return fut
+
+    def _barrier(self, key: tuple):
+        # Read-your-writes for one conversation (or one user's listing). Blocks, so
+        # async callers go through asyncio.to_thread.
+        if not self.ready:
+            return
+        with self.cond:
+            target = self.pending.get(key)
+            if target is not None:
+                self.cond.wait_for(lambda: self.applied >= target, timeout=10.0)
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                batch = [self.jobs.popleft() for _ in range(min(CHAT_DB_BATCH_MAX, len(self.jobs)))]
+            results = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for _, fn, args, fut in batch:
+                    # A failing job rolls back alone; the rest of the batch still commits.
+                    conn.execute("SAVEPOINT job")
+                    try:
+                        results.append((fut, fn(conn, *args), None))
+                        conn.execute("RELEASE job")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO job")
+                        conn.execute("RELEASE job")
+                        results.append((fut, None, e))
+                conn.execute("COMMIT")
+            except Exception as e:
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                results = [(fut, None, e) for _, _, _, fut in batch]
+            self.batches += 1
+            self.writes += len(batch)
+            with self.cond:
+                self.applied = batch[-1][0]
+                for _, _, args, _ in batch:
+                    for key in (args[:3], args[:2]):
+                        if self.pending.get(key, 0) <= self.applied:
+                            self.pending.pop(key, None)
+                self.cond.notify_all()
+            for fut, result, err in results:
+                if err is not None:
+                    self.errors += 1
+                    print(f"Conversation store write failed: {err}")
+                    fut.set_exception(err)
+                else:
+                    fut.set_result(result)
+
+    @staticmethod
+    def _pk(conn, kind: str, user_id: str, conversation_id: str) -> Optional[int]:
+        row = conn.execute("SELECT pk FROM conversations WHERE kind = ? AND user_id = ? AND id = ?", (kind, user_id, conversation_id)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _bump(conn) -> int:
+        # Store-wide change counter. Writers hold the database write lock, so
+        # versions are strictly increasing in commit order across processes.
+        conn.execute("UPDATE store_clock SET version = version + 1 WHERE id = 0")
+        return conn.execute("SELECT version FROM store_clock WHERE id = 0").fetchone()[0]
+
+    @classmethod
+    def _op_create(cls, conn, kind: str, user_id: str, conversation_id: str, title: str, now: str):
+        conn.execute(
+            "INSERT OR IGNORE INTO conversations (kind, user_id, id, title, meta, start_time, last_active, version) VALUES (?, ?, ?, ?, '{}', ?, ?, ?)",
+            (kind, user_id, conversation_id, title, now, now, cls._bump(conn)),
+        )
+
+    @classmethod
+    def _op_append(cls, conn, kind: str, user_id: str, conversation_id: str, messages: List[dict], title: Optional[str], now: str):
+        cls._op_create(conn, kind, user_id, conversation_id, title or "", now)
+        pk = cls._pk(conn, kind, user_id, conversation_id)
+        last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE conversation_pk = ?", (pk,)).fetchone()[0]
+        rows = []
+        for i, m in enumerate(messages, start=1):
+            extra = {k: v for k, v in m.items() if k not in ("role", "content", "timestamp")}
+            rows.append((pk, last + i, str(m.get("role", "")), str(m.get("content", "")), _ts_ms(m.get("timestamp") or now), json.dumps(extra, ensure_ascii=False) if extra else None))
+        conn.executemany("INSERT INTO messages (conversation_pk, seq, role, content, ts, extra) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.execute(
+            "UPDATE conversations SET last_active = ?, version = ?, title = CASE WHEN title = '' AND ? IS NOT NULL THEN ? ELSE title END WHERE pk = ?",
+            (now, cls._bump(conn), title, title, pk),
+        )
+        return pk, rows
+
+    @classmethod
+    def _op_update(cls, conn, kind: str, user_id: str, conversation_id: str, fields: dict):
+        row = conn.execute("SELECT pk, meta FROM conversations WHERE kind = ? AND user_id = ? AND id = ?", (kind, user_id, conversation_id)).fetchone()
+        if row is None:
+            return False
+        meta = json.loads(row["meta"] or "{}")
+        for k, v in fields.items():
+            if k == "title":
+                continue
+            if v is None:
+                meta.pop(k, None)
+            else:
+                meta[k] = v
+        if "title" in fields:
+            conn.execute("UPDATE conversations SET title = ?, meta = ?, version = ? WHERE pk = ?", (fields["title"] or "", json.dumps(meta, ensure_ascii=False), cls._bump(conn), row["pk"]))
+        else:
+            conn.execute("UPDATE conversations SET meta = ?, version = ? WHERE pk = ?", (json.dumps(meta, ensure_ascii=False), cls._bump(conn), row["pk"]))
+        return True
+
+    @classmethod
+    def _op_delete(cls, conn, kind: str, user_id: str, conversation_id: str):
+        pk = cls._pk(conn, kind, user_id, conversation_id)
+        if pk is None:
+            return False
+        conn.execute("DELETE FROM messages WHERE conversation_pk = ?", (pk,))
+        conn.execute("DELETE FROM conversations WHERE pk = ?", (pk,))
+        conn.execute(
+            "INSERT OR REPLACE INTO conversation_tombstones (kind, user_id, id, version) VALUES (?, ?, ?, ?)",
+            (kind, user_id, conversation_id, cls._bump(conn)),
+        )
+        return True
+
+    @staticmethod
+    def _record(row) -> dict:
+        conv = json.loads(row["meta"] or "{}")
+        conv.update({
+            "id": row["id"],
+            "user_id": row["user_id"],
+            "title": row["title"],
+            "start_time": datetime.datetime.fromisoformat(row["start_time"]),
+            "last_active": datetime.datetime.fromisoformat(row["last_active"]),
+        })
+        return conv
+
+    def create(self, kind: str, user_id: str, title: Optional[str] = None) -> str:
+        conversation_id = str(uuid.uuid4())
+        self._submit(self._op_create, kind, user_id, conversation_id, title or "", datetime.datetime.utcnow().isoformat())
+        return conversation_id
+
+    def append(self, kind: str, user_id: str, conversation_id: str, messages: List[dict], title: Optional[str] = None) -> concurrent.futures.Future:
+        fut = self._submit(self._op_append, kind, user_id, conversation_id, [dict(m) for m in messages], title, datetime.datetime.utcnow().isoformat())
+        fut.add_done_callback(lambda f: self._appended((kind, user_id, conversation_id), f))
+        return fut
+
+    def _appended(self, key: tuple, fut: concurrent.futures.Future):
+        # Runs in the writer thread once the batch has committed.
+        if fut.exception() is not None:
+            self.memory.discard(key)
+            return
+        pk, rows = fut.result()
+        if rows:
+            self.memory.extend(key, pk, rows[0][1], [_Message(*r[1:]) for r in rows])
+
+    def update(self, kind: str, user_id: str, conversation_id: str, **fields) -> concurrent.futures.Future:
+        return self._submit(self._op_update, kind, user_id, conversation_id, fields)
+
+    def delete(self, kind: str, user_id: str, conversation_id: str) -> concurrent.futures.Future:
+        self.memory.discard((kind, user_id, conversation_id))
+        return self._submit(self._op_delete, kind, user_id, conversation_id)
+
+    def get(self, kind: str, user_id: str, conversation_id: str) -> Optional[dict]:
+        self._barrier((kind, user_id, conversation_id))
+        row = self._db().execute(
+            "SELECT id, user_id, title, meta, start_time, last_active FROM conversations WHERE kind = ? AND user_id = ? AND id = ?",
+            (kind, user_id, conversation_id),
+        ).fetchone()
+        return self._record(row) if row else None
+
+    def list(self, kind: str, user_id: str) -> List[dict]:
+        self._barrier((kind, user_id))
+        rows = self._db().execute(
+            "SELECT id, user_id, title, meta, start_time, last_active FROM conversations WHERE kind = ? AND user_id = ? ORDER BY last_active DESC",
+            (kind, user_id),
+        ).fetchall()
+        return [self._record(r) for r in rows]
+
+    def version(self, kind: str, user_id: str) -> int:
+        self._barrier((kind, user_id))
+        return self._db().execute("SELECT version FROM store_clock WHERE id = 0").fetchone()[0]
+
+    def page(self, kind: str, user_id: str, limit: int, after: Optional[tuple] = None):
+        # Keyset page over the (kind, user_id, last_active) index, newest first;
+        # `after` is the (last_active, pk) of the previous page's last row.
+        self._barrier((kind, user_id))
+        cols = "SELECT pk, id, user_id, title, meta, start_time, last_active FROM conversations WHERE kind = ? AND user_id = ?"
+        if after is None:
+            rows = self._db().execute(cols + " ORDER BY last_active DESC, pk DESC LIMIT ?", (kind, user_id, limit + 1)).fetchall()
+        else:
+            rows = self._db().execute(cols + " AND (last_active, pk) < (?, ?) ORDER BY last_active DESC, pk DESC LIMIT ?", (kind, user_id, after[0], after[1], limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        last = (rows[-1]["last_active"], rows[-1]["pk"]) if more and rows else None
+        return [self._record(r) for r in rows], last
+
+    def changes(self, kind: str, user_id: str, since: int, limit: int):
+        # Conversations created/updated and ids deleted after version `since`.
+        self._barrier((kind, user_id))
+        rows = self._db().execute(
+            "SELECT id, user_id, title, meta, start_time, last_active, version FROM conversations WHERE kind = ? AND user_id = ? AND version > ? ORDER BY version LIMIT ?",
+            (kind, user_id, since, limit + 1),
+        ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        upto = rows[-1]["version"] if more else None
+        dead = self._db().execute(
+            "SELECT id, version FROM conversation_tombstones WHERE kind = ? AND user_id = ? AND version > ? ORDER BY version",
+            (kind, user_id, since),
+        ).fetchall()
+        deleted = [d for d in dead if upto is None or d["version"] <= upto]
+        # Everything up to the newest version seen has been reported.
+        high = max([since] + [r["version"] for r in rows] + [d["version"] for d in deleted])
+        return [self._record(r) for r in rows], [d["id"] for d in deleted], high, more
+
+    def rows(self, kind: str, user_id: str, conversation_id: str, offset: int = 0, limit: int = -1) -> List[_Message]:
+        self._barrier((kind, user_id, conversation_id))
+        rows = self._db().execute(
+            "SELECT m.seq, m.role, m.content, m.ts, m.extra FROM messages m JOIN conversations c ON c.pk = m.conversation_pk "
+            "WHERE c.kind = ? AND c.user_id = ? AND c.id = ? ORDER BY m.seq LIMIT ? OFFSET ?",
+            (kind, user_id, conversation_id, limit, offset),
+        ).fetchall()
+        return [_Message(*r) for r in rows]
+
+    def history(self, kind: str, user_id: str, conversation_id: str) -> List[_Message]:
+        # Full history for prompt building, served from memory while it is current.
+        self._barrier((kind, user_id, conversation_id))
+        head = self._db().execute(
+            "SELECT c.pk, (SELECT COALESCE(MAX(seq), 0) FROM messages WHERE conversation_pk = c.pk) FROM conversations c "
+            "WHERE c.kind = ? AND c.user_id = ? AND c.id = ?",
+            (kind, user_id, conversation_id),
+        ).fetchone()
+        if head is None:
+            return []
+        key = (kind, user_id, conversation_id)
+        cached = self.memory.get(key, head[0], head[1])
+        if cached is not None:
+            return cached
+        rows = self.rows(kind, user_id, conversation_id)
+        if rows and rows[-1].seq == head[1]:
+            self.memory.put(key, head[0], head[1], rows)
+        return rows
+
+    def messages(self, kind: str, user_id: str, conversation_id: str, offset: int = 0, limit: int = -1) -> List[dict]:
+        if offset == 0 and limit < 0:
+            return [m.as_dict() for m in self.history(kind, user_id, conversation_id)]
+        return [m.as_dict() for m in self.rows(kind, user_id, conversation_id, offset, limit)]
+
+    def latest(self, kind: str, user_id: str, conversation_id: str, limit: int, before: Optional[int] = None):
+        # Newest `limit` messages with seq < before, walking the (conversation_pk, seq)
+        # primary key backwards. Returns them oldest-first plus whether older ones exist.
+        self._barrier((kind, user_id, conversation_id))
+        rows = self._db().execute(
+            "SELECT m.seq, m.role, m.content, m.ts, m.extra FROM messages m JOIN conversations c ON c.pk = m.conversation_pk "
+            "WHERE c.kind = ? AND c.user_id = ? AND c.id = ? AND m.seq < ? ORDER BY m.seq DESC LIMIT ?",
+            (kind, user_id, conversation_id, before if before is not None else 2 ** 62, limit + 1),
+        ).fetchall()
+        more = len(rows) > limit
+        return [_Message(*r) for r in reversed(rows[:limit])], more
+
+    def stats(self) -> dict:
+        self.memory.sweep()
+        return {"path": self.path, "queued": len(self.jobs), "batches": self.batches, "writes": self.writes, "errors": self.errors, "memory": self.memory.stats()}
+
+_STORE = _ConversationStore(CHAT_DB_PATH)
 
 def create_conversation(user_id: str, title: Optional[str] = None) -> str:
-    _ensure_user(user_id)
-    conv_id = str(uuid.uuid4())
-    MOCK_CHAT_DB[user_id]["conversations"][conv_id] = {
-        "id": conv_id,
-        "user_id": user_id,
-        "messages": [],
-        "start_time": datetime.datetime.utcnow(),
-        "last_active": datetime.datetime.utcnow(),
-        "title": title or ""
-    }
-    return conv_id
+    return _STORE.create("chat", user_id, title)
 
 def load_chat_history(user_id: str, conversation_id: str) -> List[dict]:
-    conv = MOCK_CHAT_DB.get(user_id, {}).get("conversations", {}).get(conversation_id)
-    if not conv:
-        return []
-    return list(conv.get("messages", []))
+    return _STORE.messages("chat", user_id, conversation_id)
 
 def save_chat_history(user_id: str, conversation_id: str, new_messages: List[dict], title: Optional[str] = None):
-    _ensure_user(user_id)
-    convs = MOCK_CHAT_DB[user_id]["conversations"]
-    conv = convs.get(conversation_id)
-    if not conv:
-        convs[conversation_id] = {
-            "id": conversation_id,
-            "user_id": user_id,
-            "messages": [],
-            "start_time": datetime.datetime.utcnow(),
-            "last_active": datetime.datetime.utcnow(),
-            "title": title or ""
-        }
-        conv = convs[conversation_id]
-    ts = datetime.datetime.utcnow().isoformat()
-    conv["messages"].extend([{**m, "timestamp": m.get("timestamp") or ts} for m in new_messages])
-    conv["last_active"] = datetime.datetime.utcnow()
-    if title is not None and not conv.get("title"):
-        conv["title"] = title
-
-def _ensure_social_user(user_id: str):
-    if user_id not in MOCK_SOCIAL_DB:
-        MOCK_SOCIAL_DB[user_id] = {"conversations": {}}
+    return _STORE.append("chat", user_id, conversation_id, new_messages, title)
 
 def create_social_conversation(user_id: str, title: Optional[str] = None) -> str:
-    _ensure_social_user(user_id)
-    conv_id = str(uuid.uuid4())
-    MOCK_SOCIAL_DB[user_id]["conversations"][conv_id] = {
-        "id": conv_id,
-        "user_id": user_id,
-        "messages": [],
-        "start_time": datetime.datetime.utcnow(),
-        "last_active": datetime.datetime.utcnow(),
-        "title": title or ""
-    }
-    return conv_id
+    return _STORE.create("social", user_id, title)
 
 def load_social_history(user_id: str, conversation_id: str) -> List[dict]:
-    conv = MOCK_SOCIAL_DB.get(user_id, {}).get("conversations", {}).get(conversation_id)
-    if not conv:
-        return []
-    return list(conv.get("messages", []))
+    return _STORE.messages("social", user_id, conversation_id)
 
 def save_social_history(user_id: str, conversation_id: str, new_messages: List[dict], title: Optional[str] = None):
-    _ensure_social_user(user_id)
-    convs = MOCK_SOCIAL_DB[user_id]["conversations"]
-    conv = convs.get(conversation_id)
-    if not conv:
-        convs[conversation_id] = {
-            "id": conversation_id,
-            "user_id": user_id,
-            "messages": [],
-            "start_time": datetime.datetime.utcnow(),
-            "last_active": datetime.datetime.utcnow(),
-            "title": title or ""
-        }
-        conv = convs[conversation_id]
-    ts = datetime.datetime.utcnow().isoformat()
-    conv["messages"].extend([{**m, "timestamp": m.get("timestamp") or ts} for m in new_messages])
-    conv["last_active"] = datetime.datetime.utcnow()
-    if title is not None and not conv.get("title"):
-        conv["title"] = title
+    return _STORE.append("social", user_id, conversation_id, new_messages, title)
 
 def get_current_user(request: Request) -> str:
     auth = request.headers.get("Authorization")
@@ -427,18 +1544,7 @@ def get_current_user(request: Request) -> str:
                 return "anonymous"
     return "anonymous"
 
-def paginate_items(items: List[dict], page: int, page_size: int) -> dict:
-    total = len(items)
-    start = max((page - 1) * page_size, 0)
-    end = min(start + page_size, total)
-    return {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
-        "items": items[start:end]
-    }
-
-def generate_auto_title(user_text: str, ai_text: str) -> str:
+def generate_auto_title(user_text: str, ai_text: str, use_llm: bool = True) -> str:
     base = user_text.strip() or ai_text.strip() or "Hội thoại mới"
     base_words = base.split()
     simple = " ".join(base_words[:8])
@@ -471,15 +1577,18 @@ def generate_auto_title(user_text: str, ai_text: str) -> str:
         out = " ".join(dedup).strip()
         out = out[:60]
         return out or "Hội thoại"
-    if (llm_pro or llm_flash) is None:
+    if not use_llm or (llm_pro or llm_flash) is None:
         return _normalize(simple)
     try:
-        llm = llm_flash or llm_pro
+        tier = "flash" if llm_flash is not None else "pro"
+        llm = _bound_llm(tier)
+        messages = [
+            {"role": "system", "content": TITLE_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Người dùng: {user_text}\nTrợ lý: {ai_text}"}
+        ]
+        _kv_restore(llm, tier, None, messages)
         result = llm.create_chat_completion(
-            messages=[
-                {"role": "system", "content": "Tạo tiêu đề ngắn gọn (≤6 từ) bằng tiếng Việt, mô tả chủ đề cuộc trò chuyện."},
-                {"role": "user", "content": f"Người dùng: {user_text}\nTrợ lý: {ai_text}"}
-            ],
+            messages=messages,
             temperature=0.2,
             max_tokens=24,
         )
@@ -488,96 +1597,1665 @@ def generate_auto_title(user_text: str, ai_text: str) -> str:
     except Exception:
         return _normalize(simple)
 
-async def load_model():
-    print(f"Checking PRO model: {PRO_MODEL_PATH}")
-    print(f"PRO exists: {os.path.exists(PRO_MODEL_PATH)}")
-    print(f"Checking FLASH model: {FLASH_MODEL_PATH}")
-    print(f"FLASH exists: {os.path.exists(FLASH_MODEL_PATH)}")
-    print(f"Llama available: {Llama is not None}")
-    print("ℹ️ CPU text models will be lazy-loaded on demand when GPU is unavailable or switched to CPU.")
-    print(f"Checking VLM model path: {VLM_MODEL_PATH}")
-    print(f"VLM model file exists: {os.path.exists(VLM_MODEL_PATH)}")
-    print(f"VLM CLIP model file exists: {os.path.exists(VLM_CLIP_MODEL_PATH)}")
-    print("ℹ️ VLM model will be lazy-loaded on demand with GPU-first processing.")
+async def load_model():
+    print(f"Checking PRO model: {PRO_MODEL_PATH}")
+    print(f"PRO exists: {os.path.exists(PRO_MODEL_PATH)}")
+    print(f"Checking FLASH model: {FLASH_MODEL_PATH}")
+    print(f"FLASH exists: {os.path.exists(FLASH_MODEL_PATH)}")
+    print(f"Llama available: {Llama is not None}")
+    print("ℹ️ CPU text models will be lazy-loaded on demand when GPU is unavailable or switched to CPU.")
+    print(f"Checking VLM model path: {VLM_MODEL_PATH}")
+    print(f"VLM model file exists: {os.path.exists(VLM_MODEL_PATH)}")
+    print(f"VLM CLIP model file exists: {os.path.exists(VLM_CLIP_MODEL_PATH)}")
+    print("ℹ️ VLM model will be lazy-loaded on demand with GPU-first processing.")
+    if WARMUP_PROFILE:
+        print(f"🔥 Warm-up profile: {', '.join(WARMUP_PROFILE)} (health reports ready when done)")
+        _WARMUP.update(state="warming", started=datetime.datetime.utcnow().isoformat() + "Z")
+        _spawn_background(_warmup_models())
+
+EVENTS_FLUSH_INTERVAL_S = float(os.environ.get("EVENTS_FLUSH_INTERVAL_S", "1.0"))
+EVENTS_FLUSH_BATCH = int(os.environ.get("EVENTS_FLUSH_BATCH", "256"))
+EVENTS_BUFFER_MAX = int(os.environ.get("EVENTS_BUFFER_MAX", "10000"))
+EVENTS_ROTATE_MB = float(os.environ.get("EVENTS_ROTATE_MB", "16"))
+EVENTS_ROTATE_DAILY = os.environ.get("EVENTS_ROTATE_DAILY", "1").strip().lower() in ("1", "true", "on")
+EVENTS_ROTATE_KEEP = int(os.environ.get("EVENTS_ROTATE_KEEP", "14"))
+EVENTS_COMPRESS = os.environ.get("EVENTS_COMPRESS", "1").strip().lower() in ("1", "true", "on")
+
+class _EventSink:
+    """Buffers runtime events in a ring and appends them to runtime-events.jsonl in
+    batches from one flusher thread, rotating the file by size or UTC day.
+
+    The frontend appends to the same file, so it is opened per batch rather than
+    held open; a rotation simply renames it and the next writer recreates it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ring = collections.deque(maxlen=max(1, EVENTS_BUFFER_MAX))
+        self.wake = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.write_failures = 0
+        self.errors = 0
+
+    def emit(self, event: dict):
+        if len(self.ring) == self.ring.maxlen:
+            self.dropped += 1
+        self.ring.append(event)
+        self.emitted += 1
+        if self.thread is None:
+            self._start()
+        if len(self.ring) >= EVENTS_FLUSH_BATCH:
+            self.wake.set()
+
+    def _start(self):
+        with self.flush_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="runtime-events", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wake.wait(EVENTS_FLUSH_INTERVAL_S)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            while self.ring:
+                batch = []
+                while self.ring and len(batch) < max(1, EVENTS_FLUSH_BATCH):
+                    batch.append(self.ring.popleft())
+                kept, lines = [], []
+                for event in batch:
+                    try:
+                        lines.append(json.dumps(event, default=str))
+                        kept.append(event)
+                    except Exception:
+                        self.errors += 1
+                if not lines:
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._maybe_rotate()
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                    self.written += len(lines)
+                    self.batches += 1
+                except Exception as e:
+                    # Put the batch back in front of newer events for the next tick;
+                    # whatever no longer fits in the ring is lost and counted.
+                    self.write_failures += 1
+                    room = self.ring.maxlen - len(self.ring)
+                    requeue = kept[-room:] if room > 0 else []
+                    self.ring.extendleft(reversed(requeue))
+                    lost = len(kept) - len(requeue)
+                    self.dropped += lost
+                    self.errors += lost
+                    print(f"Runtime event flush failed ({len(requeue)} requeued, {lost} dropped): {e}")
+                    return
+
+    def _maybe_rotate(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if st.st_size == 0:
+            return
+        too_big = EVENTS_ROTATE_MB > 0 and st.st_size >= EVENTS_ROTATE_MB * 1024 * 1024
+        opened = datetime.datetime.utcfromtimestamp(st.st_mtime).date()
+        new_day = EVENTS_ROTATE_DAILY and opened != datetime.datetime.utcnow().date()
+        if not (too_big or new_day):
+            return
+        stem, ext = os.path.splitext(self.path)
+        rotated = f"{stem}-{datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}{ext}"
+        os.replace(self.path, rotated)
+        self.rotations += 1
+        if EVENTS_COMPRESS:
+            try:
+                with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+            except Exception as e:
+                print(f"Runtime event compression failed: {e}")
+        self._prune(stem, ext)
+
+    def _prune(self, stem: str, ext: str):
+        if EVENTS_ROTATE_KEEP <= 0:
+            return
+        folder, base = os.path.split(stem)
+        old = sorted(n for n in os.listdir(folder) if n.startswith(base + "-") and (n.endswith(ext) or n.endswith(ext + ".gz")))
+        for name in old[:-EVENTS_ROTATE_KEEP]:
+            try:
+                os.remove(os.path.join(folder, name))
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "buffered": len(self.ring),
+            "emitted": self.emitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "rotations": self.rotations,
+            "write_failures": self.write_failures,
+            "errors": self.errors,
+        }
+
+_EVENTS = _EventSink(os.path.join(os.path.dirname(__file__), "medical-consultation-app", "data", "runtime-events.jsonl"))
+atexit.register(_EVENTS.flush)
+
+EVENTS_INDEX_EVERY = int(os.environ.get("EVENTS_INDEX_EVERY", "64"))
+_TS_FIELD = re.compile(rb'"ts"\s*:\s*"([^"]+)"')
+
+def _event_epoch(value) -> Optional[float]:
+    # Backend events use naive-UTC ISO, the frontend writes "...Z"; both become epoch seconds.
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        dt = datetime.datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except Exception:
+        try:
+            return float(value)
+        except Exception:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+class _JsonlIndex:
+    """Sparse time index over a JSONL log and its rotated segments.
+
+    The live file is split into blocks of EVENTS_INDEX_EVERY lines, and each
+    block records its byte offset and min/max ts. Only bytes appended since the
+    last query are indexed, and a range query reads just the overlapping
+    blocks. Rotated segments (possibly gzipped) never change, so they are
+    summarised once by their ts range and skipped when it does not overlap."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ident = None
+        self.indexed_to = 0
+        self.blocks = []
+        self.segments = {}
+
+    def _reset(self, ident):
+        self.ident = ident
+        self.indexed_to = 0
+        self.blocks = []
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset(None)
+            return
+        ident = (st.st_dev, st.st_ino)
+        if ident != self.ident or st.st_size < self.indexed_to:
+            self._reset(ident)
+        if st.st_size == self.indexed_to:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.indexed_to)
+            pos = self.indexed_to
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                if not self.blocks or self.blocks[-1]["lines"] >= EVENTS_INDEX_EVERY:
+                    self.blocks.append({"offset": pos, "end": pos, "lines": 0, "min": None, "max": None})
+                block = self.blocks[-1]
+                m = _TS_FIELD.search(line)
+                ts = _event_epoch(m.group(1).decode("utf-8", "replace")) if m else None
+                if ts is not None:
+                    block["min"] = ts if block["min"] is None else min(block["min"], ts)
+                    block["max"] = ts if block["max"] is None else max(block["max"], ts)
+                pos += len(line)
+                block["end"] = pos
+                block["lines"] += 1
+        self.indexed_to = pos
+
+    def _segment_paths(self) -> List[str]:
+        folder, name = os.path.split(self.path)
+        stem, ext = os.path.splitext(name)
+        try:
+            names = sorted(n for n in os.listdir(folder) if n.startswith(stem + "-") and (n.endswith(ext) or n.endswith(ext + ".gz")))
+        except Exception:
+            return []
+        return [os.path.join(folder, n) for n in names]
+
+    @staticmethod
+    def _open(path: str):
+        return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+    def _segment_range(self, path: str):
+        rng = self.segments.get(path)
+        if rng is None:
+            lo = hi = None
+            with self._open(path) as f:
+                for line in f:
+                    m = _TS_FIELD.search(line)
+                    ts = _event_epoch(m.group(1).decode("utf-8", "replace")) if m else None
+                    if ts is not None:
+                        lo = ts if lo is None else min(lo, ts)
+                        hi = ts if hi is None else max(hi, ts)
+            rng = self.segments[path] = (lo, hi)
+        return rng
+
+    @staticmethod
+    def _overlaps(lo, hi, since, until) -> bool:
+        if lo is None:
+            # No timestamps at all: only relevant to unbounded queries.
+            return since is None and until is None
+        return (since is None or hi >= since) and (until is None or lo <= until)
+
+    def query(self, since: Optional[float], until: Optional[float], keep):
+        """Parsed records within [since, until] for which keep(record, ts) is true, oldest
+        segment first. Returns (records, blocks_read, blocks_total)."""
+        with self.lock:
+            self._refresh()
+            blocks = list(self.blocks)
+            segments = self._segment_paths()
+            for gone in set(self.segments) - set(segments):
+                self.segments.pop(gone, None)
+            ranges = {}
+            for p in segments:
+                try:
+                    ranges[p] = self._segment_range(p)
+                except Exception:
+                    pass
+        out = []
+        read = 0
+
+        def take(line: bytes):
+            try:
+                rec = json.loads(line)
+            except Exception:
+                return
+            if not isinstance(rec, dict):
+                return
+            ts = _event_epoch(rec.get("ts"))
+            if since is not None and (ts is None or ts < since):
+                return
+            if until is not None and (ts is None or ts > until):
+                return
+            if keep(rec, ts):
+                out.append(rec)
+
+        for p, (lo, hi) in ranges.items():
+            if not self._overlaps(lo, hi, since, until):
+                continue
+            read += 1
+            try:
+                with self._open(p) as f:
+                    for line in f:
+                        take(line)
+            except Exception:
+                pass
+        wanted = [b for b in blocks if self._overlaps(b["min"], b["max"], since, until)]
+        if wanted:
+            try:
+                with open(self.path, "rb") as f:
+                    for b in wanted:
+                        f.seek(b["offset"])
+                        for line in f.read(b["end"] - b["offset"]).splitlines():
+                            take(line)
+                        read += 1
+            except Exception:
+                pass
+        return out, read, len(blocks) + len(ranges)
+
+_EVENT_INDEXES = {
+    "events": _JsonlIndex(_EVENTS.path),
+    "metrics": _JsonlIndex(os.path.join(os.path.dirname(_EVENTS.path), "runtime-metrics.jsonl")),
+}
+
+def _duration_stats(records: List[dict]) -> dict:
+    groups = {}
+    for r in records:
+        d = r.get("duration_ms")
+        if isinstance(d, (int, float)) and not isinstance(d, bool):
+            groups.setdefault(str(r.get("mode") or "cpu"), []).append(float(d))
+    out = {}
+    for mode, vals in groups.items():
+        vals.sort()
+        out[mode] = {
+            "count": len(vals),
+            "p50_ms": round(vals[min(len(vals) - 1, int(0.50 * len(vals)))], 1),
+            "p95_ms": round(vals[min(len(vals) - 1, int(0.95 * len(vals)))], 1),
+        }
+    return out
+
+def _append_runtime_event(event: dict):
+    try:
+        _EVENTS.emit(event)
+    except Exception:
+        pass
+
+SPECULATIVE_DECODING = os.environ.get("SPECULATIVE_DECODING", "0").strip().lower() in ("1", "true", "on")
+SPECULATIVE_K = int(os.environ.get("SPECULATIVE_K", "4"))
+
+class _FlashDraftModel(LlamaDraftModel):
+    # Draft proposer for the pro tier. Llama.generate calls this on the pro worker
+    # thread with the full token history; we greedily extend it with a private
+    # flash instance (sharing llm_flash would race the flash worker) and pro
+    # verifies the k proposals in a single batched eval.
+    def __init__(self, llm, k: int):
+        self.llm = llm
+        self.k = max(1, k)
+        self.calls = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.draft_ms = 0.0
+        self._last = None
+
+    def _account(self, ids):
+        # Pro keeps the matching prefix of our last proposal and then appends its
+        # own sampled token, so the accepted count is visible on the next call.
+        if self._last is None:
+            return
+        base, anchor, proposal = self._last
+        self._last = None
+        if len(ids) <= base or ids[base - 1] != anchor:
+            return
+        got = ids[base:base + len(proposal)]
+        n = _common_prefix_len(got, proposal)
+        self.accepted += min(n, len(ids) - base - 1)
+
+    def __call__(self, input_ids, **kwargs):
+        started = time.perf_counter()
+        ids = np.asarray(input_ids, dtype=np.intc)
+        self._account(ids)
+        llm = self.llm
+        room = llm.n_ctx() - len(ids) - 1
+        if room <= 0 or len(ids) == 0:
+            return np.array([], dtype=np.intc)
+        n = _common_prefix_len(llm.input_ids[:llm.n_tokens], ids)
+        if n == len(ids):
+            n -= 1
+        llm.n_tokens = n
+        llm.eval(ids[n:].tolist())
+        out = []
+        eos = llm.token_eos()
+        for i in range(min(self.k, room)):
+            tok = llm.sample(temp=0.0, repeat_penalty=1.0)
+            out.append(tok)
+            if tok == eos or i == min(self.k, room) - 1:
+                break
+            llm.eval([tok])
+        proposal = np.array(out, dtype=np.intc)
+        self.calls += 1
+        self.proposed += len(out)
+        self.draft_ms += (time.perf_counter() - started) * 1000.0
+        self._last = (len(ids), ids[-1], proposal)
+        return proposal
+
+    def stats(self) -> dict:
+        return {
+            "k": self.k,
+            "calls": self.calls,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": round(self.accepted / self.proposed, 4) if self.proposed else 0.0,
+            "avg_accepted_per_call": round(self.accepted / self.calls, 3) if self.calls else 0.0,
+            "avg_draft_ms": round(self.draft_ms / self.calls, 2) if self.calls else 0.0,
+        }
+
+_SPECULATIVE = {"drafts": [], "error": None}
+
+def _load_pro_draft():
+    # One private flash instance per pro replica, on the same threads.
+    if not SPECULATIVE_DECODING or LlamaDraftModel is object or np is None or not os.path.exists(FLASH_MODEL_PATH):
+        return None
+    layout = _replica_layout("pro", _bound_replica("pro"))
+    try:
+        flash = Llama(model_path=FLASH_MODEL_PATH, n_ctx=TEXT_MODEL_N_CTX, n_threads=layout["n_threads"], n_threads_batch=layout["n_threads_batch"], n_batch=MODEL_N_BATCH, use_mmap=MODEL_USE_MMAP, use_mlock=MODEL_USE_MLOCK, verbose=False)
+        return _FlashDraftModel(flash, SPECULATIVE_K)
+    except Exception as e:
+        _SPECULATIVE["error"] = str(e)
+        return None
+
+def _parse_cpulist(text: str) -> List[int]:
+    cpus = []
+    for part in (text or "").strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-", 1)
+            cpus.extend(range(int(a), int(b) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def _read_sys(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except Exception:
+        return None
+
+def _detect_cpu_topology() -> dict:
+    try:
+        allowed = sorted(os.sched_getaffinity(0))
+    except Exception:
+        allowed = list(range(os.cpu_count() or 1))
+    core_of = {}
+    for cpu in allowed:
+        base = f"/sys/devices/system/cpu/cpu{cpu}/topology/"
+        pkg = _read_sys(base + "physical_package_id")
+        core = _read_sys(base + "core_id")
+        core_of[cpu] = (int(pkg), int(core)) if pkg is not None and core is not None else (0, cpu)
+    nodes = []
+    node_root = "/sys/devices/system/node"
+    try:
+        names = sorted((n for n in os.listdir(node_root) if n.startswith("node") and n[4:].isdigit()), key=lambda n: int(n[4:]))
+    except Exception:
+        names = []
+    for name in names:
+        cpus = [c for c in _parse_cpulist(_read_sys(os.path.join(node_root, name, "cpulist")) or "") if c in core_of]
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes = [allowed]
+    return {"logical": len(allowed), "physical": len(set(core_of.values())), "nodes": nodes, "core_of": core_of}
+
+_CPU_TOPOLOGY = _detect_cpu_topology()
+
+MODEL_REPLICAS = os.environ.get("MODEL_REPLICAS", "auto").strip().lower()
+MODEL_THREADS = int(os.environ.get("MODEL_THREADS", "0"))
+MODEL_THREADS_BATCH = int(os.environ.get("MODEL_THREADS_BATCH", "0"))
+MODEL_N_BATCH = int(os.environ.get("MODEL_N_BATCH", "512"))
+MODEL_PIN_NUMA = os.environ.get("MODEL_PIN_NUMA", "1").strip().lower() not in ("0", "false", "off")
+MODEL_USE_MMAP = os.environ.get("MODEL_USE_MMAP", "1").strip().lower() not in ("0", "false", "off")
+MODEL_USE_MLOCK = os.environ.get("MODEL_USE_MLOCK", "0").strip().lower() in ("1", "true", "on")
+
+def _replica_count(tier: str) -> int:
+    raw = os.environ.get(f"{tier.upper()}_REPLICAS", MODEL_REPLICAS).strip().lower()
+    if raw.isdigit() and int(raw) > 0:
+        return int(raw)
+    if MODEL_THREADS > 0:
+        return max(1, _CPU_TOPOLOGY["physical"] // MODEL_THREADS)
+    # One replica per NUMA node keeps every instance's KV cache and scratch
+    # buffers on local memory; the mmap'd weights are shared page cache.
+    return len(_CPU_TOPOLOGY["nodes"])
+
+def _replica_layout(tier: str, idx: int) -> dict:
+    # Replicas are spread round-robin over NUMA nodes and the node's physical
+    # cores are split between the replicas placed on it. Generation is memory
+    # bound (one thread per physical core); prompt batches also use SMT siblings.
+    count = _REPLICA_COUNTS.get(tier, 1)
+    nodes = _CPU_TOPOLOGY["nodes"]
+    node = idx % len(nodes)
+    peers = len(range(node, count, len(nodes)))
+    slot = idx // len(nodes)
+    core_of = _CPU_TOPOLOGY["core_of"]
+    cores = []
+    for cpu in nodes[node]:
+        if core_of[cpu] not in cores:
+            cores.append(core_of[cpu])
+    per = max(1, len(cores) // max(peers, 1))
+    mine = set(cores[slot * per:(slot + 1) * per] or cores[-per:])
+    cpus = [c for c in nodes[node] if core_of[c] in mine]
+    return {
+        "node": node,
+        "cpus": cpus,
+        "n_threads": MODEL_THREADS or len(mine),
+        "n_threads_batch": MODEL_THREADS_BATCH or len(cpus),
+    }
+
+_REPLICA_COUNTS = {"pro": _replica_count("pro"), "flash": _replica_count("flash")}
+_REPLICAS = {tier: [None] * n for tier, n in _REPLICA_COUNTS.items()}
+_REPLICA_LOCAL = threading.local()
+
+def _bound_replica(tier: str) -> int:
+    bound = getattr(_REPLICA_LOCAL, "binding", None)
+    return bound[1] if bound is not None and bound[0] == tier else 0
+
+MODEL_RAM_BUDGET_MB = int(os.environ.get("MODEL_RAM_BUDGET_MB", "0"))
+MODEL_HOT = {t.strip().lower() for t in os.environ.get("MODEL_HOT", "").split(",") if t.strip()}
+
+def _instance_bytes(llm) -> int:
+    # Per-instance memory on top of the mmap'd weights: the f16 KV cache plus the
+    # logits buffer (n_ctx rows when logits_all, n_batch rows otherwise).
+    total = 0
+    try:
+        md = llm.metadata
+        arch = md.get("general.architecture", "llama")
+        n_layer = int(md[f"{arch}.block_count"])
+        n_embd = int(md[f"{arch}.embedding_length"])
+        n_head = int(md[f"{arch}.attention.head_count"])
+        n_head_kv = int(md.get(f"{arch}.attention.head_count_kv", n_head))
+        total += 2 * n_layer * llm.n_ctx() * (n_embd // n_head) * n_head_kv * 2
+    except Exception:
+        pass
+    try:
+        total += int(llm.scores.nbytes)
+    except Exception:
+        pass
+    return total
+
+def _file_bytes(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except Exception:
+        return 0
+
+class _ModelResidency:
+    # Tracks every resident model instance (text replicas and the VLM) against
+    # MODEL_RAM_BUDGET_MB. Weights are counted once per GGUF because replicas
+    # share the mmap; evicting only drops our references, so a job still holding
+    # the instance finishes normally and the memory is freed when it returns.
+    # make_room reserves a pending entry under the lock, so concurrent loads
+    # (replicas, warm-up) see each other's memory before the weights are read.
+    def __init__(self, budget_bytes: int, hot: set):
+        self.budget_bytes = budget_bytes
+        self.hot = hot
+        self.entries = {}
+        self.lock = threading.RLock()
+        self.evictions = 0
+        self.instance_guess = {}
+
+    def resident_bytes(self) -> int:
+        with self.lock:
+            paths = {p for e in self.entries.values() for p in e["weights"]}
+            return sum(e["bytes"] for e in self.entries.values()) + sum(_file_bytes(p) for p in paths)
+
+    def touch(self, key: tuple):
+        e = self.entries.get(key)
+        if e is not None:
+            e["last_used"] = time.time()
+
+    def _busy(self, key: tuple) -> bool:
+        w = _INFERENCE_WORKERS.get("vlm" if key[0] == "vlm" else f"{key[0]}#{key[1]}")
+        return w is not None and w.depth() > 0
+
+    def make_room(self, key: tuple, weights: List[str]):
+        if self.budget_bytes <= 0:
+            return
+        with self.lock:
+            have = {p for e in self.entries.values() for p in e["weights"]}
+            need = sum(_file_bytes(p) for p in weights if p not in have) + self.instance_guess.get(key[0], 256 * 1024 * 1024)
+            while self.resident_bytes() + need > self.budget_bytes:
+                # Idle models go first; a busy one is only dropped when nothing else
+                # is left, and its memory returns once its current job ends. Loads
+                # still in progress cannot be evicted.
+                candidates = [k for k, e in self.entries.items() if k != key and k[0] not in self.hot and not e.get("pending")]
+                if not candidates:
+                    _append_runtime_event({"type": "cpu_model_budget_exceeded", "tier": key[0], "replica": key[1], "need_bytes": need, "resident_bytes": self.resident_bytes(), "ts": datetime.datetime.utcnow().isoformat()})
+                    raise HTTPException(status_code=503, detail="Không đủ bộ nhớ để nạp mô hình, vui lòng thử lại sau.", headers={"Retry-After": "30"})
+                victim = min(candidates, key=lambda k: (self._busy(k), self.entries[k]["last_used"]))
+                _unload_model(victim, "lru")
+                have = {p for e in self.entries.values() for p in e["weights"]}
+                need = sum(_file_bytes(p) for p in weights if p not in have) + self.instance_guess.get(key[0], 256 * 1024 * 1024)
+            now = time.time()
+            self.entries[key] = {"weights": list(weights), "bytes": self.instance_guess.get(key[0], 256 * 1024 * 1024), "loaded_at": now, "last_used": now, "load_ms": None, "pending": True}
+
+    def release(self, key: tuple):
+        # A load failed: drop its reservation (never a model that is resident).
+        with self.lock:
+            if self.entries.get(key, {}).get("pending"):
+                self.entries.pop(key, None)
+
+    def register(self, key: tuple, weights: List[str], nbytes: int, load_ms: float):
+        with self.lock:
+            now = time.time()
+            self.entries[key] = {"weights": list(weights), "bytes": nbytes, "loaded_at": now, "last_used": now, "load_ms": round(load_ms, 1)}
+            self.instance_guess[key[0]] = nbytes
+
+    def forget(self, key: tuple) -> Optional[dict]:
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    def describe(self, tier: str) -> dict:
+        with self.lock:
+            mine = [e for k, e in self.entries.items() if k[0] == tier and not e.get("pending")]
+            if not mine:
+                return {"resident": False, "hot": tier in self.hot}
+            weights = {p for e in mine for p in e["weights"]}
+            return {
+                "resident": True,
+                "hot": tier in self.hot,
+                "replicas_resident": len(mine),
+                "resident_bytes": sum(e["bytes"] for e in mine) + sum(_file_bytes(p) for p in weights),
+                "last_used": datetime.datetime.utcfromtimestamp(max(e["last_used"] for e in mine)).isoformat() + "Z",
+                "load_ms": max(e["load_ms"] for e in mine),
+            }
+
+_RESIDENCY = _ModelResidency(MODEL_RAM_BUDGET_MB * 1024 * 1024, MODEL_HOT)
+
+def _unload_model(key: tuple, reason: str):
+    global llm_pro, llm_flash, vlm_llm
+    tier, idx = key
+    if tier == "vlm":
+        vlm_llm = None
+    else:
+        inst = _REPLICAS[tier][idx]
+        _REPLICAS[tier][idx] = None
+        draft = getattr(inst, "draft_model", None)
+        if draft is not None:
+            _SPECULATIVE["drafts"] = [d for d in _SPECULATIVE["drafts"] if d is not draft]
+        others = [r for r in _REPLICAS[tier] if r is not None]
+        if tier == "pro" and llm_pro is inst:
+            llm_pro = others[0] if others else None
+        elif tier == "flash" and llm_flash is inst:
+            llm_flash = others[0] if others else None
+    entry = _RESIDENCY.forget(key)
+    _RESIDENCY.evictions += 1
+    _append_runtime_event({
+        "type": "cpu_model_unloaded",
+        "tier": tier,
+        "replica": idx,
+        "reason": reason,
+        "resident_s": round(time.time() - entry["loaded_at"], 1) if entry else None,
+        "bytes": entry["bytes"] if entry else None,
+        "ts": datetime.datetime.utcnow().isoformat(),
+    })
+
+def _text_weights(tier: str) -> List[str]:
+    if tier == "pro":
+        return [PRO_MODEL_PATH] + ([FLASH_MODEL_PATH] if SPECULATIVE_DECODING else [])
+    return [FLASH_MODEL_PATH]
+
+def _load_text_replica(tier: str, idx: int):
+    layout = _replica_layout(tier, idx)
+    kwargs = {
+        "model_path": PRO_MODEL_PATH if tier == "pro" else FLASH_MODEL_PATH,
+        "n_ctx": TEXT_MODEL_N_CTX,
+        "n_threads": layout["n_threads"],
+        "n_threads_batch": layout["n_threads_batch"],
+        "n_batch": MODEL_N_BATCH,
+        "use_mmap": MODEL_USE_MMAP,
+        "use_mlock": MODEL_USE_MLOCK,
+        "verbose": False,
+    }
+    if tier != "pro":
+        return Llama(**kwargs)
+    draft = _load_pro_draft()
+    # A draft model makes llama-cpp-python keep logits for every position
+    # (n_ctx x n_vocab floats) so pro can verify k tokens in one eval.
+    llm = Llama(draft_model=draft, **kwargs)
+    if draft is not None:
+        if draft.llm.n_vocab() != llm.n_vocab():
+            llm.draft_model = None
+            _SPECULATIVE["error"] = "vocab mismatch between flash and pro"
+        else:
+            _SPECULATIVE["drafts"].append(draft)
+    return llm
+
+def ensure_text_model(tier: str) -> bool:
+    # Loads the replica bound to the calling inference thread (replica 0 when
+    # called from anywhere else). llm_pro / llm_flash keep pointing at the first
+    # loaded replica for the "is this tier available" checks.
+    global llm_pro, llm_flash
+    idx = _bound_replica(tier)
+    path = PRO_MODEL_PATH if tier == "pro" else FLASH_MODEL_PATH
+    if _REPLICAS[tier][idx] is not None:
+        _RESIDENCY.touch((tier, idx))
+        return False
+    if Llama is None or not os.path.exists(path):
+        return False
+    _RESIDENCY.make_room((tier, idx), _text_weights(tier))
+    just_loaded = False
+    try:
+        now = datetime.datetime.utcnow().isoformat()
+        _append_runtime_event({"type": "cpu_model_loading", "tier": tier, "replica": idx, "ts": now})
+        started = time.perf_counter()
+        llm = _load_text_replica(tier, idx)
+        load_ms = (time.perf_counter() - started) * 1000.0
+        draft = getattr(llm, "draft_model", None)
+        nbytes = _instance_bytes(llm) + (_instance_bytes(draft.llm) if draft is not None else 0)
+        _REPLICAS[tier][idx] = llm
+        _RESIDENCY.register((tier, idx), [path] + ([FLASH_MODEL_PATH] if draft is not None else []), nbytes, load_ms)
+        if tier == "pro" and llm_pro is None:
+            llm_pro = llm
+        elif tier == "flash" and llm_flash is None:
+            llm_flash = llm
+        just_loaded = True
+        _append_runtime_event({"type": "cpu_model_loaded", "tier": tier, "replica": idx, "load_ms": round(load_ms, 1), "resident_bytes": _RESIDENCY.resident_bytes(), "ts": datetime.datetime.utcnow().isoformat()})
+    except Exception as e:
+        _RESIDENCY.release((tier, idx))
+        _append_runtime_event({"type": "cpu_model_load_failed", "tier": tier, "replica": idx, "error": str(e), "ts": datetime.datetime.utcnow().isoformat()})
+    if just_loaded and tier not in _PREFIX_STATES:
+        try:
+            _prime_prefix_states(tier, _tier_llm(tier))
+        except Exception:
+            pass
+    return just_loaded
+
+def _bound_llm(tier: str):
+    ensure_text_model(tier)
+    return _tier_llm(tier)
+
+def ensure_vlm_model() -> bool:
+    global vlm_llm
+    if vlm_llm is not None:
+        _RESIDENCY.touch(("vlm", 0))
+        return False
+    if not (os.path.exists(VLM_MODEL_PATH) and os.path.exists(VLM_CLIP_MODEL_PATH)):
+        return False
+    if Llama is None or Llava15ChatHandler is None:
+        return False
+    _RESIDENCY.make_room(("vlm", 0), [VLM_MODEL_PATH, VLM_CLIP_MODEL_PATH])
+    try:
+        now = datetime.datetime.utcnow().isoformat()
+        _append_runtime_event({"type": "cpu_model_loading", "tier": "vlm", "ts": now})
+        started = time.perf_counter()
+        chat_handler = Llava15ChatHandler(clip_model_path=VLM_CLIP_MODEL_PATH)
+        vlm_llm = Llama(model_path=VLM_MODEL_PATH, chat_handler=chat_handler, n_ctx=2048, n_threads=4, use_mmap=MODEL_USE_MMAP, use_mlock=MODEL_USE_MLOCK, verbose=False)
+        load_ms = (time.perf_counter() - started) * 1000.0
+        _RESIDENCY.register(("vlm", 0), [VLM_MODEL_PATH, VLM_CLIP_MODEL_PATH], _instance_bytes(vlm_llm), load_ms)
+        _append_runtime_event({"type": "cpu_model_loaded", "tier": "vlm", "load_ms": round(load_ms, 1), "resident_bytes": _RESIDENCY.resident_bytes(), "ts": datetime.datetime.utcnow().isoformat()})
+        return True
+    except Exception as e:
+        vlm_llm = None
+        _RESIDENCY.release(("vlm", 0))
+        _append_runtime_event({"type": "cpu_model_load_failed", "tier": "vlm", "error": str(e), "ts": datetime.datetime.utcnow().isoformat()})
+        return False
+
+INFERENCE_QUEUE_MAX = int(os.environ.get("INFERENCE_QUEUE_MAX", "8"))
+# Scheduling classes, highest first. A queued job is promoted one class for every
+# SCHED_AGING_S it waits, so background work cannot starve forever.
+SCHED_CLASSES = ("interactive", "lookup", "background")
+SCHED_AGING_S = float(os.environ.get("SCHED_AGING_S", "20"))
+SCHED_BACKGROUND_DEFER_DEPTH = int(os.environ.get("SCHED_BACKGROUND_DEFER_DEPTH", "1"))
+SCHED_BACKGROUND_MAX_DEFER_S = float(os.environ.get("SCHED_BACKGROUND_MAX_DEFER_S", "120"))
+# Fair-queueing weight (estimated tokens) of jobs submitted without a cost.
+SCHED_DEFAULT_COST = float(os.environ.get("SCHED_DEFAULT_COST", "256"))
+
+def _interactive_depth() -> int:
+    return sum(w.class_depth("interactive") for w in list(_INFERENCE_WORKERS.values()))
+
+class _InferenceWorker:
+    # One thread per loaded model: llama.cpp contexts are not thread-safe, so every
+    # call touching a given model is serialised here instead of on the event loop.
+    # Jobs wait in per-class queues. Inside a class users share the model by
+    # start-time fair queueing: each job is tagged with its user's virtual start
+    # (the later of the class clock and the end of that user's previous job) and
+    # costs its estimated tokens, prompt plus max_tokens. The smallest start tag
+    # runs next, so a user sending long generations gets the same token share as
+    # one sending short ones instead of the same number of turns.
+    def __init__(self, key: str):
+        self.key = key
+        self.queues = {c: collections.OrderedDict() for c in SCHED_CLASSES}
+        self.vtime = {c: 0.0 for c in SCHED_CLASSES}
+        self.vfinish = {}
+        self.queued = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.running_class = None
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.promotions = 0
+        self.deferrals = 0
+        self.wait_ms_total = 0.0
+        self.run_ms_total = 0.0
+        self.last_wait_ms = 0.0
+        self.last_run_ms = 0.0
+        self.class_stats = {c: {"completed": 0, "wait_ms_total": 0.0, "max_wait_ms": 0.0} for c in SCHED_CLASSES}
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._loop, name=f"inference-{key}", daemon=True)
+        self.thread.start()
+
+    def depth(self) -> int:
+        return self.queued + (1 if self.running else 0)
+
+    def class_depth(self, priority: str) -> int:
+        return sum(len(q) for q in list(self.queues[priority].values())) + (1 if self.running and self.running_class == priority else 0)
+
+    def waiting(self, *classes) -> bool:
+        return any(self.queues[c] for c in classes)
+
+    def retry_after(self) -> int:
+        avg_s = (self.run_ms_total / self.completed / 1000.0) if self.completed else 5.0
+        return max(1, min(120, int(avg_s * max(self.depth(), 1))))
+
+    def submit(self, fn, args, priority: str = "interactive", user: Optional[str] = None, cost: Optional[float] = None) -> concurrent.futures.Future:
+        if priority not in self.queues:
+            priority = "interactive"
+        user = user or ""
+        with self.cond:
+            if self.queued >= INFERENCE_QUEUE_MAX:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"Mô hình {self.key} đang bận, vui lòng thử lại sau.",
+                    headers={"Retry-After": str(self.retry_after())},
+                )
+            fut = concurrent.futures.Future()
+            start = max(self.vtime[priority], self.vfinish.get((priority, user), 0.0))
+            self.vfinish[(priority, user)] = start + max(1.0, float(cost or SCHED_DEFAULT_COST))
+            self.queues[priority].setdefault(user, collections.deque()).append((fn, args, fut, time.perf_counter(), start))
+            self.queued += 1
+            if len(self.vfinish) > 4096:
+                # Users whose last job ended before the class clock carry no credit.
+                self.vfinish = {k: v for k, v in self.vfinish.items() if v > self.vtime[k[0]]}
+            self.cond.notify()
+        return fut
+
+    def _next(self):
+        # Called with the lock held. Returns (priority, job) or None when only
+        # deferred background work is queued.
+        now = time.perf_counter()
+        best = None
+        for rank, priority in enumerate(SCHED_CLASSES):
+            users = self.queues[priority]
+            if not users:
+                continue
+            oldest = min(q[0][3] for q in users.values())
+            waited = now - oldest
+            if priority == "background" and waited < SCHED_BACKGROUND_MAX_DEFER_S and _interactive_depth() >= SCHED_BACKGROUND_DEFER_DEPTH:
+                self.deferrals += 1
+                continue
+            effective = rank - (int(waited // SCHED_AGING_S) if SCHED_AGING_S > 0 else 0)
+            if best is None or effective < best[0]:
+                best = (effective, rank, priority)
+        if best is None:
+            return None
+        _, rank, priority = best
+        if rank != min(r for r, c in enumerate(SCHED_CLASSES) if self.queues[c]):
+            self.promotions += 1
+        users = self.queues[priority]
+        user = min(users, key=lambda u: users[u][0][4])
+        q = users[user]
+        job = q.popleft()
+        self.vtime[priority] = max(self.vtime[priority], job[4])
+        if not q:
+            del users[user]
+        self.queued -= 1
+        return priority, job
+
+    def _loop(self):
+        _bind_worker_thread(self)
+        while True:
+            with self.cond:
+                picked = self._next() if self.queued else None
+                while picked is None:
+                    # Deferred background jobs are re-checked periodically.
+                    self.cond.wait(timeout=0.5 if self.queued else None)
+                    picked = self._next() if self.queued else None
+                priority, (fn, args, fut, enqueued, _) = picked
+                self.running = True
+                self.running_class = priority
+            try:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                started = time.perf_counter()
+                try:
+                    fut.set_result(fn(*args))
+                    self.completed += 1
+                except BaseException as e:
+                    fut.set_exception(e)
+                    self.failed += 1
+                finished = time.perf_counter()
+                self.last_wait_ms = (started - enqueued) * 1000.0
+                self.last_run_ms = (finished - started) * 1000.0
+                self.wait_ms_total += self.last_wait_ms
+                self.run_ms_total += self.last_run_ms
+                cs = self.class_stats[priority]
+                cs["completed"] += 1
+                cs["wait_ms_total"] += self.last_wait_ms
+                cs["max_wait_ms"] = max(cs["max_wait_ms"], self.last_wait_ms)
+            finally:
+                self.running = False
+                self.running_class = None
+
+    def stats(self) -> dict:
+        done = self.completed + self.failed
+        now = time.perf_counter()
+        classes = {}
+        for c in SCHED_CLASSES:
+            users = list(self.queues[c].values())
+            cs = self.class_stats[c]
+            classes[c] = {
+                "queued": sum(len(q) for q in users),
+                "users": len(users),
+                "oldest_wait_ms": round((now - min(q[0][3] for q in users)) * 1000.0, 1) if users else 0.0,
+                "completed": cs["completed"],
+                "avg_wait_ms": round(cs["wait_ms_total"] / cs["completed"], 1) if cs["completed"] else 0.0,
+                "max_wait_ms": round(cs["max_wait_ms"], 1),
+            }
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "running_class": self.running_class,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "promotions": self.promotions,
+            "deferrals": self.deferrals,
+            "avg_wait_ms": round(self.wait_ms_total / done, 1) if done else 0.0,
+            "avg_run_ms": round(self.run_ms_total / done, 1) if done else 0.0,
+            "last_wait_ms": round(self.last_wait_ms, 1),
+            "last_run_ms": round(self.last_run_ms, 1),
+            "utilisation": round(self.run_ms_total / max((time.time() - self.started) * 1000.0, 1.0), 4),
+            "classes": classes,
+        }
+
+_INFERENCE_WORKERS = {}
+_INFERENCE_LOCK = threading.Lock()
+
+def _bind_worker_thread(worker: "_InferenceWorker"):
+    _REPLICA_LOCAL.worker = worker
+    tier, _, idx = worker.key.partition("#")
+    if not idx or tier not in _REPLICAS:
+        return
+    _REPLICA_LOCAL.binding = (tier, int(idx))
+    # llama.cpp's compute threads inherit this thread's affinity.
+    cpus = _replica_layout(tier, int(idx))["cpus"]
+    if MODEL_PIN_NUMA and cpus and len(_CPU_TOPOLOGY["nodes"]) > 1 and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except Exception:
+            pass
+
+def _inference_worker(key: str) -> _InferenceWorker:
+    with _INFERENCE_LOCK:
+        w = _INFERENCE_WORKERS.get(key)
+        if w is None:
+            w = _INFERENCE_WORKERS[key] = _InferenceWorker(key)
+        return w
+
+def _dispatch_key(key: str) -> str:
+    # Text tiers fan out to "<tier>#<i>" replicas: least queued first, then
+    # already-loaded replicas, so extra replicas only load under contention.
+    if key not in _REPLICAS:
+        return key
+    best = None
+    for i in range(len(_REPLICAS[key])):
+        w = _INFERENCE_WORKERS.get(f"{key}#{i}")
+        score = (w.depth() if w is not None else 0, 0 if _REPLICAS[key][i] is not None else 1, i)
+        if best is None or score < best:
+            best = score
+    return f"{key}#{best[2]}"
+
+def _tier_idle(tier: str) -> bool:
+    return any((_INFERENCE_WORKERS.get(f"{tier}#{i}") is None or _INFERENCE_WORKERS[f"{tier}#{i}"].depth() == 0) for i in range(len(_REPLICAS.get(tier, []))))
+
+async def _run_inference(key: str, fn, *args, priority: str = "interactive", user: Optional[str] = None, cost: Optional[float] = None):
+    return await asyncio.wrap_future(_inference_worker(_dispatch_key(key)).submit(fn, args, priority, user, cost))
+
+def _chat_cost(messages: List[dict], max_tokens: Optional[int]) -> int:
+    # Fair-queueing weight of a generation: prompt estimate plus the decode budget.
+    return sum(_estimate_tokens(str(m.get("content") or "")) for m in messages) + int(max_tokens or 512)
+
+_STREAM_END = object()
+
+def _stream_inference(key: str, fn, *args, priority: str = "interactive", user: Optional[str] = None, cost: Optional[float] = None):
+    # Submits eagerly so a full queue surfaces as 503 before the response starts;
+    # the iterator returned by fn is drained on the worker thread.
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    def _put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            stop.set()
+    def _drain():
+        try:
+            for item in fn(*args):
+                if stop.is_set():
+                    break
+                _put(item)
+        except Exception as e:
+            _put(e)
+        finally:
+            _put(_STREAM_END)
+    fut = _inference_worker(_dispatch_key(key)).submit(_drain, (), priority, user, cost)
+    async def _gen():
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            fut.cancel()
+    return _gen()
+
+_IN_FLIGHT = {}
+_SHARED_STREAMS = {}
+_COALESCE_STATS = {"leaders": 0, "joined": 0, "stream_leaders": 0, "stream_joined": 0}
+
+def _flight_key(kind: str, tier: str, messages: List[dict], temperature, max_tokens, deterministic: bool = False):
+    # Only greedy (or explicitly deterministic) generations may be shared.
+    if not deterministic and (temperature or 0) > 0:
+        return None
+    norm = [(str(m.get("role", "")).lower(), " ".join(str(m.get("content", "")).split())) for m in messages]
+    return (kind, tier, json.dumps(norm, ensure_ascii=False), float(temperature or 0), max_tokens)
+
+async def _single_flight(key, make):
+    # Identical requests await one shared task; it is not tied to any single
+    # caller, so the first client disconnecting does not cancel the others.
+    if key is None:
+        return await make()
+    task = _IN_FLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(make())
+        _IN_FLIGHT[key] = task
+        task.add_done_callback(lambda t: _IN_FLIGHT.pop(key, None) if _IN_FLIGHT.get(key) is t else None)
+        _COALESCE_STATS["leaders"] += 1
+    else:
+        _COALESCE_STATS["joined"] += 1
+    return await asyncio.shield(task)
+
+class _SharedStream:
+    # Fans one chunk stream out to every attached request; late joiners replay
+    # the chunks produced so far. The source is closed once nobody is listening.
+    def __init__(self, key, source):
+        self.key = key
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self.listeners = 0
+        self.changed = asyncio.Event()
+        self.pump = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self.changed.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.changed.set()
+            if _SHARED_STREAMS.get(self.key) is self:
+                _SHARED_STREAMS.pop(self.key, None)
+            await source.aclose()
+
+    async def follow(self):
+        self.listeners += 1
+        i = 0
+        try:
+            while True:
+                if i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self.changed.clear()
+                if i < len(self.chunks) or self.done:
+                    continue
+                await self.changed.wait()
+        finally:
+            self.listeners -= 1
+            if self.listeners == 0 and not self.done:
+                if _SHARED_STREAMS.get(self.key) is self:
+                    _SHARED_STREAMS.pop(self.key, None)
+                self.pump.cancel()
+
+def _coalesced_stream(key, make):
+    if key is None:
+        return make()
+    shared = _SHARED_STREAMS.get(key)
+    if shared is None:
+        shared = _SHARED_STREAMS[key] = _SharedStream(key, make())
+        _COALESCE_STATS["stream_leaders"] += 1
+    else:
+        _COALESCE_STATS["stream_joined"] += 1
+    return shared.follow()
+
+def _inference_tier(selected: str) -> str:
+    if (selected or "").lower() == "pro":
+        return "pro"
+    if llm_flash is None and llm_pro is not None:
+        return "pro"
+    return "flash"
+
+def _tier_llm(tier: str):
+    # Inside a replica's inference thread this is that replica's own instance.
+    bound = getattr(_REPLICA_LOCAL, "binding", None)
+    if bound is not None and bound[0] == tier:
+        return _REPLICAS[tier][bound[1]]
+    return llm_pro if tier == "pro" else llm_flash
+
+KV_CACHE_RAM_MB = int(os.environ.get("KV_CACHE_RAM_MB", "1024"))
+KV_CACHE_DIR = os.environ.get("KV_CACHE_DIR", "").strip()
+
+class _ConversationKVCache:
+    # Conversation-keyed llama.cpp states. Restoring a conversation's state before
+    # its next turn lets Llama.generate's longest-prefix match skip re-prefilling
+    # the history; only the new user turn is evaluated.
+    def __init__(self, budget_bytes: int, spill_dir: str = ""):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    @staticmethod
+    def _size(state) -> int:
+        return int(state.llama_state_size) + int(state.input_ids.nbytes) + int(state.scores.nbytes)
+
+    def _spill_path(self, key: tuple) -> str:
+        import hashlib
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".kv")
+
+    def get(self, key: tuple):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return item[0]
+        if self.spill_dir:
+            path = self._spill_path(key)
+            try:
+                with open(path, "rb") as f:
+                    state = pickle.load(f)
+                os.remove(path)
+                self.disk_hits += 1
+                self.put(key, state)
+                return state
+            except FileNotFoundError:
+                pass
+            except Exception:
+                pass
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, state):
+        size = self._size(state)
+        spilled = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (state, size)
+            self.bytes += size
+            while self.bytes > self.budget_bytes and len(self.entries) > 1:
+                k, (st, sz) = self.entries.popitem(last=False)
+                self.bytes -= sz
+                self.evictions += 1
+                spilled.append((k, st))
+        if self.spill_dir:
+            for k, st in spilled:
+                try:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                    with open(self._spill_path(k), "wb") as f:
+                        pickle.dump(st, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    self.spills += 1
+                except Exception:
+                    pass
+
+    def drop_conversation(self, kind: str, user_id: str, conversation_id: str):
+        with self.lock:
+            keys = [k for k in self.entries if k[1:] == (kind, user_id, conversation_id)]
+            for k in keys:
+                self.bytes -= self.entries.pop(k)[1]
+        if self.spill_dir:
+            for tier in ("pro", "flash"):
+                try:
+                    os.remove(self._spill_path((tier, kind, user_id, conversation_id)))
+                except Exception:
+                    pass
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "spills": self.spills,
+            "spill_dir": self.spill_dir or None,
+        }
 
-def _append_runtime_event(event: dict):
+_KV_CACHE = _ConversationKVCache(KV_CACHE_RAM_MB * 1024 * 1024, KV_CACHE_DIR)
+
+def _compact_state(llm, state):
+    # load_state sets _requires_eval, so generate always re-decodes at least one
+    # token before sampling and the saved score rows are never read back (we do
+    # not request logprobs). Keep a single broadcastable row instead of
+    # n_tokens x n_vocab floats, which matters once a draft model forces logits_all.
+    state.scores = state.scores[:1].copy()
+    return state
+
+def _common_prefix_len(a, b) -> int:
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    diff = (a[:n] != b[:n]).nonzero()[0]
+    return int(diff[0]) if len(diff) else n
+
+PREFIX_CACHE_PROMPTS = [p.strip() for p in os.environ.get("PREFIX_CACHE_PROMPTS", "medical,friend,classify,title,summary").split(",") if p.strip()]
+
+_PREFIX_PROMPTS = {
+    "medical": {"role": "system", "content": MEDICAL_SYSTEM_PROMPT},
+    "friend": {"role": "system", "content": FRIEND_SYSTEM_PROMPT},
+    "classify": {"role": "user", "content": LOOKUP_CLASSIFY_PROMPT},
+    "title": {"role": "system", "content": TITLE_SYSTEM_PROMPT},
+    "summary": {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+}
+
+# tier -> {"day", "states": name -> (LlamaState, n_prefix)}; states are portable
+# between replicas of a tier since they load the same GGUF with the same n_ctx.
+_PREFIX_STATES = {}
+_PREFIX_STATS = {"primed": 0, "hits": 0, "skipped": 0, "prime_ms": 0}
+
+def _prime_variants(msg: dict) -> List[List[dict]]:
+    if msg["role"] == "system":
+        return [[msg, {"role": "user", "content": "."}], [msg, {"role": "user", "content": "?"}]]
+    return [[{"role": msg["role"], "content": msg["content"] + "."}], [{"role": msg["role"], "content": msg["content"] + "?"}]]
+
+def _prime_prefix_states(tier: str, llm):
+    # Runs on the tier's inference thread. The shared prefix length is the common
+    # token prefix of two primes that differ only after it; the second prime
+    # reuses the first's KV so it costs a handful of tokens. Chat templates embed
+    # today's date, so states are rebuilt when the day changes.
+    started = time.time()
+    states = {}
+    for name in PREFIX_CACHE_PROMPTS:
+        msg = _PREFIX_PROMPTS.get(name)
+        if msg is None:
+            continue
+        try:
+            first, second = _prime_variants(msg)
+            llm.create_chat_completion(messages=first, temperature=0, max_tokens=1)
+            state = _compact_state(llm, llm.save_state())
+            llm.create_chat_completion(messages=second, temperature=0, max_tokens=1)
+            n_prefix = _common_prefix_len(llm.input_ids[:llm.n_tokens], state.input_ids[:int(state.n_tokens)])
+            if n_prefix > 0:
+                states[name] = (state, n_prefix)
+        except Exception:
+            pass
+    _PREFIX_STATES[tier] = {"day": datetime.date.today().isoformat(), "states": states}
+    _PREFIX_STATS["primed"] += len(states)
+    _PREFIX_STATS["prime_ms"] += int((time.time() - started) * 1000)
+    _append_runtime_event({"type": "prefix_cache_primed", "tier": tier, "prompts": sorted(states), "ts": datetime.datetime.utcnow().isoformat()})
+
+def _prefix_state_for(llm, tier: str, messages: Optional[List[dict]]):
+    if not messages or not PREFIX_CACHE_PROMPTS:
+        return None
+    entry = _PREFIX_STATES.get(tier)
+    if entry is None or entry["day"] != datetime.date.today().isoformat():
+        _prime_prefix_states(tier, llm)
+        entry = _PREFIX_STATES.get(tier)
+    head = messages[0]
+    content = str(head.get("content") or "")
+    best = None
+    for name, (state, n_prefix) in entry["states"].items():
+        msg = _PREFIX_PROMPTS[name]
+        if head.get("role") == msg["role"] and content.startswith(msg["content"]):
+            if best is None or n_prefix > best[1]:
+                best = (state, n_prefix)
+    return best
+
+def _kv_restore(llm, tier: str, cache_key: Optional[tuple], messages: Optional[List[dict]] = None):
+    state = _KV_CACHE.get((tier,) + cache_key) if cache_key is not None else None
+    if state is not None:
+        n = int(state.n_tokens)
+        if llm.n_tokens >= n and (llm.input_ids[:n] == state.input_ids[:n]).all():
+            return
+        llm.load_state(state)
+        return
     try:
-        _ensure_runtime_files()
-        pdir = _front_data_dir()
-        events_path = os.path.join(pdir, "runtime-events.jsonl")
-        with open(events_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(event) + "\n")
+        pinned = _prefix_state_for(llm, tier, messages)
+    except Exception:
+        pinned = None
+    if pinned is None:
+        return
+    state, n_prefix = pinned
+    if _common_prefix_len(llm.input_ids[:llm.n_tokens], state.input_ids[:n_prefix]) >= n_prefix:
+        _PREFIX_STATS["skipped"] += 1
+        return
+    llm.load_state(state)
+    _PREFIX_STATS["hits"] += 1
+
+def _kv_snapshot(llm, tier: str, cache_key: Optional[tuple]):
+    if cache_key is None:
+        return
+    try:
+        _KV_CACHE.put((tier,) + cache_key, _compact_state(llm, llm.save_state()))
     except Exception:
         pass
 
-def ensure_text_model(tier: str) -> bool:
-    global llm_pro, llm_flash
-    just_loaded = False
-    if tier == "pro":
-        if llm_pro is None and os.path.exists(PRO_MODEL_PATH) and Llama is not None:
-            try:
-                now = datetime.datetime.utcnow().isoformat()
-                _append_runtime_event({"type": "cpu_model_loading", "tier": "pro", "ts": now})
-                llm_pro = Llama(model_path=PRO_MODEL_PATH, n_ctx=2048, n_threads=4, verbose=False)
-                just_loaded = True
-                _append_runtime_event({"type": "cpu_model_loaded", "tier": "pro", "ts": datetime.datetime.utcnow().isoformat()})
-            except Exception as e:
-                llm_pro = None
-                _append_runtime_event({"type": "cpu_model_load_failed", "tier": "pro", "error": str(e), "ts": datetime.datetime.utcnow().isoformat()})
-    else:
-        if llm_flash is None and os.path.exists(FLASH_MODEL_PATH) and Llama is not None:
+def _complete_chat(tier: str, messages: List[dict], temperature: Optional[float], max_tokens: Optional[int], cache_key: Optional[tuple] = None):
+    just_loaded = ensure_text_model(tier)
+    llm = _tier_llm(tier)
+    if llm is None:
+        return just_loaded, None
+    _kv_restore(llm, tier, cache_key, messages)
+    result = llm.create_chat_completion(messages=messages, temperature=temperature, max_tokens=max_tokens)
+    _kv_snapshot(llm, tier, cache_key)
+    return just_loaded, result
+
+def _chat_chunks(tier: str, messages: List[dict], temperature: Optional[float], max_tokens: Optional[int], cache_key: Optional[tuple] = None):
+    llm = _bound_llm(tier)
+    if llm is None:
+        return
+    _kv_restore(llm, tier, cache_key, messages)
+    yield from llm.create_chat_completion(messages=messages, temperature=temperature, max_tokens=max_tokens, stream=True)
+    _kv_snapshot(llm, tier, cache_key)
+
+async def _generate_title(user_text: str, ai_text: str) -> str:
+    if llm_flash is None and llm_pro is None:
+        return generate_auto_title(user_text, ai_text, use_llm=False)
+    try:
+        return await _run_inference("flash" if llm_flash is not None else "pro", generate_auto_title, user_text, ai_text, priority="background")
+    except HTTPException:
+        return generate_auto_title(user_text, ai_text, use_llm=False)
+
+_BACKGROUND_TASKS = set()
+
+TITLE_BATCH_MAX = int(os.environ.get("TITLE_BATCH_MAX", "8"))
+TITLE_IDLE_POLL_S = float(os.environ.get("TITLE_IDLE_POLL_S", "0.25"))
+TITLE_MAX_DEFER_S = float(os.environ.get("TITLE_MAX_DEFER_S", "30"))
+
+_TITLE_JOBS = collections.deque()
+_TITLE_STATS = {"generated": 0, "heuristic": 0, "batches": 0, "preempted": 0}
+_TITLER = {"task": None, "wake": None}
+
+def _title_batch(tier: str, pairs: List[tuple]) -> List[Optional[str]]:
+    # Runs on the tier's inference thread. Titles share the pinned title prefix,
+    # so back-to-back generations only evaluate their own turn. Stops early when
+    # interactive work queues up behind the batch; the rest is re-queued.
+    worker = getattr(_REPLICA_LOCAL, "worker", None)
+    out = []
+    for i, (user_text, ai_text) in enumerate(pairs):
+        if i and worker is not None and worker.waiting("interactive", "lookup"):
+            out.extend([None] * (len(pairs) - i))
+            break
+        out.append(generate_auto_title(user_text, ai_text))
+    return out
+
+def _apply_title(job: dict, title: str):
+    conv = _conversation_record(job["kind"], job["user_id"], job["conversation_id"])
+    if conv is not None:
+        kind = "social" if job["kind"] == "social" else "chat"
+        if conv.get("title"):
+            _watch_store_write(_STORE.update(kind, job["user_id"], job["conversation_id"], title_pending=None), "title update")
+        else:
+            _watch_store_write(_STORE.update(kind, job["user_id"], job["conversation_id"], title_pending=None, title=title), "title update")
+    if job.get("answer_pending") is not None:
+        _ANSWER_CACHE.set_title(job["answer_pending"], title)
+
+async def _titler():
+    wake = _TITLER["wake"]
+    while True:
+        if not _TITLE_JOBS:
+            wake.clear()
+            await wake.wait()
+            continue
+        tier = "flash" if llm_flash is not None else ("pro" if llm_pro is not None else None)
+        idle = tier is not None and _tier_idle(tier)
+        deferred = time.time() - _TITLE_JOBS[0]["queued"]
+        if tier is not None and not idle and deferred < TITLE_MAX_DEFER_S:
+            await asyncio.sleep(TITLE_IDLE_POLL_S)
+            continue
+        batch = [_TITLE_JOBS.popleft() for _ in range(min(TITLE_BATCH_MAX, len(_TITLE_JOBS)))]
+        titles = [None] * len(batch)
+        if idle:
             try:
-                now = datetime.datetime.utcnow().isoformat()
-                _append_runtime_event({"type": "cpu_model_loading", "tier": "flash", "ts": now})
-                llm_flash = Llama(model_path=FLASH_MODEL_PATH, n_ctx=2048, n_threads=4, verbose=False)
-                just_loaded = True
-                _append_runtime_event({"type": "cpu_model_loaded", "tier": "flash", "ts": datetime.datetime.utcnow().isoformat()})
-            except Exception as e:
-                llm_flash = None
-                _append_runtime_event({"type": "cpu_model_load_failed", "tier": "flash", "error": str(e), "ts": datetime.datetime.utcnow().isoformat()})
-    return just_loaded
+                titles = await _run_inference(tier, _title_batch, tier, [(j["user_text"], j["ai_text"]) for j in batch], priority="background")
+                _TITLE_STATS["batches"] += 1
+            except Exception:
+                titles = [generate_auto_title(j["user_text"], j["ai_text"], use_llm=False) for j in batch]
+                _TITLE_STATS["heuristic"] += len(batch)
+        else:
+            # No local model, or chat has kept it busy past TITLE_MAX_DEFER_S:
+            # a keyword title costs nothing and never competes with users.
+            titles = [generate_auto_title(j["user_text"], j["ai_text"], use_llm=False) for j in batch]
+            _TITLE_STATS["heuristic"] += len(batch)
+        for job, title in reversed(list(zip(batch, titles))):
+            if title is None:
+                _TITLE_JOBS.appendleft(job)
+                _TITLE_STATS["preempted"] += 1
+            else:
+                await asyncio.to_thread(_apply_title, job, title)
+        _TITLE_STATS["generated"] += sum(1 for t in titles if t is not None)
+
+def _queue_title(kind: str, user_id: str, conversation_id: str, user_text: str, ai_text: str, answer_pending=None, conv: Optional[dict] = None):
+    # `conv` is the caller's fresh record; runs on the loop, so it must not read the store.
+    if conv is None or conv.get("title") or conv.get("title_pending"):
+        return
+    _watch_store_write(_STORE.update("social" if kind == "social" else "chat", user_id, conversation_id, title_pending=True), "title_pending update")
+    _TITLE_JOBS.append({
+        "kind": kind,
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "user_text": user_text,
+        "ai_text": ai_text,
+        "answer_pending": answer_pending,
+        "queued": time.time(),
+    })
+    loop = asyncio.get_running_loop()
+    task = _TITLER["task"]
+    if task is None or task.done() or task.get_loop() is not loop:
+        _TITLER["wake"] = asyncio.Event()
+        _TITLER["task"] = loop.create_task(_titler())
+    _TITLER["wake"].set()
+
+def _spawn_background(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+@app.get("/v1/runtime/inference")
+async def inference_stats():
+    return {
+        "queue_max": INFERENCE_QUEUE_MAX,
+        "scheduler": {"classes": list(SCHED_CLASSES), "aging_s": SCHED_AGING_S, "background_defer_depth": SCHED_BACKGROUND_DEFER_DEPTH, "interactive_depth": _interactive_depth()},
+        "workers": {k: w.stats() for k, w in list(_INFERENCE_WORKERS.items())},
+        "titles": {"pending": len(_TITLE_JOBS), **_TITLE_STATS},
+        "coalesce": {"in_flight": len(_IN_FLIGHT), "streams": len(_SHARED_STREAMS), **_COALESCE_STATS},
+    }
 
-def ensure_vlm_model() -> bool:
-    global vlm_llm
-    if vlm_llm is not None:
-        return False
-    if not (os.path.exists(VLM_MODEL_PATH) and os.path.exists(VLM_CLIP_MODEL_PATH)):
-        return False
-    if Llama is None or Llava15ChatHandler is None:
-        return False
+WARMUP_PROFILE = [t for t in (p.strip().lower() for p in os.environ.get("WARMUP_PROFILE", "").replace("+", ",").split(",")) if t in ("pro", "flash", "vlm")]
+
+_WARMUP = {"state": "ready" if not WARMUP_PROFILE else "pending", "profile": WARMUP_PROFILE, "started": None, "finished": None, "results": {}}
+
+def _warm_text_replica(tier: str) -> dict:
+    # Runs on the replica's own thread: load, then a short greedy generation so
+    # the weight pages are faulted in and the first real prefill is not cold.
+    started = time.perf_counter()
+    loaded = ensure_text_model(tier)
+    llm = _tier_llm(tier)
+    if llm is None:
+        return {"ok": False, "error": "model not available"}
+    llm.create_chat_completion(messages=[{"role": "user", "content": "Xin chào"}], temperature=0, max_tokens=8)
+    return {"ok": True, "loaded": loaded, "ms": round((time.perf_counter() - started) * 1000.0, 1)}
+
+def _warm_vlm() -> dict:
+    started = time.perf_counter()
+    loaded = ensure_vlm_model()
+    llm = vlm_llm
+    if llm is None:
+        return {"ok": False, "error": "model not available"}
+    llm.create_chat_completion(messages=[{"role": "user", "content": "Xin chào"}], temperature=0, max_tokens=4)
+    return {"ok": True, "loaded": loaded, "ms": round((time.perf_counter() - started) * 1000.0, 1)}
+
+async def _warm_one(key: str, fn, *args):
     try:
-        now = datetime.datetime.utcnow().isoformat()
-        _append_runtime_event({"type": "cpu_model_loading", "tier": "vlm", "ts": now})
-        chat_handler = Llava15ChatHandler(clip_model_path=VLM_CLIP_MODEL_PATH)
-        vlm_llm = Llama(model_path=VLM_MODEL_PATH, chat_handler=chat_handler, n_ctx=2048, n_threads=4, verbose=False)
-        _append_runtime_event({"type": "cpu_model_loaded", "tier": "vlm", "ts": datetime.datetime.utcnow().isoformat()})
-        return True
+        result = await asyncio.wrap_future(_inference_worker(key).submit(fn, args, "background"))
     except Exception as e:
-        vlm_llm = None
-        _append_runtime_event({"type": "cpu_model_load_failed", "tier": "vlm", "error": str(e), "ts": datetime.datetime.utcnow().isoformat()})
-        return False
+        result = {"ok": False, "error": str(getattr(e, "detail", e))}
+    _WARMUP["results"][key] = result
+    _append_runtime_event({"type": "warmup_model", "key": key, **result, "ts": datetime.datetime.utcnow().isoformat()})
+
+async def _warmup_models():
+    # Every replica has its own worker thread, so the whole profile loads in parallel.
+    jobs = []
+    for tier in WARMUP_PROFILE:
+        if tier == "vlm":
+            jobs.append(_warm_one("vlm", _warm_vlm))
+        else:
+            for i in range(len(_REPLICAS[tier])):
+                jobs.append(_warm_one(f"{tier}#{i}", _warm_text_replica, tier))
+    await asyncio.gather(*jobs)
+    _WARMUP.update(state="ready", finished=datetime.datetime.utcnow().isoformat() + "Z")
+    _append_runtime_event({"type": "warmup_done", "profile": WARMUP_PROFILE, "ok": all(r.get("ok") for r in _WARMUP["results"].values()), "ts": datetime.datetime.utcnow().isoformat()})
+
+@app.get("/v1/runtime/model-pool")
+async def model_pool_stats():
+    tiers = {}
+    for tier, replicas in _REPLICAS.items():
+        items = []
+        for i, llm in enumerate(replicas):
+            layout = _replica_layout(tier, i)
+            w = _INFERENCE_WORKERS.get(f"{tier}#{i}")
+            items.append({
+                "replica": i,
+                "loaded": llm is not None,
+                "node": layout["node"],
+                "cpus": layout["cpus"],
+                "n_threads": layout["n_threads"],
+                "n_threads_batch": layout["n_threads_batch"],
+                "n_batch": MODEL_N_BATCH,
+                **(w.stats() if w is not None else {"queued": 0, "running": False, "utilisation": 0.0}),
+            })
+        tiers[tier] = items
+    return {
+        "topology": {"logical_cpus": _CPU_TOPOLOGY["logical"], "physical_cores": _CPU_TOPOLOGY["physical"], "numa_nodes": [len(n) for n in _CPU_TOPOLOGY["nodes"]]},
+        "pin_numa": MODEL_PIN_NUMA,
+        "tiers": tiers,
+    }
+
+@app.get("/v1/runtime/speculative")
+async def speculative_stats():
+    drafts = [d.stats() for d in list(_SPECULATIVE["drafts"])]
+    proposed = sum(d["proposed"] for d in drafts)
+    accepted = sum(d["accepted"] for d in drafts)
+    return {
+        "enabled": SPECULATIVE_DECODING,
+        "active": bool(drafts),
+        "error": _SPECULATIVE["error"],
+        "k": SPECULATIVE_K,
+        "proposed": proposed,
+        "accepted": accepted,
+        "acceptance_rate": round(accepted / proposed, 4) if proposed else 0.0,
+        "replicas": drafts,
+    }
+
+@app.get("/v1/runtime/kv-cache")
+async def kv_cache_stats():
+    out = _KV_CACHE.stats()
+    out["prefix"] = dict(_PREFIX_STATS)
+    out["prefix"]["tiers"] = {t: {"day": e["day"], "prompts": {n: p for n, (_, p) in e["states"].items()}} for t, e in list(_PREFIX_STATES.items())}
+    return out
+
+@app.get("/v1/runtime/answer-cache")
+async def answer_cache_stats():
+    return _ANSWER_CACHE.stats()
+
+@app.get("/v1/runtime/gpu-backends")
+async def gpu_backends():
+    urls = []
+    for u in [_get_proxy_base()] + _registry_urls() + list(_BREAKERS) + list(_BACKEND_STATUS):
+        if u.rstrip("/") not in urls:
+            urls.append(u.rstrip("/"))
+    return {
+        "probe_interval_s": GPU_PROBE_INTERVAL_S,
+        "breaker": {"failures": GPU_BREAKER_FAILURES, "cooldown_s": GPU_BREAKER_COOLDOWN_S},
+        "backends": [{"url": u, **_breaker(u).stats(), "probe": _BACKEND_STATUS.get(u)} for u in urls],
+    }
+
+@app.get("/v1/runtime/store")
+async def store_stats():
+    return _STORE.stats()
+
+@app.get("/v1/runtime/events")
+async def query_runtime_events(source: str = "events", type: Optional[str] = None, tier: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None, limit: int = 200):
+    """Filtered read of runtime-events.jsonl (source=events) or runtime-metrics.jsonl
+    (source=metrics), including rotated segments. `type` is comma-separated; `tier`
+    matches an event's tier (pro/flash/vlm) or mode (cpu/gpu); since/until take ISO
+    or epoch seconds. `stats` gives p50/p95 duration_ms by mode over every match."""
+    index = _EVENT_INDEXES.get(source)
+    if index is None:
+        raise HTTPException(status_code=400, detail="source must be 'events' or 'metrics'")
+    lo, hi = _event_epoch(since), _event_epoch(until)
+    if (since and lo is None) or (until and hi is None):
+        raise HTTPException(status_code=400, detail="since/until must be ISO timestamps or epoch seconds")
+    types = {t.strip() for t in type.split(",") if t.strip()} if type else None
+
+    def keep(rec: dict, ts) -> bool:
+        if types is not None and rec.get("type") not in types:
+            return False
+        if tier and tier not in (rec.get("tier"), rec.get("mode"), rec.get("model")):
+            return False
+        return True
+
+    if source == "events":
+        await asyncio.to_thread(_EVENTS.flush)
+    records, read, total = await asyncio.to_thread(index.query, lo, hi, keep)
+    limit = max(0, min(limit, 5000))
+    return {
+        "source": source,
+        "matched": len(records),
+        "events": records[-limit:] if limit else [],
+        "stats": _duration_stats(records),
+        "index": {"blocks_read": read, "blocks_total": total, "every": EVENTS_INDEX_EVERY},
+        "sink": _EVENTS.stats(),
+    }
+
+@app.get("/v1/runtime/admission")
+async def admission_stats():
+    mw = _ADMISSION["middleware"]
+    return mw.stats() if mw is not None else {}
+
+@app.get("/v1/runtime/http-pool")
+async def http_pool_stats():
+    return {**_http_pool_stats(), "proxy": _proxy_stats()}
 
 @app.get("/health")
 async def health():
-    return {
-        "status": "ok", 
+    ready = _WARMUP["state"] == "ready"
+    data = {
+        "status": "ok" if ready else "warming",
+        "ready": ready,
+        "warmup": _WARMUP,
         "text_model_loaded": (llm_pro is not None) or (llm_flash is not None), 
         "pro_loaded": llm_pro is not None,
         "flash_loaded": llm_flash is not None,
         "vlm_model_loaded": vlm_llm is not None,
         "proxy_target": LLAMA_SERVER_URL
     }
+    # Load balancers only route here once the warm-up profile has finished.
+    return data if ready else JSONResponse(status_code=503, content=data)
 
 @app.get("/v1/models")
 async def list_models():
     items = []
     if os.path.exists(PRO_MODEL_PATH):
-        items.append({"id": os.path.basename(PRO_MODEL_PATH), "type": "gguf", "tier": "pro"})
+        items.append({"id": os.path.basename(PRO_MODEL_PATH), "type": "gguf", "tier": "pro", **_RESIDENCY.describe("pro")})
     if os.path.exists(FLASH_MODEL_PATH):
-        items.append({"id": os.path.basename(FLASH_MODEL_PATH), "type": "gguf", "tier": "flash"})
+        items.append({"id": os.path.basename(FLASH_MODEL_PATH), "type": "gguf", "tier": "flash", **_RESIDENCY.describe("flash")})
     if os.path.exists(VLM_MODEL_PATH):
-        items.append({"id": os.path.basename(VLM_MODEL_PATH), "type": "gguf", "tier": "vlm"})
-    return {"data": items}
+        items.append({"id": os.path.basename(VLM_MODEL_PATH), "type": "gguf", "tier": "vlm", **_RESIDENCY.describe("vlm")})
+    return {
+        "data": items,
+        "residency": {
+            "budget_bytes": _RESIDENCY.budget_bytes,
+            "resident_bytes": _RESIDENCY.resident_bytes(),
+            "evictions": _RESIDENCY.evictions,
+        },
+    }
 
 def _front_data_dir():
     return os.path.join(os.path.dirname(__file__), "medical-consultation-app", "data")
@@ -605,15 +3283,118 @@ def _ensure_state_file():
         with open(STATE_FILE, "w", encoding="utf-8") as f:
             json.dump({"global": {"target": "cpu", "model": "flash", "updated_at": datetime.datetime.utcnow().isoformat()}, "users": {}}, f, ensure_ascii=False)
 
+CONFIG_POLL_S = float(os.environ.get("CONFIG_POLL_S", "1"))
+
+_RuntimeSnapshot = collections.namedtuple("_RuntimeSnapshot", ["mode", "state", "servers", "loaded_at"])
+
+def _write_json_atomic(path: str, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+class _RuntimeConfig:
+    """runtime-mode.json, runtime_state.json and server-registry.json held in memory.
+
+    Handlers read `snapshot()`, which does no I/O while the watcher task runs.
+    The files are re-parsed only when their mtime/size change, and the POST
+    endpoints swap in the new snapshot as soon as they write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stamps = {}
+        self._snapshot = None
+        self._checked = 0.0
+        self.watching = False
+        self.reloads = 0
+
+    def _paths(self) -> dict:
+        pdir = _front_data_dir()
+        return {
+            "mode": os.path.join(pdir, "runtime-mode.json"),
+            "state": STATE_FILE,
+            "servers": os.path.join(pdir, "server-registry.json"),
+        }
+
+    @staticmethod
+    def _stamp(path: str):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _parse(name: str, path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return None
+        if name == "servers":
+            return [s for s in (data.get("servers", []) if isinstance(data, dict) else []) if isinstance(s, dict)]
+        return data if isinstance(data, dict) else None
+
+    def refresh(self) -> bool:
+        changed = {}
+        for name, path in self._paths().items():
+            stamp = self._stamp(path)
+            if self._snapshot is None or self._stamps.get(name) != stamp:
+                changed[name] = (stamp, self._parse(name, path) if stamp is not None else None)
+        self._checked = time.monotonic()
+        if not changed:
+            return False
+        with self._lock:
+            cur = self._snapshot._asdict() if self._snapshot is not None else {}
+            for name, (stamp, data) in changed.items():
+                self._stamps[name] = stamp
+                cur[name] = data if data is not None or name != "servers" else []
+            cur["loaded_at"] = time.time()
+            self._snapshot = _RuntimeSnapshot(**cur)
+            self.reloads += 1
+        return True
+
+    def snapshot(self) -> "_RuntimeSnapshot":
+        # Without the watcher (e.g. a TestClient used without lifespan) fall back
+        # to a stat check at most once per poll interval.
+        if self._snapshot is None or (not self.watching and time.monotonic() - self._checked >= CONFIG_POLL_S):
+            self.refresh()
+        return self._snapshot
+
+    def write(self, name: str, data):
+        path = self._paths()[name]
+        with self._lock:
+            _write_json_atomic(path, data)
+            self._stamps[name] = self._stamp(path)
+            base = self._snapshot._asdict() if self._snapshot is not None else {"mode": None, "state": None, "servers": []}
+            base[name] = data
+            base["loaded_at"] = time.time()
+            self._snapshot = _RuntimeSnapshot(**base)
+
+    async def watch(self):
+        self.watching = True
+        try:
+            while True:
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+                await asyncio.sleep(CONFIG_POLL_S)
+        finally:
+            self.watching = False
+
+_RUNTIME_CONFIG = _RuntimeConfig()
+
 @app.get("/v1/runtime/mode")
 async def get_runtime_mode():
     try:
-        _ensure_runtime_files()
-        pdir = _front_data_dir()
-        mode_path = os.path.join(pdir, "runtime-mode.json")
-        with open(mode_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
+        mode = _RUNTIME_CONFIG.snapshot().mode
+        if mode is None:
+            _ensure_runtime_files()
+            _RUNTIME_CONFIG.refresh()
+            mode = _RUNTIME_CONFIG.snapshot().mode or {}
+        return dict(mode)
     except Exception as e:
         return {"error": str(e)}
 
@@ -628,13 +3409,8 @@ async def set_runtime_mode(req: Request):
         payload = {"target": target, "updated_at": now}
         if gpu_url:
             payload["gpu_url"] = str(gpu_url)
-        pdir = _front_data_dir()
-        mode_path = os.path.join(pdir, "runtime-mode.json")
-        events_path = os.path.join(pdir, "runtime-events.jsonl")
-        with open(mode_path, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
-        with open(events_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps({"type": "mode_change", "target": target, "gpu_url": gpu_url, "ts": now}) + "\n")
+        _RUNTIME_CONFIG.write("mode", payload)
+        _append_runtime_event({"type": "mode_change", "target": target, "gpu_url": gpu_url, "ts": now})
         return {"ok": True, "mode": payload}
     except Exception as e:
         return {"error": str(e)}
@@ -642,10 +3418,12 @@ async def set_runtime_mode(req: Request):
 @app.get("/v1/runtime/state")
 async def get_runtime_state(request: Request):
     try:
-        _ensure_state_file()
+        data = _RUNTIME_CONFIG.snapshot().state
+        if data is None:
+            _ensure_state_file()
+            _RUNTIME_CONFIG.refresh()
+            data = _RUNTIME_CONFIG.snapshot().state or {}
         user_id = get_current_user(request)
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
         if user_id and user_id != "anonymous":
             u = (data.get("users") or {}).get(user_id)
             if u:
@@ -665,8 +3443,10 @@ async def set_runtime_state(req: Request):
         gpu_url = body.get("gpu_url")
         model = body.get("model")
         user_id = get_current_user(req)
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        # Work on a copy so readers keep seeing the old snapshot until the swap.
+        if _RUNTIME_CONFIG.snapshot().state is None:
+            _RUNTIME_CONFIG.refresh()
+        data = json.loads(json.dumps(_RUNTIME_CONFIG.snapshot().state or {}))
         if "users" not in data or not isinstance(data["users"], dict):
             data["users"] = {}
         cur = data.get("global") or {}
@@ -692,33 +3472,506 @@ async def set_runtime_state(req: Request):
                 u["model"] = model
             u["updated_at"] = now
             data["users"][user_id] = u
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        _RUNTIME_CONFIG.write("state", data)
+        evt = {"ts": now}
+        if target in ("cpu", "gpu"):
+            evt.update({"type": "mode_change", "target": target, "gpu_url": gpu_url})
+        if model in ("flash", "pro"):
+            evt.update({"type": "model_change", "model": model})
+        if "type" in evt:
+            _append_runtime_event(evt)
+        return {"ok": True, "state": cur}
+    except Exception as e:
+        return {"error": str(e)}
+
+def _gpu_headers(mode_sel: Optional[str] = None) -> dict:
+    headers = {"Content-Type": "application/json", "ngrok-skip-browser-warning": "true"}
+    auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
+    if auth:
+        headers["Authorization"] = auth
+    if mode_sel:
+        headers["X-Mode"] = mode_sel
+    return headers
+
+def _last_user_message(base_messages: List[dict]) -> Optional[dict]:
+    for m in reversed(base_messages):
+        if m.get("role") == "user":
+            return {"role": "user", "content": m.get("content", "")}
+    return None
+
+def _compose_messages(history: List[dict], base_messages: List[dict]) -> List[dict]:
+    # System messages lead the prompt so every turn of a conversation shares the
+    # same token prefix (and the saved KV state stays reusable).
+    system = [m for m in base_messages if m.get("role") == "system"]
+    rest = [m for m in base_messages if m.get("role") != "system"]
+    return system + history + rest
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "0"))
+HISTORY_TRIM_RATIO = float(os.environ.get("HISTORY_TRIM_RATIO", "0.6"))
+HISTORY_MESSAGE_OVERHEAD = 6
+HISTORY_SUMMARY_MAX_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", "192"))
+
+_SUMMARY_PENDING = set()
+
+def _conversation_record(kind: str, user_id: str, conversation_id: str) -> Optional[dict]:
+    return _STORE.get("social" if kind == "social" else "chat", user_id, conversation_id)
+
+TOKEN_LEN_CACHE_MAX = int(os.environ.get("TOKEN_LEN_CACHE_MAX", "8192"))
+_TOKEN_LENS = collections.OrderedDict()
+_TOKEN_LENS_LOCK = threading.Lock()
+
+def _token_len(tier: str, local: bool, text: str) -> int:
+    # Counts are cached under a digest of the text so the cache stays a fixed
+    # size no matter how long the messages are.
+    raw = text.encode("utf-8")
+    key = (tier, local, hashlib.blake2b(raw, digest_size=16).digest())
+    with _TOKEN_LENS_LOCK:
+        n = _TOKEN_LENS.get(key)
+        if n is not None:
+            _TOKEN_LENS.move_to_end(key)
+            return n
+    n = None
+    llm = _tier_llm(tier) if local else None
+    if llm is not None:
         try:
-            _ensure_runtime_files()
-            pdir = _front_data_dir()
-            events_path = os.path.join(pdir, "runtime-events.jsonl")
-            evt = {"ts": now}
-            if target in ("cpu", "gpu"):
-                evt.update({"type": "mode_change", "target": target, "gpu_url": gpu_url})
-            if model in ("flash", "pro"):
-                evt.update({"type": "model_change", "model": model})
-            if "type" in evt:
-                with open(events_path, "a", encoding="utf-8") as f:
-                    f.write(json.dumps(evt) + "\n")
+            n = len(llm.tokenize(raw, add_bos=False, special=True))
         except Exception:
             pass
-        return {"ok": True, "state": cur}
+    if n is None:
+        # No local tokenizer (GPU mode / model not loaded): Vietnamese text averages
+        # roughly three characters per Llama 3 token.
+        n = len(text) // 3 + 1
+    with _TOKEN_LENS_LOCK:
+        _TOKEN_LENS[key] = n
+        while len(_TOKEN_LENS) > TOKEN_LEN_CACHE_MAX:
+            _TOKEN_LENS.popitem(last=False)
+    return n
+
+def _watch_store_write(fut: concurrent.futures.Future, what: str):
+    # Fire-and-forget store writes still get their failures reported.
+    def done(f):
+        err = f.exception()
+        if err is not None:
+            print(f"Conversation store {what} failed: {err}")
+            _append_runtime_event({"type": "store_write_failed", "what": what, "error": str(err), "ts": datetime.datetime.utcnow().isoformat()})
+    fut.add_done_callback(done)
+    return fut
+
+def _history_budget(max_tokens: Optional[int]) -> int:
+    budget = TEXT_MODEL_N_CTX - int(max_tokens or 512) - 64
+    if HISTORY_TOKEN_BUDGET > 0:
+        budget = min(budget, HISTORY_TOKEN_BUDGET)
+    return max(budget, 256)
+
+def _plan_history(kind: str, user_id: str, conversation_id: str, history: List[dict], base_messages: List[dict], tier: str, max_tokens: Optional[int]):
+    # Keep the system prompt and the newest turns inside the token budget; turns
+    # that fall out of the window are folded into conv["summary"] in the background.
+    # Runs off the event loop (see _plan_prompt); returns (messages, needs_summary).
+    conv = _conversation_record(kind, user_id, conversation_id)
+    local = _tier_llm(tier) is not None
+    cost = lambda m: _token_len(tier, local, str(m.get("content") or "")) + HISTORY_MESSAGE_OVERHEAD
+    summary = (conv or {}).get("summary") or ""
+    fixed = sum(cost(m) for m in base_messages)
+    if summary:
+        fixed += _token_len(tier, local, SUMMARY_CONTEXT_PREFIX + summary)
+    budget = _history_budget(max_tokens)
+    start = min(int((conv or {}).get("window_start") or 0), len(history))
+    window_cost = sum(cost(m) for m in history[start:])
+    if fixed + window_cost > budget:
+        # Slide in one step well below the budget so the prompt prefix, and the
+        # conversation's cached KV state, stays stable for the next few turns.
+        target = budget * HISTORY_TRIM_RATIO - fixed
+        while start < len(history) and (window_cost > target or history[start].get("role") != "user"):
+            window_cost -= cost(history[start])
+            start += 1
+        if conv is not None:
+            _watch_store_write(_STORE.update("social" if kind == "social" else "chat", user_id, conversation_id, window_start=start), "window_start update")
+    needs_summary = conv is not None and start > int(conv.get("summary_upto") or 0)
+    if summary:
+        note = SUMMARY_CONTEXT_PREFIX + summary
+        system = [m for m in base_messages if m.get("role") == "system"]
+        others = [m for m in base_messages if m.get("role") != "system"]
+        if system:
+            system = [{**system[0], "content": str(system[0].get("content") or "") + "\n\n" + note}] + system[1:]
+        else:
+            system = [{"role": "system", "content": note}]
+        base_messages = system + others
+    return _compose_messages(history[start:], base_messages), needs_summary
+
+async def _plan_prompt(kind: str, user_id: str, conversation_id: str, history: List[dict], base_messages: List[dict], tier: str, max_tokens: Optional[int]) -> List[dict]:
+    messages, needs_summary = await asyncio.to_thread(_plan_history, kind, user_id, conversation_id, history, base_messages, tier, max_tokens)
+    if needs_summary:
+        _spawn_background(_refresh_summary(kind, user_id, conversation_id, tier))
+    return messages
+
+def _transcript(turns: List[dict]) -> str:
+    lines = []
+    for m in turns:
+        who = "Người dùng" if m.get("role") == "user" else "Trợ lý"
+        lines.append(f"{who}: {str(m.get('content') or '').strip()}")
+    return "\n".join(lines)
+
+def _summarize_turns(tier: str, previous: str, turns: List[dict]) -> str:
+    # Runs on the tier's inference thread. Folds the turns in chunks that fit the
+    # context alongside the running summary.
+    llm = _bound_llm(tier)
+    if llm is None:
+        return ""
+    chunk_budget = TEXT_MODEL_N_CTX - HISTORY_SUMMARY_MAX_TOKENS - 256
+    summary = previous
+    i = 0
+    while i < len(turns):
+        chunk = []
+        used = _token_len(tier, True, summary)
+        while i < len(turns):
+            c = _token_len(tier, True, str(turns[i].get("content") or "")) + HISTORY_MESSAGE_OVERHEAD
+            if chunk and used + c > chunk_budget:
+                break
+            chunk.append(turns[i])
+            used += c
+            i += 1
+        body = _transcript(chunk)
+        if summary:
+            body = f"Tóm tắt trước đó: {summary}\n\nĐoạn hội thoại tiếp theo:\n{body}"
+        messages = [{"role": "system", "content": SUMMARY_SYSTEM_PROMPT}, {"role": "user", "content": body}]
+        _kv_restore(llm, tier, None, messages)
+        res = llm.create_chat_completion(messages=messages, temperature=0.2, max_tokens=HISTORY_SUMMARY_MAX_TOKENS)
+        summary = str(res.get("choices", [{}])[0].get("message", {}).get("content", "")).strip() or summary
+    return summary
+
+def _extractive_summary(previous: str, turns: List[dict]) -> str:
+    parts = [previous] if previous else []
+    for m in turns:
+        if m.get("role") == "user":
+            parts.append(str(m.get("content") or "").strip()[:160])
+    return " | ".join(p for p in parts if p)[-1200:]
+
+async def _refresh_summary(kind: str, user_id: str, conversation_id: str, tier: str):
+    key = (kind, user_id, conversation_id)
+    if key in _SUMMARY_PENDING:
+        return
+    _SUMMARY_PENDING.add(key)
+    try:
+        conv = await asyncio.to_thread(_conversation_record, kind, user_id, conversation_id)
+        if conv is None:
+            return
+        done = int(conv.get("summary_upto") or 0)
+        upto = int(conv.get("window_start") or 0)
+        if upto <= done:
+            return
+        previous = conv.get("summary") or ""
+        turns = await asyncio.to_thread(_STORE.messages, "social" if kind == "social" else "chat", user_id, conversation_id, done, upto - done)
+        text = ""
+        if _tier_llm(tier) is not None:
+            try:
+                text = await _run_inference(tier, _summarize_turns, tier, previous, turns, priority="background", user=user_id, cost=_chat_cost(turns, HISTORY_SUMMARY_MAX_TOKENS))
+            except Exception:
+                text = ""
+        if not text:
+            text = _extractive_summary(previous, turns)
+        conv = await asyncio.to_thread(_conversation_record, kind, user_id, conversation_id)
+        if conv is not None and int(conv.get("summary_upto") or 0) == done:
+            _watch_store_write(_STORE.update("social" if kind == "social" else "chat", user_id, conversation_id, summary=text, summary_upto=upto, summary_updated_at=datetime.datetime.utcnow().isoformat()), "summary update")
+            _append_runtime_event({"type": "history_summarized", "kind": kind, "conversation_id": conversation_id, "upto": upto, "ts": datetime.datetime.utcnow().isoformat()})
+    finally:
+        _SUMMARY_PENDING.discard(key)
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE", "1").strip().lower() not in ("0", "false", "off")
+ANSWER_CACHE_EMBED_MODEL = os.environ.get("ANSWER_CACHE_EMBED_MODEL", "bkai-foundation-models/vietnamese-bi-encoder")
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.92"))
+ANSWER_CACHE_TTL_S = int(os.environ.get("ANSWER_CACHE_TTL_S", "21600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+def _normalize_question(text: str) -> str:
+    import unicodedata
+    t = unicodedata.normalize("NFC", str(text or "")).lower()
+    t = " ".join(t.split())
+    return t.strip(" ?!.,;:")
+
+class _SemanticAnswerCache:
+    # Per-namespace answers keyed by normalised question. Exact repeats hit the
+    # dict directly; paraphrases go through a cosine search over unit-norm
+    # embeddings stacked into one matrix per namespace.
+    def __init__(self, max_entries: int, ttl_s: int, threshold: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.threshold = threshold
+        self.spaces = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _space(self, ns: str) -> dict:
+        space = self.spaces.get(ns)
+        if space is None:
+            space = {"entries": collections.OrderedDict(), "keys": [], "matrix": None}
+            self.spaces[ns] = space
+        return space
+
+    def _expire(self, space: dict, now: float):
+        entries = space["entries"]
+        dead = [k for k, e in entries.items() if e["expires"] <= now]
+        for k in dead:
+            del entries[k]
+        evicted = len(entries) - self.max_entries
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+        # Only a changed entry set invalidates the stacked matrix; entries
+        # stored without a vector stay out of it instead of forcing a rebuild.
+        if dead or evicted > 0:
+            space["matrix"] = None
+
+    def _matrix(self, space: dict):
+        if space["matrix"] is None:
+            keys = [k for k, e in space["entries"].items() if e["vec"] is not None]
+            space["keys"] = keys
+            space["matrix"] = np.stack([space["entries"][k]["vec"] for k in keys]) if keys else np.zeros((0, 1), dtype=np.float32)
+        return space["keys"], space["matrix"]
+
+    def get_exact(self, ns: str, key: str) -> Optional[dict]:
+        now = time.time()
+        with self.lock:
+            space = self._space(ns)
+            e = space["entries"].get(key)
+            if e is None or e["expires"] <= now:
+                return None
+            space["entries"].move_to_end(key)
+            e["hits"] += 1
+            self.hits += 1
+            return e
+
+    def get_similar(self, ns: str, vec) -> Optional[dict]:
+        now = time.time()
+        with self.lock:
+            space = self._space(ns)
+            self._expire(space, now)
+            keys, mat = self._matrix(space)
+            if not keys or mat.shape[1] != vec.shape[0]:
+                self.misses += 1
+                return None
+            sims = mat @ vec
+            i = int(sims.argmax())
+            if float(sims[i]) < self.threshold:
+                self.misses += 1
+                return None
+            e = space["entries"][keys[i]]
+            space["entries"].move_to_end(keys[i])
+            e["hits"] += 1
+            self.hits += 1
+            self.semantic_hits += 1
+            return e
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def put(self, ns: str, key: str, vec, answer: str, title: Optional[str] = None, meta: Optional[dict] = None):
+        with self.lock:
+            space = self._space(ns)
+            space["entries"][key] = {"vec": vec, "answer": answer, "title": title or "", "meta": meta or {}, "expires": time.time() + self.ttl_s, "hits": 0}
+            space["entries"].move_to_end(key)
+            space["matrix"] = None
+            self._expire(space, time.time())
+
+    def set_title(self, pending, title: str):
+        ns, key, _ = pending
+        with self.lock:
+            e = self.spaces.get(ns, {}).get("entries", {}).get(key)
+            if e is not None and not e["title"]:
+                e["title"] = title
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": ANSWER_CACHE_ENABLED,
+                "embedder": _ANSWER_EMBEDDER["state"],
+                "threshold": self.threshold,
+                "ttl_s": self.ttl_s,
+                "max_entries": self.max_entries,
+                "namespaces": {ns: len(sp["entries"]) for ns, sp in self.spaces.items()},
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+_ANSWER_CACHE = _SemanticAnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_S, ANSWER_CACHE_THRESHOLD)
+_ANSWER_EMBEDDER = {"state": "idle", "model": None}
+
+def _load_answer_embedder():
+    # Share the RAG module's bi-encoder when it is already up; otherwise load the
+    # same model once (LLM_CHAT picks this instance up when it initialises later).
+    model = getattr(rag_chat, "hf_embeddings", None)
+    if model is None:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        model = HuggingFaceEmbeddings(model_name=ANSWER_CACHE_EMBED_MODEL)
+    _ANSWER_EMBEDDER["model"] = model
+    _ANSWER_EMBEDDER["state"] = "ready"
+
+async def _ensure_answer_embedder():
+    try:
+        await _run_inference("embed", _load_answer_embedder)
     except Exception as e:
-        return {"error": str(e)}
+        _ANSWER_EMBEDDER["state"] = "unavailable"
+        _append_runtime_event({"type": "answer_cache_embedder_failed", "error": str(e), "ts": datetime.datetime.utcnow().isoformat()})
+
+def _embed_question(text: str):
+    vec = np.asarray(_ANSWER_EMBEDDER["model"].embed_query(text), dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+async def _answer_cache_lookup(ns: str, question: str):
+    # Returns (entry or None, pending) where pending is handed back to
+    # _answer_cache_store so the embedding is computed once per request.
+    if not ANSWER_CACHE_ENABLED or not question:
+        return None, None
+    key = _normalize_question(question)
+    if not key:
+        return None, None
+    entry = _ANSWER_CACHE.get_exact(ns, key)
+    if entry is not None:
+        return entry, None
+    vec = None
+    if np is not None:
+        if _ANSWER_EMBEDDER["state"] == "idle":
+            _ANSWER_EMBEDDER["state"] = "loading"
+            _spawn_background(_ensure_answer_embedder())
+        elif _ANSWER_EMBEDDER["state"] == "ready":
+            try:
+                vec = await _run_inference("embed", _embed_question, key)
+                entry = _ANSWER_CACHE.get_similar(ns, vec)
+                if entry is not None:
+                    return entry, None
+            except Exception:
+                vec = None
+    if vec is None:
+        _ANSWER_CACHE.miss()
+    return None, (ns, key, vec)
+
+def _answer_cache_store(pending, answer: str, title: Optional[str] = None, meta: Optional[dict] = None):
+    if pending is None or not answer or answer.startswith("Xin lỗi, tôi đang gặp sự cố kỹ thuật"):
+        return
+    ns, key, vec = pending
+    _ANSWER_CACHE.put(ns, key, vec, answer, title, meta)
+
+def _cacheable_question(history: List[dict], base_messages: List[dict], default_system: str) -> str:
+    # Only self-contained first turns under the stock system prompt are shared:
+    # follow-ups depend on the conversation and custom prompts change the answer.
+    if history:
+        return ""
+    users = [m for m in base_messages if m.get("role") == "user"]
+    others = [m for m in base_messages if m.get("role") not in ("user", "system")]
+    systems = [m for m in base_messages if m.get("role") == "system"]
+    if len(users) != 1 or others or any(str(m.get("content") or "").strip() != default_system.strip() for m in systems):
+        return ""
+    return str(users[0].get("content") or "")
+
+async def _finalize_chat_turn(user_id: str, conversation_id: str, base_messages: List[dict], content: str, social: bool = False, answer_pending=None, title: Optional[str] = None):
+    last_user = _last_user_message(base_messages)
+    to_save = []
+    if last_user:
+        to_save.append(last_user)
+    to_save.append({"role": "assistant", "content": content})
+    kind = "social" if social else "chat"
+    await asyncio.wrap_future(_STORE.append(kind, user_id, conversation_id, to_save))
+    conv = await asyncio.to_thread(_STORE.get, kind, user_id, conversation_id)
+    _answer_cache_store(answer_pending, content, (conv or {}).get("title") or title)
+    if conv and not conv.get("title"):
+        if title:
+            _watch_store_write(_STORE.update(kind, user_id, conversation_id, title=title), "title update")
+        else:
+            _queue_title("social" if social else "chat", user_id, conversation_id, last_user.get("content", "") if last_user else "", content, answer_pending, conv=conv)
+
+def _sse(data) -> str:
+    if isinstance(data, str):
+        return f"data: {data}\n\n"
+    return "data: " + json.dumps(data, ensure_ascii=False) + "\n\n"
+
+def _sse_response(gen) -> StreamingResponse:
+    return StreamingResponse(gen, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _sse_chunk(completion_id: str, content: Optional[str], finish_reason: Optional[str], meta: dict) -> dict:
+    delta = {"role": "assistant", "content": content} if content is not None else {}
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        **meta,
+    }
+
+async def _static_chat_stream(content: str, meta: dict):
+    yield _sse(_sse_chunk("local-static", content, None, meta))
+    yield _sse(_sse_chunk("local-static", None, "stop", meta))
+    yield _sse("[DONE]")
+
+async def _local_chat_stream(chunks, meta: dict, on_done):
+    # `chunks` comes from _stream_inference, so decoding stays on the model's worker
+    # thread. Persisting is spawned in the background so a client disconnect
+    # still records the partial answer.
+    parts = []
+    complete = False
+    try:
+        async for chunk in chunks:
+            delta = (chunk.get("choices") or [{}])[0].get("delta") or {}
+            if delta.get("content"):
+                parts.append(delta["content"])
+            yield _sse({**chunk, **meta})
+        complete = True
+    finally:
+        _spawn_background(on_done("".join(parts), complete))
+    yield _sse("[DONE]")
+
+async def _open_gpu_chat_stream(paths: List[str], payload: dict, mode_sel: str):
+    headers = _gpu_headers(mode_sel)
+    headers["Accept"] = "text/event-stream"
+    body = {**payload, "mode": mode_sel, "stream": True}
+    proxied = await _proxy_call([(path, body) for path in paths], headers, stream=True)
+    return proxied[1] if proxied is not None else None
+
+async def _gpu_chat_stream(resp, meta: dict, on_done):
+    parts = []
+    complete = False
+    try:
+        if "text/event-stream" not in resp.headers.get("Content-Type", ""):
+            # Backend ignored stream=true and answered with a plain JSON body.
+            await resp.aread()
+            data = resp.json()
+            if "choices" in data:
+                content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+            else:
+                content = str(data.get("reply", "")) or f"Xin lỗi, tôi đang gặp sự cố kỹ thuật: {data.get('error', 'Unknown error')}"
+            parts.append(content)
+            completion_id = str(data.get("id", "proxy"))
+            yield _sse(_sse_chunk(completion_id, content, None, meta))
+            yield _sse(_sse_chunk(completion_id, None, "stop", meta))
+        else:
+            async for line in resp.aiter_lines():
+                if not line or not line.startswith("data:"):
+                    continue
+                raw = line[5:].strip()
+                if raw == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(raw)
+                except Exception:
+                    continue
+                delta = (chunk.get("choices") or [{}])[0].get("delta") or {}
+                if delta.get("content"):
+                    parts.append(delta["content"])
+                yield _sse({**chunk, **meta})
+        complete = True
+    finally:
+        await _http_close(resp)
+        _spawn_background(on_done("".join(parts), complete))
+    yield _sse("[DONE]")
+
 @app.post("/v1/chat/completions")
 async def chat_completions(req: ChatRequest, request: Request):
     selected = (req.model or "flash").lower()
-    chosen_llm = None
-    if selected == "pro":
-        chosen_llm = llm_pro
-    else:
-        chosen_llm = llm_flash or llm_pro
 
     token_user = get_current_user(request)
     user_id = (token_user if token_user and token_user != "anonymous" else (req.user_id or "anonymous")).strip() or "anonymous"
@@ -726,18 +3979,34 @@ async def chat_completions(req: ChatRequest, request: Request):
     if not conversation_id:
         conversation_id = create_conversation(user_id)
 
-    history = load_chat_history(user_id, conversation_id)
+    history = await asyncio.to_thread(load_chat_history, user_id, conversation_id)
+    cache_key = ("chat", user_id, conversation_id)
     base_messages = [{"role": m.role, "content": m.content} for m in (req.messages or [])]
     if not base_messages:
-        default_sys = """Bạn là Trợ lý Y tế AI. Nhiệm vụ của bạn là cung cấp thông tin y tế hữu ích, chính xác và an toàn bằng Tiếng Việt.
-Lưu ý: Luôn khuyến cáo người dùng đi khám bác sĩ nếu có dấu hiệu nghiêm trọng. Không đưa ra chẩn đoán khẳng định thay thế bác sĩ."""
+        default_sys = MEDICAL_SYSTEM_PROMPT
         sys_msg = (req.system or default_sys).strip()
         user_text = (req.prompt or req.question or req.message or "").strip()
         if sys_msg:
             base_messages = [{"role": "system", "content": sys_msg}, {"role": "user", "content": user_text}]
         else:
             base_messages = [{"role": "user", "content": user_text}]
-    full_messages = history + base_messages
+    kind = "chat"
+    full_messages = await _plan_prompt("chat", user_id, conversation_id, history, base_messages, _inference_tier(selected), req.max_tokens)
+    answer_pending = None
+    question = _cacheable_question(history, base_messages, MEDICAL_SYSTEM_PROMPT)
+    if question:
+        cached, answer_pending = await _answer_cache_lookup("medical", question)
+        if cached is not None:
+            await _finalize_chat_turn(user_id, conversation_id, base_messages, cached["answer"], title=cached["title"])
+            meta = {"conversation_id": conversation_id, "mode_used": _current_target(), "cache": "hit"}
+            if req.stream:
+                return _sse_response(_static_chat_stream(cached["answer"], meta))
+            response = ChatResponse(
+                id="answer-cache",
+                choices=[ChatChoice(index=0, message=ChatMessage(role="assistant", content=cached["answer"]))],
+                conversation_id=conversation_id,
+            )
+            return {**response.dict(), **meta}
 
     try:
         _log_user = ""
@@ -750,66 +4019,44 @@ Lưu ý: Luôn khuyến cáo người dùng đi khám bác sĩ nếu có dấu h
     except Exception:
         pass
     target = _current_target()
+    if req.stream:
+        meta = {"conversation_id": conversation_id}
+        on_done = lambda content, complete=True: _finalize_chat_turn(user_id, conversation_id, base_messages, content, answer_pending=answer_pending if complete else None)
+        if target == "gpu":
+            payload = req.dict()
+            payload["messages"] = full_messages
+            mode_sel = "pro" if (req.model or "").lower() == "pro" else "flash"
+            proxied = await _open_gpu_chat_stream(["/v1/chat/completions", "/v1/chat"], payload, mode_sel)
+            if proxied is not None:
+                return _sse_response(_gpu_chat_stream(proxied, {**meta, "mode_used": "gpu", "mode_tier": mode_sel}, on_done))
+        tier = _inference_tier(selected)
+        just_loaded = await _run_inference(tier, ensure_text_model, tier, user=user_id)
+        if _tier_llm(tier) is not None:
+            meta.update({"mode_used": "cpu", **({"model_init": True} if just_loaded else {})})
+            flight = _flight_key(kind, tier, full_messages, req.temperature, req.max_tokens, bool(req.deterministic))
+            chunks = _coalesced_stream(flight, lambda: _stream_inference(tier, _chat_chunks, tier, full_messages, req.temperature, req.max_tokens, cache_key, user=user_id, cost=_chat_cost(full_messages, req.max_tokens)))
+            return _sse_response(_local_chat_stream(chunks, meta, on_done))
+        return _sse_response(_static_chat_stream("Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau.", meta))
     if target == "gpu":
         try:
             payload = req.dict()
             payload["messages"] = full_messages
-            base = _get_proxy_base()
-            headers = {"Content-Type": "application/json", "ngrok-skip-browser-warning": "true"}
-            auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
-            if auth:
-                headers["Authorization"] = auth
             mode_sel = "pro" if (req.model or "").lower() == "pro" else "flash"
-            headers["X-Mode"] = mode_sel
+            headers = _gpu_headers(mode_sel)
             payload["mode"] = mode_sel
-            proxied = requests.post(
-                f"{base.rstrip('/')}/v1/chat/completions",
-                headers=headers,
-                data=json.dumps(payload),
-                timeout=60,
-            )
-            if not proxied.ok:
-                fallback = requests.post(
-                    f"{base.rstrip('/')}/v1/chat",
-                    headers=headers,
-                    data=json.dumps({"messages": payload["messages"], "mode": mode_sel}),
-                    timeout=60,
-                )
-                if fallback.ok:
-                    proxied_data = fallback.json()
-                else:
-                    alt = requests.post(
-                        f"{base.rstrip('/')}/v1/chat/completions",
-                        headers=headers,
-                        data=json.dumps(payload),
-                        timeout=60,
-                    )
-                    if alt.ok:
-                        proxied_data = alt.json()
-                    else:
-                        proxied.raise_for_status()
-                        proxied_data = proxied.json()
-            else:
-                proxied_data = proxied.json()
+            proxied = await _proxy_call([
+                ("/v1/chat/completions", payload),
+                ("/v1/chat", {"messages": payload["messages"], "mode": mode_sel}),
+            ], headers)
+            if proxied is None:
+                raise RuntimeError("no GPU backend answered within the deadline")
+            proxied_data = proxied[1].json()
             content = ""
             if "choices" in proxied_data:
                 content = proxied_data.get("choices", [{}])[0].get("message", {}).get("content", "")
             else:
                 content = str(proxied_data.get("reply", "")) or f"Xin lỗi, tôi đang gặp sự cố kỹ thuật: {proxied_data.get('error', 'Unknown error')}"
-            last_user = None
-            for m in reversed(base_messages):
-                if m["role"] == "user":
-                    last_user = {"role": "user", "content": m["content"]}
-                    break
-            to_save = []
-            if last_user:
-                to_save.append(last_user)
-            to_save.append({"role": "assistant", "content": content})
-            save_chat_history(user_id, conversation_id, to_save)
-            conv = MOCK_CHAT_DB.get(user_id, {}).get("conversations", {}).get(conversation_id)
-            if conv and not conv.get("title"):
-                title = generate_auto_title(last_user.get("content", "") if last_user else "", content)
-                conv["title"] = title
+            await _finalize_chat_turn(user_id, conversation_id, base_messages, content, answer_pending=answer_pending)
             response = ChatResponse(
                 id=str(proxied_data.get("id", "proxy")),
                 choices=[ChatChoice(index=0, message=ChatMessage(role="assistant", content=content))],
@@ -827,35 +4074,12 @@ Lưu ý: Luôn khuyến cáo người dùng đi khám bác sĩ nếu có dấu h
         except Exception:
             pass
 
-    just_loaded = False
-    if chosen_llm is None:
-        just_loaded = ensure_text_model(selected)
-        if selected == "pro":
-            chosen_llm = llm_pro
-        else:
-            chosen_llm = llm_flash or llm_pro
-
-    if chosen_llm is not None:
-        result = chosen_llm.create_chat_completion(
-            messages=full_messages,
-            temperature=req.temperature,
-            max_tokens=req.max_tokens,
-        )
+    tier = _inference_tier(selected)
+    flight = _flight_key(kind, tier, full_messages, req.temperature, req.max_tokens, bool(req.deterministic))
+    just_loaded, result = await _single_flight(flight, lambda: _run_inference(tier, _complete_chat, tier, full_messages, req.temperature, req.max_tokens, cache_key, user=user_id, cost=_chat_cost(full_messages, req.max_tokens)))
+    if result is not None:
         content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-        last_user = None
-        for m in reversed(base_messages):
-            if m.get("role") == "user":
-                last_user = {"role": "user", "content": m.get("content", "")}
-                break
-        to_save = []
-        if last_user:
-            to_save.append(last_user)
-        to_save.append({"role": "assistant", "content": content})
-        save_chat_history(user_id, conversation_id, to_save)
-        conv = MOCK_CHAT_DB.get(user_id, {}).get("conversations", {}).get(conversation_id)
-        if conv and not conv.get("title"):
-            title = generate_auto_title(last_user.get("content", "") if last_user else "", content)
-            conv["title"] = title
+        await _finalize_chat_turn(user_id, conversation_id, base_messages, content, answer_pending=answer_pending)
         response = ChatResponse(
             id=str(result.get("id", "local-llama")),
             choices=[ChatChoice(index=0, message=ChatMessage(role="assistant", content=content))],
@@ -876,90 +4100,76 @@ Lưu ý: Luôn khuyến cáo người dùng đi khám bác sĩ nếu có dấu h
 @app.post("/v1/friend-chat/completions")
 async def friend_chat_completions(req: ChatRequest, request: Request):
     selected = (req.model or "flash").lower()
-    chosen_llm = None
-    if selected == "pro":
-        chosen_llm = llm_pro
-    else:
-        chosen_llm = llm_flash or llm_pro
     token_user = get_current_user(request)
     user_id = (token_user if token_user and token_user != "anonymous" else (req.user_id or "anonymous")).strip() or "anonymous"
     conversation_id = req.conversation_id or None
     if not conversation_id:
         conversation_id = create_social_conversation(user_id)
-    history = load_social_history(user_id, conversation_id)
-    friend_prompt = (
-        "Bạn là một người bạn thân, nói chuyện đời thường bằng tiếng Việt.\n"
-        "Cách nói tự nhiên, gần gũi, có thể hài hước nhẹ, dùng từ ngữ bình dân.\n\n"
-        "Nguyên tắc:\n"
-        "- Ưu tiên lắng nghe và đồng cảm trước.\n"
-        "- Không giảng đạo lý, không nói như sách vở.\n"
-        "- Không khuyên dạy ngay, trừ khi người dùng hỏi rõ.\n"
-        "- Phản hồi giống người thật đang trò chuyện, không phải trợ lý máy móc.\n"
-        "- Có thể hỏi lại 1 câu ngắn để hiểu thêm cảm xúc người nói.\n\n"
-        "Tránh:\n"
-        "- Nói quá dài.\n"
-        "- Dùng từ ngữ học thuật.\n"
-        "- Kết luận thay người dùng.\n"
-    )
+    history = await asyncio.to_thread(load_social_history, user_id, conversation_id)
+    cache_key = ("social", user_id, conversation_id)
+    friend_prompt = FRIEND_SYSTEM_PROMPT
     base_messages = [{"role": m.role, "content": m.content} for m in (req.messages or [])]
     if not base_messages:
         user_text = (req.prompt or req.question or req.message or "").strip()
         base_messages = [{"role": "system", "content": friend_prompt}, {"role": "user", "content": user_text}]
     else:
         base_messages = [{"role": "system", "content": friend_prompt}] + base_messages
-    full_messages = history + base_messages
+    kind = "social"
+    full_messages = await _plan_prompt("social", user_id, conversation_id, history, base_messages, _inference_tier(selected), req.max_tokens)
+    answer_pending = None
+    question = _cacheable_question(history, base_messages, FRIEND_SYSTEM_PROMPT)
+    if question:
+        cached, answer_pending = await _answer_cache_lookup("friend", question)
+        if cached is not None:
+            await _finalize_chat_turn(user_id, conversation_id, base_messages, cached["answer"], social=True, title=cached["title"])
+            meta = {"conversation_id": conversation_id, "mode_used": _current_target(), "cache": "hit"}
+            if req.stream:
+                return _sse_response(_static_chat_stream(cached["answer"], meta))
+            response = ChatResponse(
+                id="answer-cache",
+                choices=[ChatChoice(index=0, message=ChatMessage(role="assistant", content=cached["answer"]))],
+                conversation_id=conversation_id,
+            )
+            return {**response.dict(), **meta}
     target = _current_target()
+    if req.stream:
+        meta = {"conversation_id": conversation_id}
+        on_done = lambda content, complete=True: _finalize_chat_turn(user_id, conversation_id, base_messages, content, social=True, answer_pending=answer_pending if complete else None)
+        if target == "gpu":
+            payload = req.dict()
+            payload["messages"] = full_messages
+            mode_sel = "pro" if (req.model or "").lower() == "pro" else "flash"
+            proxied = await _open_gpu_chat_stream(["/v1/friend-chat/completions", "/v1/chat/completions"], payload, mode_sel)
+            if proxied is not None:
+                return _sse_response(_gpu_chat_stream(proxied, {**meta, "mode_used": "gpu"}, on_done))
+        tier = _inference_tier(selected)
+        just_loaded = await _run_inference(tier, ensure_text_model, tier, user=user_id)
+        if _tier_llm(tier) is not None:
+            meta.update({"mode_used": "cpu", **({"model_init": True} if just_loaded else {})})
+            flight = _flight_key(kind, tier, full_messages, req.temperature, req.max_tokens, bool(req.deterministic))
+            chunks = _coalesced_stream(flight, lambda: _stream_inference(tier, _chat_chunks, tier, full_messages, req.temperature, req.max_tokens, cache_key, user=user_id, cost=_chat_cost(full_messages, req.max_tokens)))
+            return _sse_response(_local_chat_stream(chunks, meta, on_done))
+        return _sse_response(_static_chat_stream("Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau.", meta))
     if target == "gpu":
         try:
             payload = req.dict()
             payload["messages"] = full_messages
-            base = _get_proxy_base()
-            headers = {"Content-Type": "application/json", "ngrok-skip-browser-warning": "true"}
-            auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
-            if auth:
-                headers["Authorization"] = auth
             mode_sel = "pro" if (req.model or "").lower() == "pro" else "flash"
-            headers["X-Mode"] = mode_sel
+            headers = _gpu_headers(mode_sel)
             payload["mode"] = mode_sel
-            proxied = requests.post(
-                f"{base.rstrip('/')}/v1/friend-chat/completions",
-                headers=headers,
-                data=json.dumps(payload),
-                timeout=60,
-            )
-            if not proxied.ok:
-                fallback = requests.post(
-                    f"{base.rstrip('/')}/v1/chat/completions",
-                    headers=headers,
-                    data=json.dumps({"messages": payload["messages"], "mode": mode_sel}),
-                    timeout=60,
-                )
-                if fallback.ok:
-                    proxied_data = fallback.json()
-                else:
-                    proxied.raise_for_status()
-                    proxied_data = proxied.json()
-            else:
-                proxied_data = proxied.json()
+            proxied = await _proxy_call([
+                ("/v1/friend-chat/completions", payload),
+                ("/v1/chat/completions", {"messages": payload["messages"], "mode": mode_sel}),
+            ], headers)
+            if proxied is None:
+                raise RuntimeError("no GPU backend answered within the deadline")
+            proxied_data = proxied[1].json()
             content = ""
             if "choices" in proxied_data:
                 content = proxied_data.get("choices", [{}])[0].get("message", {}).get("content", "")
             else:
                 content = str(proxied_data.get("reply", "")) or f"Xin lỗi, tôi đang gặp sự cố kỹ thuật: {proxied_data.get('error', 'Unknown error')}"
-            last_user = None
-            for m in reversed(base_messages):
-                if m["role"] == "user":
-                    last_user = {"role": "user", "content": m["content"]}
-                    break
-            to_save = []
-            if last_user:
-                to_save.append(last_user)
-            to_save.append({"role": "assistant", "content": content})
-            save_social_history(user_id, conversation_id, to_save)
-            conv = MOCK_SOCIAL_DB.get(user_id, {}).get("conversations", {}).get(conversation_id)
-            if conv and not conv.get("title"):
-                title = generate_auto_title(last_user.get("content", "") if last_user else "", content)
-                conv["title"] = title
+            await _finalize_chat_turn(user_id, conversation_id, base_messages, content, social=True, answer_pending=answer_pending)
             return {
                 "id": str(proxied_data.get("id", "proxy")),
                 "object": "chat.completion",
@@ -969,34 +4179,12 @@ async def friend_chat_completions(req: ChatRequest, request: Request):
             }
         except Exception:
             pass
-    just_loaded = False
-    if chosen_llm is None:
-        just_loaded = ensure_text_model(selected)
-        if selected == "pro":
-            chosen_llm = llm_pro
-        else:
-            chosen_llm = llm_flash or llm_pro
-    if chosen_llm is not None:
-        result = chosen_llm.create_chat_completion(
-            messages=full_messages,
-            temperature=req.temperature,
-            max_tokens=req.max_tokens,
-        )
+    tier = _inference_tier(selected)
+    flight = _flight_key(kind, tier, full_messages, req.temperature, req.max_tokens, bool(req.deterministic))
+    just_loaded, result = await _single_flight(flight, lambda: _run_inference(tier, _complete_chat, tier, full_messages, req.temperature, req.max_tokens, cache_key, user=user_id, cost=_chat_cost(full_messages, req.max_tokens)))
+    if result is not None:
         content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-        last_user = None
-        for m in reversed(base_messages):
-            if m.get("role") == "user":
-                last_user = {"role": "user", "content": m.get("content", "")}
-                break
-        to_save = []
-        if last_user:
-            to_save.append(last_user)
-        to_save.append({"role": "assistant", "content": content})
-        save_social_history(user_id, conversation_id, to_save)
-        conv = MOCK_SOCIAL_DB.get(user_id, {}).get("conversations", {}).get(conversation_id)
-        if conv and not conv.get("title"):
-            title = generate_auto_title(last_user.get("content", "") if last_user else "", content)
-            conv["title"] = title
+        await _finalize_chat_turn(user_id, conversation_id, base_messages, content, social=True, answer_pending=answer_pending)
         return {
             "id": str(result.get("id", "local-llama")),
             "object": "chat.completion",
@@ -1013,16 +4201,14 @@ async def vision_multi(req: VisionMultiRequest):
     auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
     if auth:
         headers["Authorization"] = auth
-    r = requests.post(f"{base.rstrip('/')}/v1/vision-multi", headers=headers, data=json.dumps(req.dict()), timeout=60)
-    r.raise_for_status()
+    async with _balanced_call(base):
+        r = await _http_send("POST", f"{base.rstrip('/')}/v1/vision-multi", headers=headers, content=json.dumps(req.dict()), timeout=60)
+        r.raise_for_status()
     data = r.json()
     try:
-        gm = requests.get(f"{base.rstrip('/')}/gpu/metrics", headers={"ngrok-skip-browser-warning": "true"}, timeout=5)
-        if gm.ok:
-            v = gm.json()
-            pdir = _front_data_dir()
-            with open(os.path.join(pdir, "runtime-events.jsonl"), "a", encoding="utf-8") as f:
-                f.write(json.dumps({"type": "gpu_metrics", "endpoint": "vision-multi", "data": v, "ts": datetime.datetime.utcnow().isoformat()}) + "\n")
+        gm = await _http_send("GET", f"{base.rstrip('/')}/gpu/metrics", headers={"ngrok-skip-browser-warning": "true"}, timeout=5)
+        if gm.is_success:
+            _append_runtime_event({"type": "gpu_metrics", "endpoint": "vision-multi", "data": gm.json(), "ts": datetime.datetime.utcnow().isoformat()})
     except Exception:
         pass
     return data
@@ -1034,11 +4220,19 @@ async def tts_stream(req: TextToSpeechStreamRequest):
     auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
     if auth:
         headers["Authorization"] = auth
-    def gen():
-        with requests.post(f"{base.rstrip('/')}/v1/tts/stream", headers=headers, data=json.dumps(req.dict()), timeout=120, stream=True) as resp:
-            for chunk in resp.iter_content(chunk_size=1024):
+    async def gen():
+        async with _balanced_call(base):
+            resp = await _http_send("POST", f"{base.rstrip('/')}/v1/tts/stream", headers=headers, content=json.dumps(req.dict()), timeout=120, stream=True)
+            if resp.status_code >= 500:
+                # A 5xx is a backend failure, not a fast healthy response.
+                await _http_close(resp)
+                resp.raise_for_status()
+        try:
+            async for chunk in resp.aiter_bytes(chunk_size=1024):
                 if chunk:
                     yield chunk
+        finally:
+            await _http_close(resp)
     return StreamingResponse(gen(), media_type="audio/mpeg")
 
 @app.post("/v1/stt/stream")
@@ -1049,12 +4243,20 @@ async def stt_stream(file: UploadFile = File(...)):
     if auth:
         headers["Authorization"] = auth
     content = await file.read()
-    def gen():
-        with requests.post(f"{base.rstrip('/')}/v1/stt/stream", headers=headers, files={"file": (file.filename or "audio.wav", content, "audio/wav")}, timeout=120, stream=True) as resp:
-            for line in resp.iter_lines():
+    async def gen():
+        async with _balanced_call(base):
+            resp = await _http_send("POST", f"{base.rstrip('/')}/v1/stt/stream", headers=headers, files={"file": (file.filename or "audio.wav", content, "audio/wav")}, timeout=120, stream=True)
+            if resp.status_code >= 500:
+                # A 5xx is a backend failure, not a fast healthy response.
+                await _http_close(resp)
+                resp.raise_for_status()
+        try:
+            async for line in resp.aiter_lines():
                 if not line:
                     continue
-                yield line + b"\n"
+                yield (line + "\n").encode("utf-8")
+        finally:
+            await _http_close(resp)
     return StreamingResponse(gen(), media_type="application/json")
 
 @app.get("/gpu/metrics")
@@ -1065,8 +4267,8 @@ async def gpu_metrics():
     if auth:
         headers["Authorization"] = auth
     try:
-        r = requests.get(f"{base.rstrip('/')}/gpu/metrics", headers=headers, timeout=10)
-        if r.ok:
+        r = await _http_send("GET", f"{base.rstrip('/')}/gpu/metrics", headers=headers, timeout=10)
+        if r.is_success:
             return r.json()
     except Exception:
         pass
@@ -1089,6 +4291,19 @@ async def gpu_metrics():
         pass
     return data
 
+async def _save_lookup_turn(req: HealthLookupRequest, question: str, answer: str) -> str:
+    user_id = (req.user_id or "anonymous").strip() or "anonymous"
+    conversation_id = req.conversation_id or create_conversation(user_id)
+    try:
+        await asyncio.wrap_future(save_chat_history(user_id, conversation_id, [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer}
+        ]))
+    except Exception as e:
+        # The answer is still returned; only its history entry is lost.
+        print(f"Health lookup history save failed: {e}")
+    return conversation_id
+
 @app.post("/v1/health-lookup")
 async def health_lookup(req: HealthLookupRequest):
     """
@@ -1120,12 +4335,15 @@ async def health_lookup(req: HealthLookupRequest):
 
     def _llm_classify_query_local(q: str) -> str:
         try:
-            model = llm_pro or llm_flash
+            tier = "pro" if llm_pro is not None else "flash"
+            model = _bound_llm(tier)
             if model is None:
                 return ""
-            prompt = "Chỉ trả lời một từ: 'thuốc' hoặc 'bệnh' hoặc 'triệu chứng' hoặc 'không liên quan'. Truy vấn: " + (q or "").strip()
+            prompt = LOOKUP_CLASSIFY_PROMPT + (q or "").strip()
             try:
-                res = model.create_chat_completion(messages=[{"role": "user", "content": prompt}], temperature=0, max_tokens=4)
+                messages = [{"role": "user", "content": prompt}]
+                _kv_restore(model, tier, None, messages)
+                res = model.create_chat_completion(messages=messages, temperature=0, max_tokens=4)
                 msg = str(res.get("choices", [{}])[0].get("message", {}).get("content", "")).strip().lower()
                 return msg
             except Exception:
@@ -1135,8 +4353,26 @@ async def health_lookup(req: HealthLookupRequest):
         except Exception:
             return ""
 
+    # Lookups are stateless, so a repeat is answered from the cache before the
+    # LLM classifier queues on the inference worker. Entries carry the
+    # classification verdict, so out-of-scope repeats still get redirected.
+    cached, lookup_pending = await _answer_cache_lookup("lookup:" + (req.mode or "auto").lower(), req.query)
+    if cached is not None:
+        meta = cached.get("meta") or {}
+        if meta.get("is_medical") is False:
+            return HealthLookupResponse(success=True, response=cached["answer"], mode=target, redirect_url="/tu-van", cached=True)
+        conversation_id = await _save_lookup_turn(req, req.query.strip(), cached["answer"])
+        return HealthLookupResponse(success=True, response=cached["answer"], conversation_id=conversation_id, mode=target, cached=True)
+
     cls = _classify_query(req.query)
-    label = _llm_classify_query_local(req.query)
+    label = ""
+    if llm_pro is not None or llm_flash is not None:
+        try:
+            classify_tier = "pro" if llm_pro is not None else "flash"
+            flight = _flight_key("classify", classify_tier, [{"role": "user", "content": req.query}], 0, 4)
+            label = await _single_flight(flight, lambda: _run_inference(classify_tier, _llm_classify_query_local, req.query, priority="lookup", user=req.user_id))
+        except HTTPException:
+            label = ""
     if "thuốc" in label:
         cls = {"mode": "drug", "is_medical": True}
     elif "bệnh" in label:
@@ -1147,22 +4383,21 @@ async def health_lookup(req: HealthLookupRequest):
         cls = {"mode": None, "is_medical": False}
     if not cls.get("is_medical"):
         msg = "Câu hỏi không liên quan đến y tế. Vui lòng truy cập trang tư vấn để đặt câu hỏi phù hợp."
+        _answer_cache_store(lookup_pending, msg, meta={"mode": cls.get("mode"), "is_medical": False})
         return HealthLookupResponse(success=True, response=msg, mode=target, redirect_url="/tu-van")
 
     inferred_mode = (req.mode or cls.get("mode") or "").lower()
+    lookup_meta = {"mode": inferred_mode or None, "is_medical": True}
     if target == "gpu":
         try:
-            base = _get_proxy_base()
-            headers = {"Content-Type": "application/json", "ngrok-skip-browser-warning": "true"}
-            auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
-            if auth:
-                headers["Authorization"] = auth
             body = req.dict()
             if not body.get("mode") and inferred_mode:
                 body["mode"] = inferred_mode
-            r = requests.post(f"{base.rstrip('/')}/v1/health-lookup", headers=headers, data=json.dumps(body), timeout=60)
-            if r.ok:
-                data = r.json()
+            proxied = await _proxy_call([("/v1/health-lookup", body)], _gpu_headers())
+            if proxied is not None:
+                data = proxied[1].json()
+                if data.get("success", True) and not data.get("redirect_url"):
+                    _answer_cache_store(lookup_pending, str(data.get("response") or ""), meta=lookup_meta)
                 return HealthLookupResponse(
                     success=bool(data.get("success", True)),
                     response=data.get("response"),
@@ -1257,21 +4492,11 @@ async def health_lookup(req: HealthLookupRequest):
         # Không có mode: trả cái nào khớp trước
         if disease_match:
             text = f"Bệnh: {disease_match.get('name','')}\n" + format_disease(disease_match)
-            user_id = (req.user_id or "anonymous").strip() or "anonymous"
-            conversation_id = req.conversation_id or create_conversation(user_id)
-            save_chat_history(user_id, conversation_id, [
-                {"role": "user", "content": req.query.strip()},
-                {"role": "assistant", "content": text}
-            ])
+            conversation_id = await _save_lookup_turn(req, req.query.strip(), text)
             return HealthLookupResponse(success=True, response=text, conversation_id=conversation_id, mode=target)
         if drug_match:
             text = f"Thuốc: {drug_match.get('name','')}\n" + (format_drug(drug_match) if drug_match.get("uses") or drug_match.get("dosage") else (drug_match.get("notes") or ""))
-            user_id = (req.user_id or "anonymous").strip() or "anonymous"
-            conversation_id = req.conversation_id or create_conversation(user_id)
-            save_chat_history(user_id, conversation_id, [
-                {"role": "user", "content": req.query.strip()},
-                {"role": "assistant", "content": text}
-            ])
+            conversation_id = await _save_lookup_turn(req, req.query.strip(), text)
             return HealthLookupResponse(success=True, response=text, conversation_id=conversation_id, mode=target)
     except Exception as e:
         # Không chặn tiến trình; sẽ fallback RAG
@@ -1281,28 +4506,17 @@ async def health_lookup(req: HealthLookupRequest):
     if rag_chat is None:
         try:
             from RAG.RAG_QA import LLM_CHAT
-            rag_chat = LLM_CHAT()
+            rag_chat = LLM_CHAT(embeddings=_ANSWER_EMBEDDER["model"])
         except Exception as e:
             try:
                 import sys, subprocess
                 subprocess.run([sys.executable, "-m", "pip", "install", "langchain-community", "chromadb", "llama-index", "llama-index-vector-stores-chroma", "llama-index-embeddings-langchain", "langchain-openai", "sentence-transformers"], check=True)
                 from RAG.RAG_QA import LLM_CHAT
-                rag_chat = LLM_CHAT()
+                rag_chat = LLM_CHAT(embeddings=_ANSWER_EMBEDDER["model"])
             except Exception as e2:
                 return HealthLookupResponse(success=False, error=f"Không thể khởi tạo RAG: {str(e2)}")
 
-    safety_disclaimer = (
-        "Thông tin chỉ mang tính tham khảo, không thay thế tư vấn bác sĩ. "
-        "Luôn cân nhắc cơ địa, bệnh nền, tương tác thuốc và chống chỉ định. "
-        "Khuyến khích người dùng hỏi ý kiến chuyên gia y tế cho quyết định điều trị."
-    )
-
-    format_guide = (
-        "\n\nĐỊNH DẠNG TRẢ LỜI:\n"
-        "📋 Thông tin chính:\n- Định nghĩa/Mô tả\n- Nguyên nhân chính\n- Triệu chứng thường gặp\n"
-        "\n🔍 Chi tiết:\n- Cách chẩn đoán\n- Phương pháp điều trị\n- Biến chứng có thể xảy ra\n"
-        "\n⚠️ Lưu ý quan trọng:\n- Khi nào cần đến bác sĩ\n- Dấu hiệu cảnh báo\n"
-    )
+    safety_disclaimer = LOOKUP_SAFETY_DISCLAIMER
 
     medication_focus = "\nNếu là thuốc: thêm Liều dùng phổ biến, Tác dụng phụ, Tương tác, Chống chỉ định."
 
@@ -1315,34 +4529,22 @@ async def health_lookup(req: HealthLookupRequest):
         elif req.mode.lower() == "symptom":
             mode_hint = "\nTrọng tâm: Triệu chứng."
 
-    system_prompt = (
-        "Bạn là cơ sở dữ liệu y khoa an toàn và chính xác. "
-        + safety_disclaimer
-        + format_guide
-        + mode_hint
-    )
+    system_prompt = LOOKUP_SYSTEM_PROMPT + mode_hint
     user_query = req.query.strip()
 
     try:
-        answer_text = rag_chat.answer_with_system_prompt(system_prompt, user_query)
-        user_id = (req.user_id or "anonymous").strip() or "anonymous"
-        conversation_id = req.conversation_id or create_conversation(user_id)
-        save_chat_history(user_id, conversation_id, [
-            {"role": "user", "content": user_query},
-            {"role": "assistant", "content": answer_text}
-        ])
+        # Concurrent identical lookups share one RAG generation.
+        flight = _flight_key("lookup", "rag", [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_query}], 0, None)
+        answer_text = await _single_flight(flight, lambda: asyncio.to_thread(rag_chat.answer_with_system_prompt, system_prompt, user_query))
+        _answer_cache_store(lookup_pending, answer_text, meta=lookup_meta)
+        conversation_id = await _save_lookup_turn(req, user_query, answer_text)
         return HealthLookupResponse(success=True, response=answer_text, conversation_id=conversation_id, mode=target)
     except Exception as e:
         fallback_text = (
             "Hệ thống tra cứu đang gặp sự cố kết nối LLM. Dưới đây là hướng dẫn chung:\n"
             + safety_disclaimer
         )
-        user_id = (req.user_id or "anonymous").strip() or "anonymous"
-        conversation_id = req.conversation_id or create_conversation(user_id)
-        save_chat_history(user_id, conversation_id, [
-            {"role": "user", "content": user_query},
-            {"role": "assistant", "content": fallback_text}
-        ])
+        conversation_id = await _save_lookup_turn(req, user_query, fallback_text)
         return HealthLookupResponse(success=True, response=fallback_text, conversation_id=conversation_id, mode=target)
 
 @app.get("/v1/benh")
@@ -1532,15 +4734,15 @@ async def text_to_speech_stream(text: str, lang: str = "vi"):
             auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
             if auth:
                 headers["Authorization"] = auth
-            def gen():
+            async def gen():
                 try:
                     import base64 as pybase64
-                    with requests.post(f"{base.rstrip('/')}/v1/tts/stream", headers=headers, data=json.dumps({"text": text, "lang": lang}), timeout=300, stream=True) as resp:
-                        for line in resp.iter_lines():
+                    async with _http_stream("POST", f"{base.rstrip('/')}/v1/tts/stream", headers=headers, content=json.dumps({"text": text, "lang": lang}), timeout=300) as resp:
+                        async for line in resp.aiter_lines():
                             if not line:
                                 continue
                             try:
-                                obj = json.loads(line.decode("utf-8"))
+                                obj = json.loads(line)
                                 b64 = obj.get("audio_base64")
                                 if isinstance(b64, str) and b64:
                                     yield pybase64.b64decode(b64)
@@ -1979,20 +5181,20 @@ async def vision_chat(req: VisionChatRequest):
         auth = os.environ.get("LLAMA_SERVER_AUTH", "").strip()
         if auth:
             headers["Authorization"] = auth
-        gpu_try_1 = requests.post(f"{base.rstrip('/')}/v1/vision-chat", headers=headers, data=json.dumps(req.dict()), timeout=60)
-        if gpu_try_1.ok:
+        gpu_try_1 = await _http_send("POST", f"{base.rstrip('/')}/v1/vision-chat", headers=headers, content=json.dumps(req.dict()), timeout=60)
+        if gpu_try_1.is_success:
             _append_runtime_event({"type": "vision_mode_used", "mode": "gpu", "endpoint": "vision-chat", "ts": datetime.datetime.utcnow().isoformat()})
             data = gpu_try_1.json()
             return VisionChatResponse(success=bool(data.get("success", True)), response=data.get("response"), error=data.get("error"))
         gpu_payload = {"text": req.text, "images_base64": [req.image_base64], "model_id": "5CD-AI/Vintern-3B-R-beta"}
-        gpu_try_2 = requests.post(f"{base.rstrip('/')}/v1/vision-multi", headers=headers, data=json.dumps(gpu_payload), timeout=60)
-        if gpu_try_2.ok:
+        gpu_try_2 = await _http_send("POST", f"{base.rstrip('/')}/v1/vision-multi", headers=headers, content=json.dumps(gpu_payload), timeout=60)
+        if gpu_try_2.is_success:
             _append_runtime_event({"type": "vision_mode_used", "mode": "gpu", "endpoint": "vision-multi", "ts": datetime.datetime.utcnow().isoformat()})
             data = gpu_try_2.json()
             return VisionChatResponse(success=bool(data.get("success", True)), response=data.get("response"), error=data.get("error"))
     except Exception:
         pass
-    just_loaded = ensure_vlm_model()
+    just_loaded = await _run_inference("vlm", ensure_vlm_model)
     if vlm_llm is None:
         return VisionChatResponse(success=False, error="VLM model not available")
     try:
@@ -2010,13 +5212,23 @@ async def vision_chat(req: VisionChatRequest):
                 ]
             }
         ]
-        response = vlm_llm.create_chat_completion(messages=messages, temperature=req.temperature, max_tokens=req.max_tokens)
+        response = await _run_inference("vlm", _vlm_complete, messages, req.temperature, req.max_tokens)
         response_text = response.get("choices", [{}])[0].get("message", {}).get("content", "")
         _append_runtime_event({"type": "vision_mode_used", "mode": "cpu", "endpoint": "local-vlm", "model_init": bool(just_loaded), "ts": datetime.datetime.utcnow().isoformat()})
         return VisionChatResponse(success=True, response=response_text)
+    except HTTPException:
+        raise
     except Exception as e:
         return VisionChatResponse(success=False, error=f"Error processing vision chat: {str(e)}")
 
+def _vlm_complete(messages: List[dict], temperature: Optional[float], max_tokens: Optional[int]):
+    # Reloads if the residency manager evicted the VLM since ensure_vlm_model ran.
+    ensure_vlm_model()
+    llm = vlm_llm
+    if llm is None:
+        raise RuntimeError("VLM model not available")
+    return llm.create_chat_completion(messages=messages, temperature=temperature, max_tokens=max_tokens)
+
 def _extract_text_from_doc(doc_base64: str, doc_name: str) -> str:
     import base64
     import io
@@ -2053,7 +5265,7 @@ def _extract_text_from_doc(doc_base64: str, doc_name: str) -> str:
         return f"Error extracting text: {str(e)}"
 
 @app.post("/v1/document-chat")
-async def document_chat(req: DocumentChatRequest):
+async def document_chat(req: DocumentChatRequest, request: Request):
     if not req.doc_base64 or not req.text:
         raise HTTPException(status_code=400, detail="doc_base64 and text are required")
     
@@ -2065,7 +5277,7 @@ async def document_chat(req: DocumentChatRequest):
             print(f"Proxying document-chat to GPU: {gpu_url}")
             # Add ngrok-skip-browser-warning header
             headers = {"ngrok-skip-browser-warning": "true"}
-            resp = requests.post(gpu_url, json=req.dict(), headers=headers, timeout=120)
+            resp = await _http_send("POST", gpu_url, json=req.dict(), headers=headers, timeout=120)
             
             # DEBUG: Print GPU response for troubleshooting
             print(f"GPU Response Status: {resp.status_code}")
@@ -2074,7 +5286,7 @@ async def document_chat(req: DocumentChatRequest):
             except:
                 pass
 
-            if resp.ok:
+            if resp.is_success:
                 return resp.json()
             else:
                 # If GPU fails, fallback to local
@@ -2090,29 +5302,22 @@ async def document_chat(req: DocumentChatRequest):
     # Construct prompt
     full_prompt = f"Tài liệu đính kèm ({req.doc_name}):\n\n{doc_text}\n\n---\n\nCâu hỏi của người dùng: {req.text}"
     
-    # Delegate to chat/completions logic
+    # Generate directly on the inference worker: a document chat is one-shot, so
+    # it must not land in the caller's chat history, title queue or answer cache.
     try:
-        chat_req = ChatRequest(
-            model=req.model,
-            messages=[
-                ChatMessage(role="system", content="Bạn là trợ lý AI hữu ích. Hãy trả lời câu hỏi dựa trên tài liệu được cung cấp."),
-                ChatMessage(role="user", content=full_prompt)
-            ]
-        )
-        
-        # Use local loopback to reuse chat logic
-        local_url = "http://127.0.0.1:8000/v1/chat/completions"
-        resp = requests.post(local_url, json=chat_req.dict(), timeout=120)
-        
-        if resp.ok:
-            data = resp.json()
-            content = ""
-            if "choices" in data:
-                content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-            return VisionChatResponse(success=True, response=content)
-        else:
-            return VisionChatResponse(success=False, error=f"Chat error: {resp.text}")
+        messages = [
+            {"role": "system", "content": "Bạn là trợ lý AI hữu ích. Hãy trả lời câu hỏi dựa trên tài liệu được cung cấp."},
+            {"role": "user", "content": full_prompt},
+        ]
+        tier = _inference_tier((req.model or "flash").lower())
+        _, result = await _run_inference(tier, _complete_chat, tier, messages, 0.7, 512, user=get_current_user(request), cost=_chat_cost(messages, 512))
+        if result is None:
+            return VisionChatResponse(success=False, error="Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau.")
+        content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+        return VisionChatResponse(success=True, response=content)
             
+    except HTTPException:
+        raise
     except Exception as e:
         return VisionChatResponse(success=False, error=str(e))
 
@@ -2133,7 +5338,6 @@ async def login(req: LoginRequest):
             raise HTTPException(status_code=401, detail="Thông tin đăng nhập không hợp lệ")
     user_id = input_user.strip().lower()
     token = f"mock-{user_id}"
-    _ensure_user(user_id)
     return LoginResponse(user_id=user_id, token=token)
 
 @app.post("/v1/logout")
@@ -2179,7 +5383,7 @@ async def login_google(req: GoogleLoginRequest):
     if not token:
         raise HTTPException(status_code=400, detail="Thiếu id_token")
     try:
-        r = requests.get("https://oauth2.googleapis.com/tokeninfo", params={"id_token": token}, timeout=10)
+        r = await _http_send("GET", "https://oauth2.googleapis.com/tokeninfo", params={"id_token": token}, timeout=10)
         if r.status_code != 200:
             raise HTTPException(status_code=401, detail="id_token không hợp lệ")
         info = r.json()
@@ -2192,43 +5396,84 @@ async def login_google(req: GoogleLoginRequest):
         u["password_hash"] = ""
         _save_user(u)
         user_id = email.strip().lower()
-        _ensure_user(user_id)
         return LoginResponse(user_id=user_id, token=f"mock-{user_id}")
     except HTTPException:
         raise
     except Exception:
         raise HTTPException(status_code=500, detail="Lỗi xử lý đăng nhập Google")
 
+def _json_response(payload: dict) -> Response:
+    if orjson is not None:
+        return Response(content=orjson.dumps(payload), media_type="application/json")
+    return JSONResponse(payload)
+
+def _conversation_item(c: dict) -> dict:
+    return {
+        "id": c["id"],
+        "title": c.get("title", ""),
+        "title_pending": bool(c.get("title_pending")),
+        "last_active": c["last_active"].isoformat()
+    }
+
+def _encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        last_active, pk = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(last_active), int(pk)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @app.get("/v1/conversations")
-async def list_conversations(request: Request):
+async def list_conversations(request: Request, limit: Optional[int] = None, cursor: Optional[str] = None, since: Optional[int] = None):
+    """Newest-first conversations. With `limit`, pages via the opaque `next_cursor`;
+    with `since=<version>`, returns only conversations changed or deleted after it.
+    Every response carries `version` for the next `since` poll."""
     user_id = get_current_user(request)
-    _ensure_user(user_id)
-    items = list(MOCK_CHAT_DB[user_id]["conversations"].values())
-    items.sort(key=lambda x: x["last_active"], reverse=True)
+    if since is not None:
+        items, deleted, version, more = await asyncio.to_thread(_STORE.changes, "chat", user_id, since, max(1, min(limit or 200, 500)))
+        return {"conversations": [_conversation_item(c) for c in items], "deleted": deleted, "version": version, "has_more": more}
+    after = _decode_cursor(cursor) if cursor else None
+    version = await asyncio.to_thread(_STORE.version, "chat", user_id)
+    if limit is None and cursor is None:
+        items = await asyncio.to_thread(_STORE.list, "chat", user_id)
+        return {"conversations": [_conversation_item(c) for c in items], "version": version}
+    items, last = await asyncio.to_thread(_STORE.page, "chat", user_id, max(1, min(limit or 50, 500)), after)
     return {
-        "conversations": [
-            {
-                "id": c["id"],
-                "title": c.get("title", ""),
-                "last_active": c["last_active"].isoformat()
-            } for c in items
-        ]
+        "conversations": [_conversation_item(c) for c in items],
+        "next_cursor": _encode_cursor(last) if last else None,
+        "version": version,
     }
 
 @app.get("/v1/conversations/{conv_id}")
-async def get_conversation(conv_id: str, request: Request, page: int = 1, page_size: int = 50):
+async def get_conversation(conv_id: str, request: Request, page: int = 1, page_size: int = 50, before: Optional[int] = None, limit: Optional[int] = None, fields: Optional[str] = None):
+    """Messages of one conversation. `page`/`page_size` page forward from the first
+    message; `limit` (and `before=<seq>` from the previous response's `next_before`)
+    page backwards from the newest. `fields=role,content` projects each message."""
     user_id = get_current_user(request)
-    _ensure_user(user_id)
-    conv = MOCK_CHAT_DB[user_id]["conversations"].get(conv_id)
+    conv = await asyncio.to_thread(_STORE.get, "chat", user_id, conv_id)
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    data = paginate_items(conv.get("messages", []), page, page_size)
-    return {
+    projection = None
+    if fields:
+        projection = tuple(f.strip() for f in fields.split(",") if f.strip())
+        unknown = [f for f in projection if f not in _Message.FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    payload = {
         "id": conv_id,
         "title": conv.get("title", ""),
+        "title_pending": bool(conv.get("title_pending")),
         "last_active": conv["last_active"].isoformat(),
-        "messages": data.get("items", [])
     }
+    if before is not None or limit is not None:
+        items, more = await asyncio.to_thread(_STORE.latest, "chat", user_id, conv_id, max(1, min(limit or 50, 500)), before)
+        payload["next_before"] = items[0].seq if more and items else None
+    else:
+        items = await asyncio.to_thread(_STORE.rows, "chat", user_id, conv_id, max((page - 1) * page_size, 0), max(page_size, 0))
+    payload["messages"] = [m.as_dict(projection) for m in items]
+    return _json_response(payload)
 
 @app.post("/v1/conversations/start")
 async def start_conversation(request: Request):
@@ -2236,7 +5481,6 @@ async def start_conversation(request: Request):
     Optional JSON body: { "title": string }
     """
     user_id = get_current_user(request)
-    _ensure_user(user_id)
     try:
         payload = await request.json()
     except Exception:
@@ -2247,7 +5491,7 @@ async def start_conversation(request: Request):
         if isinstance(t, str):
             title = t.strip()
     conv_id = create_conversation(user_id, title or None)
-    conv = MOCK_CHAT_DB[user_id]["conversations"].get(conv_id, {})
+    conv = await asyncio.to_thread(_STORE.get, "chat", user_id, conv_id) or {}
     return {
         "id": conv_id,
         "title": conv.get("title", ""),
@@ -2257,7 +5501,6 @@ async def start_conversation(request: Request):
 @app.post("/v1/conversations/new")
 async def new_conversation(request: Request):
     user_id = get_current_user(request)
-    _ensure_user(user_id)
     try:
         payload = await request.json()
     except Exception:
@@ -2268,7 +5511,7 @@ async def new_conversation(request: Request):
         if isinstance(t, str):
             title = t.strip()
     conv_id = create_conversation(user_id, title or None)
-    conv = MOCK_CHAT_DB[user_id]["conversations"].get(conv_id, {})
+    conv = await asyncio.to_thread(_STORE.get, "chat", user_id, conv_id) or {}
     last_active = conv.get("last_active")
     ts = last_active.isoformat() if last_active else datetime.datetime.utcnow().isoformat()
     return {
@@ -2283,21 +5526,19 @@ async def update_conversation_title(conv_id: str, request: Request):
     payload = await request.json()
     title = str(payload.get("title", "")).strip()
     user_id = get_current_user(request)
-    _ensure_user(user_id)
-    conv = MOCK_CHAT_DB[user_id]["conversations"].get(conv_id)
+    conv = await asyncio.to_thread(_STORE.get, "chat", user_id, conv_id)
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    conv["title"] = title
+    await asyncio.wrap_future(_STORE.update("chat", user_id, conv_id, title=title, title_pending=None))
     return {"success": True, "id": conv_id, "title": title}
 
 @app.post("/v1/conversations/{conv_id}/auto-title")
 async def auto_title(conv_id: str, request: Request):
     user_id = get_current_user(request)
-    _ensure_user(user_id)
-    conv = MOCK_CHAT_DB[user_id]["conversations"].get(conv_id)
+    conv = await asyncio.to_thread(_STORE.get, "chat", user_id, conv_id)
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    msgs = conv.get("messages", [])
+    msgs = await asyncio.to_thread(_STORE.messages, "chat", user_id, conv_id)
     last_user = None
     last_assistant = None
     for m in reversed(msgs):
@@ -2309,18 +5550,16 @@ async def auto_title(conv_id: str, request: Request):
             break
     user_text = (last_user or {}).get("content", "")
     ai_text = (last_assistant or {}).get("content", "")
-    title = generate_auto_title(user_text, ai_text)
-    conv["title"] = title
+    title = await _generate_title(user_text, ai_text)
+    await asyncio.wrap_future(_STORE.update("chat", user_id, conv_id, title=title, title_pending=None))
     return {"success": True, "id": conv_id, "title": title}
 
 @app.delete("/v1/conversations/{conv_id}")
 async def delete_conversation(conv_id: str, request: Request):
     user_id = get_current_user(request)
-    _ensure_user(user_id)
-    convs = MOCK_CHAT_DB[user_id]["conversations"]
-    if conv_id not in convs:
+    if not await asyncio.wrap_future(_STORE.delete("chat", user_id, conv_id)):
         raise HTTPException(status_code=404, detail="Conversation not found")
-    del convs[conv_id]
+    _KV_CACHE.drop_conversation("chat", user_id, conv_id)
     return {"success": True}
 
 if __name__ == "__main__":
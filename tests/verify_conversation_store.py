@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "conversations.sqlite3")
+os.environ["CHAT_DB_PATH"] = DB_PATH
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from fastapi.testclient import TestClient
+import server
+
+client = TestClient(server.app)
+HEADERS = {"Authorization": "Bearer mock-store-user"}
+
+OTHER_PROCESS = """
+import os, sys
+os.environ["CHAT_DB_PATH"] = sys.argv[1]
+sys.path.append(sys.argv[2])
+import server
+server.save_chat_history("store-user", sys.argv[3], [{"role": "user", "content": "from another worker"}]).result()
+"""
+
+def run():
+    r = client.post("/v1/conversations/new", json={"title": "Đau đầu"}, headers=HEADERS)
+    assert r.status_code == 200
+    conv_id = r.json()["id"]
+    server.save_chat_history("store-user", conv_id, [{"role": "user", "content": "Tôi bị đau đầu"}, {"role": "assistant", "content": "Bạn nên nghỉ ngơi"}])
+    history = server.load_chat_history("store-user", conv_id)
+    assert [m["role"] for m in history] == ["user", "assistant"]
+    assert all(m.get("timestamp") for m in history)
+    assert server.load_chat_history("someone-else", conv_id) == []
+
+    # Reads wait only for writes to their own conversation, not another user's slow write.
+    slow = server._STORE._submit(lambda conn, *args: time.sleep(1.0), "chat", "slow-user", "slow")
+    started = time.perf_counter()
+    assert server._STORE.get("chat", "store-user", conv_id) is not None
+    assert time.perf_counter() - started < 0.5
+    slow.result()
+
+    subprocess.run([sys.executable, "-c", OTHER_PROCESS, DB_PATH, ROOT, conv_id], check=True)
+    # History read before the other process wrote must not be served stale.
+    assert server.load_chat_history("store-user", conv_id)[-1]["content"] == "from another worker"
+    r = client.get(f"/v1/conversations/{conv_id}", params={"page": 1, "page_size": 2}, headers=HEADERS)
+    assert r.status_code == 200
+    assert len(r.json()["messages"]) == 2
+    r = client.get(f"/v1/conversations/{conv_id}", params={"page": 2, "page_size": 2}, headers=HEADERS)
+    assert [m["content"] for m in r.json()["messages"]] == ["from another worker"]
+    r = client.get(f"/v1/conversations/{conv_id}", params={"limit": 2, "fields": "seq,role,content"}, headers=HEADERS).json()
+    assert [m["seq"] for m in r["messages"]] == [2, 3] and set(r["messages"][0]) == {"seq", "role", "content"}
+    r = client.get(f"/v1/conversations/{conv_id}", params={"limit": 2, "before": r["next_before"]}, headers=HEADERS).json()
+    assert [m["role"] for m in r["messages"]] == ["user"] and r["next_before"] is None
+    assert client.get(f"/v1/conversations/{conv_id}", params={"fields": "password"}, headers=HEADERS).status_code == 400
+
+    r = client.patch(f"/v1/conversations/{conv_id}/title", json={"title": "Nhức đầu"}, headers=HEADERS)
+    assert r.status_code == 200
+    listed = client.get("/v1/conversations", headers=HEADERS).json()["conversations"]
+    assert listed[0]["id"] == conv_id and listed[0]["title"] == "Nhức đầu"
+
+    version = client.get("/v1/conversations", headers=HEADERS).json()["version"]
+    extra = [client.post("/v1/conversations/new", json={"title": f"c{i}"}, headers=HEADERS).json()["id"] for i in range(4)]
+    seen, cursor = [], None
+    while True:
+        body = client.get("/v1/conversations", params={"limit": 2, **({"cursor": cursor} if cursor else {})}, headers=HEADERS).json()
+        seen += [c["id"] for c in body["conversations"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert len(seen) == 5 and len(set(seen)) == 5 and conv_id in seen
+    assert client.get("/v1/conversations", params={"limit": 2, "cursor": "!!"}, headers=HEADERS).status_code == 400
+    delta = client.get("/v1/conversations", params={"since": version}, headers=HEADERS).json()
+    assert sorted(c["id"] for c in delta["conversations"]) == sorted(extra) and delta["deleted"] == []
+    client.delete(f"/v1/conversations/{extra[0]}", headers=HEADERS)
+    delta = client.get("/v1/conversations", params={"since": delta["version"]}, headers=HEADERS).json()
+    assert delta["conversations"] == [] and delta["deleted"] == [extra[0]]
+
+    social_id = server.create_social_conversation("store-user")
+    server.save_social_history("store-user", social_id, [{"role": "user", "content": "chào"}])
+    assert len(server.load_social_history("store-user", social_id)) == 1
+    assert server.load_chat_history("store-user", social_id) == []
+
+    hits = server._STORE.memory.hits
+    server.save_social_history("store-user", social_id, [{"role": "assistant", "content": "chào bạn"}]).result()
+    assert server.load_social_history("store-user", social_id)[-1]["content"] == "chào bạn"
+    assert server._STORE.memory.hits == hits + 1
+
+    assert client.delete(f"/v1/conversations/{conv_id}", headers=HEADERS).status_code == 200
+    assert client.delete(f"/v1/conversations/{conv_id}", headers=HEADERS).status_code == 404
+    assert server.load_chat_history("store-user", conv_id) == []
+    print("ok", json.dumps(server._STORE.stats()))
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,54 @@
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+os.environ["EVENTS_INDEX_EVERY"] = "8"
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fastapi.testclient import TestClient
+import server
+
+client = TestClient(server.app)
+
+def run():
+    folder = tempfile.mkdtemp()
+    # Keep the tracked runtime-events.jsonl untouched: the sink and its index write/read a temp copy.
+    tracked = server._EVENTS.path
+    with open(tracked, "rb") as f:
+        before = f.read()
+    server._EVENTS.path = os.path.join(folder, "runtime-events.jsonl")
+    server._EVENT_INDEXES["events"] = server._JsonlIndex(server._EVENTS.path)
+    path = os.path.join(folder, "runtime-metrics.jsonl")
+    with gzip.open(os.path.join(folder, "runtime-metrics-20250101-000000-000000.jsonl.gz"), "wt", encoding="utf-8") as f:
+        for i in range(10):
+            f.write(json.dumps({"mode": "cpu", "duration_ms": 1000 + i, "ts": f"2025-01-01T00:00:{i:02d}Z"}) + "\n")
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(60):
+            f.write(json.dumps({"mode": "gpu" if i % 2 else "cpu", "duration_ms": i * 10, "ts": f"2025-02-01T00:{i:02d}:00.000Z"}) + "\n")
+    server._EVENT_INDEXES["metrics"] = server._JsonlIndex(path)
+
+    r = client.get("/v1/runtime/events", params={"source": "metrics", "since": "2025-02-01T00:20:00Z", "until": "2025-02-01T00:29:00Z"}).json()
+    assert r["matched"] == 10
+    assert r["index"]["blocks_read"] < r["index"]["blocks_total"]
+    assert r["stats"]["gpu"]["count"] == 5 and r["stats"]["cpu"]["p50_ms"] == 240.0
+
+    r = client.get("/v1/runtime/events", params={"source": "metrics", "tier": "cpu", "until": "2025-01-31T00:00:00Z"}).json()
+    assert r["matched"] == 10 and r["stats"]["cpu"]["p95_ms"] == 1009.0
+
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"mode": "gpu", "duration_ms": 5, "ts": "2025-03-01T00:00:00Z"}) + "\n")
+    r = client.get("/v1/runtime/events", params={"source": "metrics", "since": "2025-03-01T00:00:00Z"}).json()
+    assert r["matched"] == 1 and r["index"]["blocks_read"] == 1
+
+    assert client.get("/v1/runtime/events", params={"since": "yesterday"}).status_code == 400
+    server._append_runtime_event({"type": "verify_event", "tier": "pro", "ts": "2099-01-01T00:00:00"})
+    r = client.get("/v1/runtime/events", params={"type": "verify_event", "tier": "pro", "since": "2098-12-31T00:00:00"}).json()
+    assert r["matched"] == 1
+    server._EVENTS.flush()
+    with open(tracked, "rb") as f:
+        assert f.read() == before
+    print("ok", json.dumps(r["index"]))
+
+if __name__ == "__main__":
+    run()